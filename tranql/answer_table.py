@@ -0,0 +1,231 @@
+import copy
+import json
+import logging
+import numpy as np
+
+logger = logging.getLogger (__name__)
+
+class Vocabulary:
+    """ Integer codes for the identifiers answers bind. A binding to a list of identifiers has one code for the list. """
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode (self, value):
+        key = tuple(value) if isinstance(value, list) else value
+        code = self.codes.get (key, None)
+        if code is None:
+            code = self.codes[key] = len(self.values)
+            self.values.append (key)
+        return code
+
+    def decode (self, code):
+        value = self.values[code]
+        return list(value) if isinstance(value, tuple) else value
+
+class AnswerTable:
+    """
+    Answers as columns: one array per node and edge binding, holding codes from a vocabulary, with -1 where
+    an answer has no such binding. Joins, deduplication and renaming of the identifiers answers bind work on
+    whole columns at once. Tables share a vocabulary to be joined.
+
+    Answer properties other than bindings, like scores, are kept with each row as they are.
+    """
+
+    kinds = ("node_bindings", "edge_bindings")
+
+    def __init__(self, vocabulary, columns, extras):
+        """ columns maps (kind, name) to an array of codes. extras holds each row's other properties, or None. """
+        self.vocabulary = vocabulary
+        self.columns = columns
+        self.extras = extras
+
+    def __len__(self):
+        return len(self.extras)
+
+    @classmethod
+    def from_answers (cls, answers, vocabulary=None):
+        vocabulary = vocabulary if vocabulary is not None else Vocabulary ()
+        codes = vocabulary.codes
+        binding_kinds = set (cls.kinds)
+        columns = { kind : {} for kind in cls.kinds }
+        extras = []
+        for row, answer in enumerate(answers):
+            for kind, named in columns.items ():
+                for name, value in answer.get (kind, {}).items ():
+                    column = named.get (name, None)
+                    if column is None:
+                        column = named[name] = [ -1 ] * len(answers)
+                    """ Most values are strings already in the vocabulary. """
+                    code = codes.get (value, None) if value.__class__ is str else None
+                    column[row] = code if code is not None else vocabulary.encode (value)
+            extras.append (None if answer.keys () <= binding_kinds else
+                           { k : v for k, v in answer.items () if k not in binding_kinds })
+        return cls (vocabulary, { (kind, name) : np.array (column, dtype=np.int64)
+                                  for kind, named in columns.items () for name, column in named.items () }, extras)
+
+    def to_answers (self):
+        decoded = { k : [ self.vocabulary.decode (code) if code >= 0 else None for code in v.tolist () ]
+                    for k, v in self.columns.items () }
+        answers = []
+        for row, extra in enumerate(self.extras):
+            answer = { kind : {} for kind in self.kinds }
+            for (kind, name), values in decoded.items ():
+                if values[row] is not None:
+                    answer[kind][name] = values[row]
+            if extra is not None:
+                answer.update (copy.deepcopy (extra))
+            answers.append (answer)
+        return answers
+
+    def take (self, rows):
+        """ A table of the given rows. """
+        return AnswerTable (self.vocabulary,
+                            { k : v[rows] for k, v in self.columns.items () },
+                            [ self.extras[row] for row in rows.tolist () ])
+
+    @staticmethod
+    def concat (tables, vocabulary):
+        """ Stack tables sharing a vocabulary. Rows lacking a table's bindings get -1. """
+        names = list(dict.fromkeys ([ k for t in tables for k in t.columns ]))
+        columns = {
+            k : np.concatenate ([ t.columns[k] if k in t.columns else np.full (len(t), -1, dtype=np.int64) for t in tables ])
+                if len(tables) > 0 else np.zeros (0, dtype=np.int64)
+            for k in names
+        }
+        return AnswerTable (vocabulary, columns, [ e for t in tables for e in t.extras ])
+
+    def remap (self, kind, rename):
+        """ Rename the identifiers bound by one kind of binding. rename maps an identifier to its new name. """
+        for key, column in self.columns.items ():
+            if key[0] != kind:
+                continue
+            present = column >= 0
+            codes = np.unique (column[present])
+            """ Look up each distinct code once, then translate the whole column. """
+            renamed = np.array ([ self.rename_code (code, rename) for code in codes.tolist () ], dtype=np.int64)
+            if len(codes) > 0:
+                column[present] = renamed[np.searchsorted (codes, column[present])]
+        return self
+
+    def rename_code (self, code, rename):
+        value = self.vocabulary.decode (code)
+        if isinstance(value, list):
+            return self.vocabulary.encode ([ rename (v) for v in value ])
+        return self.vocabulary.encode (rename (value))
+
+    def dedup (self):
+        """ Drop rows repeating an earlier row's bindings and properties. """
+        if len(self) == 0:
+            return self
+        keys = [ v for v in self.columns.values () ]
+        if any ([ e is not None for e in self.extras ]):
+            extras = {}
+            keys.append (np.array ([ extras.setdefault (json.dumps (e, sort_keys=True), len(extras)) if e is not None else -1
+                                     for e in self.extras ], dtype=np.int64))
+        if len(keys) == 0:
+            return self.take (np.arange (1))
+        _, first = np.unique (np.stack (keys, axis=1), axis=0, return_index=True)
+        return self.take (np.sort (first))
+
+    def join (self, other, left, right):
+        """
+        Join each row with the rows of other binding the same node to the question node right as it binds to left.
+        Joined rows have the bindings of both, other's taking precedence, and this table's other properties.
+        """
+        assert self.vocabulary is other.vocabulary
+        empty = np.full (len(self), -1, dtype=np.int64)
+        left_codes = self.columns.get (("node_bindings", left), empty)
+        right_codes = other.columns.get (("node_bindings", right), np.full (len(other), -1, dtype=np.int64))
+        order = np.argsort (right_codes, kind='stable')
+        ordered = right_codes[order]
+        start = np.searchsorted (ordered, left_codes, side='left')
+        counts = np.searchsorted (ordered, left_codes, side='right') - start
+        counts[left_codes < 0] = 0
+        """ Each left row repeated once per match, and the matching right rows, in order. """
+        left_rows = np.repeat (np.arange (len(self)), counts)
+        offsets = np.arange (counts.sum ()) - np.repeat (np.cumsum (counts) - counts, counts)
+        right_rows = order[np.repeat (start, counts) + offsets]
+        columns = {}
+        for key in dict.fromkeys ([ *self.columns, *other.columns ]):
+            column = self.columns[key][left_rows] if key in self.columns else np.full (len(left_rows), -1, dtype=np.int64)
+            if key in other.columns:
+                bound = other.columns[key][right_rows]
+                column = np.where (bound >= 0, bound, column)
+            columns[key] = column
+        return AnswerTable (self.vocabulary, columns, [ self.extras[row] for row in left_rows.tolist () ])
+
+    @staticmethod
+    def connect (tables, root_order):
+        """
+        Connect the answers of responses to the segments of a query into answers along its whole path.
+        tables is a list of (question order, table) pairs sharing a vocabulary. Without a root order, answers are
+        concatenated.
+        """
+        vocabulary = tables[0][1].vocabulary if len(tables) > 0 else Vocabulary ()
+        if len(tables) == 1:
+            return tables[0][1]
+        if root_order is None:
+            return AnswerTable.concat ([ table for order, table in tables ], vocabulary)
+        """ Group the responses by the question node they start at, following the path from the root. """
+        groups = {}
+        for order, table in tables:
+            if order[0] == root_order[0]:
+                groups.setdefault (root_order[0], []).append ((order, table))
+        while sum ([ len(group) for group in groups.values () ]) < len(tables):
+            start = list(groups.values ())[-1][0][0][-1]
+            for order, table in tables:
+                if order[0] == start:
+                    groups.setdefault (start, []).append ((order, table))
+        groups = list(groups.values ())
+        if len(groups) < 2:
+            return AnswerTable.concat ([], vocabulary)
+        result = AnswerTable.concat ([ table for order, table in groups[0] ], vocabulary)
+        for index, group in enumerate(groups[:-1]):
+            ends = dict.fromkeys ([ order[-1] for order, table in group ])
+            joined = [
+                result.join (next_table, end, next_order[0])
+                for end in ends
+                for next_order, next_table in groups[index+1]
+            ]
+            result = AnswerTable.concat (joined, vocabulary).dedup ()
+        return result
+
+    def to_arrow (self):
+        """ The table as an Apache Arrow table, with a column per binding named like node_bindings.disease. Requires pyarrow. """
+        import pyarrow
+        data = {}
+        for (kind, name), column in self.columns.items ():
+            values = [ self.vocabulary.decode (code) if code >= 0 else None for code in column.tolist () ]
+            if any ([ isinstance(v, list) for v in values ]):
+                values = [ v if isinstance(v, list) or v is None else [ v ] for v in values ]
+            data[f"{kind}.{name}"] = values
+        return pyarrow.Table.from_pydict (data)
+
+    def to_parquet (self, where):
+        """ Write the table to a Parquet file, given its path or a writable stream. Requires pyarrow. """
+        import pyarrow.parquet
+        pyarrow.parquet.write_table (self.to_arrow (), where)
+
+    """ The formats answers can be exported in, and their media types. """
+    exports = {
+        "arrow" : "application/vnd.apache.arrow.stream",
+        "parquet" : "application/vnd.apache.parquet"
+    }
+
+    def export (self, format):
+        """ The table as an Arrow IPC stream or a Parquet file, in bytes. Requires pyarrow. """
+        import pyarrow
+        sink = pyarrow.BufferOutputStream ()
+        if format == "parquet":
+            self.to_parquet (sink)
+        else:
+            table = self.to_arrow ()
+            writer = pyarrow.RecordBatchStreamWriter (sink, table.schema)
+            writer.write_table (table)
+            writer.close ()
+        return sink.getvalue ().to_pybytes ()
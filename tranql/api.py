@@ -3,6 +3,7 @@ Provide a standard protocol for asking graph oriented questions of Translator da
 """
 import copy
 import argparse
+import hashlib
 import json
 import logging
 import os
@@ -22,12 +23,29 @@ from tranql.util import JSONKit
 from tranql.tranql_schema import GraphTranslator, Schema
 from tranql.concept import BiolinkModelWalker
 from tranql.exception import TranQLException
+from tranql.config import Config
+from tranql.jobs import Job, JobPool, JobRegistry
+from tranql.stream import QueryStream
+from tranql.result_store import ResultStore
+from tranql.answer_table import AnswerTable
+from tranql.message_parser import Projection
 #import flask_monitoringdashboard as dashboard
 
 logger = logging.getLogger (__name__)
 
 web_app_root = os.path.join (os.path.dirname (__file__), "..", "web", "build")
 
+config = Config ("conf.yml")
+
+""" Long running queries execute in the background on a bounded pool, apart from interactive requests. """
+query_jobs = JobRegistry (JobPool (max_workers=int(config.get ('MAX_QUERY_JOBS', 4)), name="tranql-query"))
+stream_pool = JobPool (max_workers=int(config.get ('MAX_QUERY_STREAMS', 8)), name="tranql-stream")
+
+""" Large results are kept here so clients can page through them. """
+result_store = ResultStore (
+    ttl=float(config.get ('RESULT_STORE_TTL', 3600)),
+    max_entries=int(config.get ('RESULT_STORE_SIZE', 100)))
+
 app = Flask(__name__)
 #app = Flask(__name__, static_folder=web_app_root)
 #dashboard.bind(app)
@@ -319,9 +337,9 @@ class MergeMessages(StandardAPIResource):
                 default: false
               required: false
               description: >
-                (Experimental) Tells the merger to invoke the Bionames API on nodes in order to get more equivalent identifiers.
+                Tells the merger to invoke the Bionames API on nodes in order to get more equivalent identifiers.
                 Ideally, this should result in a more thoroughly merged graph, as fewer equivalent nodes will fail to be detected.
-                This currently should not be used on large queries (1000+ nodes), or it will end up flooding the Bionames API.
+                Each distinct name is looked up once, concurrently with the others, and what it resolves to is cached.
             - in: query
               name: question_graph
               schema:
@@ -407,6 +425,48 @@ class TranQLQuery(StandardAPIResource):
               required: false
               default: true
               description: Specifies if requests made by TranQL will be asynchronous.
+            - in: query
+              name: timeout
+              schema:
+                type: number
+              required: false
+              description: >
+                Seconds the query may run. Outstanding reasoner requests are abandoned when it passes.
+                Capped by the server's MAX_QUERY_TIMEOUT setting, which is also the default.
+            - in: query
+              name: partial_results
+              schema:
+                type: boolean
+              required: false
+              default: false
+              description: >
+                When the timeout passes, return the results merged so far with a Warning status instead of failing.
+                The response's completeness section lists the questions, plan segments, and statements that are missing.
+            - in: query
+              name: statement_memo
+              schema:
+                type: boolean
+              required: false
+              default: false
+              description: Reuse the results of statements that, like the variables they read, are unchanged since they last ran.
+            - in: query
+              name: projection
+              schema:
+                type: string
+              required: false
+              description: >
+                Comma separated node and edge attributes to keep, like node.description,edge.publications.
+                Ids, types, names, equivalent identifiers, reasoners and source databases are always kept. Other attributes
+                are dropped as reasoner responses are read. By default every attribute is kept.
+            - in: query
+              name: store
+              schema:
+                type: boolean
+              required: false
+              default: false
+              description: >
+                Keep the result on the server and return its id and summary counts instead of the message.
+                Its answers, nodes, and edges can then be paged through at /tranql/results/{result_id}.
         responses:
             '200':
                 description: Message
@@ -423,32 +483,540 @@ class TranQLQuery(StandardAPIResource):
 
         """
         #self.validate (request)
-        result = {}
-
         logging.debug (request.data)
         query = request.data.decode('utf-8')
-        dynamic_id_resolution = request.args.get('dynamic_id_resolution','False').upper() == 'TRUE'
-        asynchronous = request.args.get('asynchronous', 'True').upper() == 'TRUE'
         logging.debug (f"--> query: {query}")
-        tranql = TranQL (options = {
-            "dynamic_id_resolution" : dynamic_id_resolution,
-            "asynchronous" : asynchronous
-        })
+        tranql = TranQL (options = self.get_options (request))
+        result = self.run (tranql, query)
+        if app.debug:
+            with open ('query.out', 'w') as stream:
+                json.dump (result, stream, indent=2)
+        if request.args.get('store', 'False').upper() == 'TRUE':
+            result = self.store (result)
+
+        return self.response(result)
+
+    @staticmethod
+    def store (result):
+        """ Keep a result in the result store, returning its id and summary along with any status and errors. """
+        if result.get ('status', None) == "Error":
+            return result
+        result_id = result_store.put (result)
+        return {
+            "result_id" : result_id,
+            "summary" : result_store.summary (result_id),
+            **{ k : result[k] for k in [ "status", "errors", "completeness" ] if k in result }
+        }
+
+    @staticmethod
+    def get_options (request):
+        """ Get the interpreter options given as query parameters. """
+        return {
+            "dynamic_id_resolution" : request.args.get('dynamic_id_resolution','False').upper() == 'TRUE',
+            "asynchronous" : request.args.get('asynchronous', 'True').upper() == 'TRUE',
+            "timeout" : request.args.get('timeout', None, type=float),
+            "partial_results" : request.args.get('partial_results', 'False').upper() == 'TRUE',
+            "statement_memo" : request.args.get('statement_memo', 'False').upper() == 'TRUE',
+            "projection" : TranQLQuery.get_projection (request)
+        }
+
+    @staticmethod
+    def get_projection (request):
+        """ The node and edge attributes a query keeps, if it limits them. """
+        try:
+            return Projection.from_config (request.args.get('projection', None))
+        except ValueError as error:
+            abort(Response(str(error), 400))
+
+    @staticmethod
+    def run (tranql, query):
+        """ Execute a query, returning the resulting message along with any errors and completeness information. """
+        result = {}
         try:
             context = tranql.execute (query) #, cache=True)
             result = context.mem.get ('result', {})
             logger.debug (f" -- backplane: {context.mem.get('backplane', '')}")
             if len(context.mem.get ('requestErrors', [])) > 0:
-                errors = self.handle_exception(context.mem['requestErrors'], warning=True)
+                errors = StandardAPIResource.handle_exception(context.mem['requestErrors'], warning=True)
                 result.update(errors)
+            completeness = context.mem.get ('completeness', {})
+            if not completeness.get ('complete', True):
+                result['completeness'] = completeness
         except Exception as e:
             traceback.print_exc()
             errors = [e, *tranql.context.mem.get ('requestErrors', [])]
-            result = self.handle_exception (errors)
-        with open ('query.out', 'w') as stream:
-            json.dump (result, stream, indent=2)
+            result = StandardAPIResource.handle_exception (errors)
+        return result
 
-        return self.response(result)
+class TranQLQueryStream(StandardAPIResource):
+    """ Stream a query's progress and results as they arrive. """
+
+    def __init__(self):
+        super().__init__()
+
+    def post(self):
+        """
+        Query TranQL, streaming results
+        ---
+        tags: [query]
+        description: >
+          Execute a TranQL query, streaming events as it executes. Progress events report statements
+          started and done, plan segments done, and the timing of each reasoner response. Delta events carry
+          the knowledge graph nodes and edges new to the merge as reasoner responses arrive. Once a statement's
+          responses are merged, a last delta remaps nodes sent under another id to their merged ids. The stream
+          ends with a result event carrying the knowledge_map.
+          Events are newline delimited JSON, or server sent events if the request accepts text/event-stream.
+        requestBody:
+          name: query
+          description: A valid TranQL program
+          required: true
+          content:
+            text/plain:
+             schema:
+               type: string
+             example: >
+               select chemical_substance->gene->disease
+                 from \"/graph/gamma/quick\"
+                where disease=\"asthma\"
+        parameters:
+            - in: query
+              name: dynamic_id_resolution
+              schema:
+                type: boolean
+              required: false
+              default: false
+              description: Specifies if dynamic id lookup of curies will be performed
+            - in: query
+              name: asynchronous
+              schema:
+                type: boolean
+              required: false
+              default: true
+              description: Specifies if requests made by TranQL will be asynchronous.
+            - in: query
+              name: timeout
+              schema:
+                type: number
+              required: false
+              description: Seconds the query may run. Capped by the server's MAX_QUERY_TIMEOUT setting, which is also the default.
+            - in: query
+              name: partial_results
+              schema:
+                type: boolean
+              required: false
+              default: false
+              description: When the timeout passes, finish with the results merged so far instead of failing.
+            - in: query
+              name: statement_memo
+              schema:
+                type: boolean
+              required: false
+              default: false
+              description: Reuse the results of statements that, like the variables they read, are unchanged since they last ran.
+            - in: query
+              name: projection
+              schema:
+                type: string
+              required: false
+              description: >
+                Comma separated node and edge attributes to keep, like node.description,edge.publications.
+                Ids, types, names, equivalent identifiers, reasoners and source databases are always kept. Other attributes
+                are dropped as reasoner responses are read. By default every attribute is kept.
+        responses:
+            '200':
+                description: A stream of events
+                content:
+                    application/x-ndjson:
+                        schema:
+                          type: string
+                    text/event-stream:
+                        schema:
+                          type: string
+        """
+        query = request.data.decode('utf-8')
+        tranql = TranQL (options = TranQLQuery.get_options (request))
+        stream = QueryStream (tranql)
+        stream_pool.submit ("stream", stream.run, lambda: TranQLQuery.run (tranql, query))
+        if request.accept_mimetypes.best == 'text/event-stream':
+            return Response (stream.messages (format="sse"), mimetype='text/event-stream')
+        return Response (stream.messages (), mimetype='application/x-ndjson')
+
+class TranQLJobs(StandardAPIResource):
+    """ Run long queries in the background. """
+
+    def __init__(self):
+        super().__init__()
+
+    def post(self):
+        """
+        Submit a TranQL query job
+        ---
+        tags: [query]
+        description: >
+          Start executing a TranQL query in the background, returning a job that can be polled for its status and result.
+          Submitting a query identical to one still executing, with the same options, returns the existing job.
+        requestBody:
+          name: query
+          description: A valid TranQL program
+          required: true
+          content:
+            text/plain:
+             schema:
+               type: string
+             example: >
+               select chemical_substance->gene->disease
+                 from \"/graph/gamma/quick\"
+                where disease=\"asthma\"
+        parameters:
+            - in: query
+              name: dynamic_id_resolution
+              schema:
+                type: boolean
+              required: false
+              default: false
+              description: Specifies if dynamic id lookup of curies will be performed
+            - in: query
+              name: asynchronous
+              schema:
+                type: boolean
+              required: false
+              default: true
+              description: Specifies if requests made by TranQL will be asynchronous.
+            - in: query
+              name: timeout
+              schema:
+                type: number
+              required: false
+              description: Seconds the query may run. Capped by the server's MAX_QUERY_TIMEOUT setting, which is also the default.
+            - in: query
+              name: partial_results
+              schema:
+                type: boolean
+              required: false
+              default: false
+              description: When the timeout passes, keep the results merged so far instead of failing.
+            - in: query
+              name: statement_memo
+              schema:
+                type: boolean
+              required: false
+              default: false
+              description: Reuse the results of statements that, like the variables they read, are unchanged since they last ran.
+            - in: query
+              name: projection
+              schema:
+                type: string
+              required: false
+              description: >
+                Comma separated node and edge attributes to keep, like node.description,edge.publications.
+                Ids, types, names, equivalent identifiers, reasoners and source databases are always kept. Other attributes
+                are dropped as reasoner responses are read. By default every attribute is kept.
+        responses:
+            '202':
+                description: The submitted job
+                content:
+                    application/json:
+                        schema:
+                          type: object
+        """
+        query = request.data.decode('utf-8')
+        options = TranQLQuery.get_options (request)
+        key = hashlib.sha256 (json.dumps ([ query, options ], sort_keys=True, default=TranQLJobs.key_value).encode ('utf-8')).hexdigest ()
+        tranql = TranQL (options = options)
+        job, coalesced = query_jobs.submit (key, "query", TranQLQuery.run, tranql, query)
+        if not coalesced:
+            job.progress = tranql.get_progress
+            job.canceller = tranql.cancel
+        return ({ **job.to_dict (include_result=False), "coalesced" : coalesced }, 202)
+
+    @staticmethod
+    def key_value (value):
+        """ The JSON form of option values, like projections, that aren't JSON themselves, to key jobs by. """
+        if isinstance(value, Projection):
+            return value.to_json ()
+        raise TypeError (f"Object of type {type(value).__name__} is not JSON serializable")
+
+    def get(self):
+        """
+        List TranQL query jobs
+        ---
+        tags: [query]
+        description: List recently submitted query jobs and their status.
+        responses:
+            '200':
+                description: Jobs
+                content:
+                    application/json:
+                        schema:
+                          type: array
+                          items:
+                            type: object
+        """
+        return self.response ([ job.to_dict (include_result=False) for job in query_jobs.list () ])
+
+class TranQLJob(StandardAPIResource):
+    """ A query job. """
+
+    def __init__(self):
+        super().__init__()
+
+    @staticmethod
+    def find (job_id):
+        job = query_jobs.get (job_id)
+        if job is None:
+            abort (404, f"Unknown job: {job_id}")
+        return job
+
+    def get(self, job_id):
+        """
+        Get a TranQL query job's status
+        ---
+        tags: [query]
+        description: Get a job's status and progress - statements, plan segments, and questions done so far.
+        parameters:
+            - in: path
+              name: job_id
+              schema:
+                type: string
+              required: true
+        responses:
+            '200':
+                description: The job
+                content:
+                    application/json:
+                        schema:
+                          type: object
+            '404':
+                description: No such job
+        """
+        return self.response (self.find (job_id).to_dict (include_result=False))
+
+    def delete(self, job_id):
+        """
+        Cancel a TranQL query job
+        ---
+        tags: [query]
+        description: Cancel a job. Outstanding reasoner requests are abandoned.
+        parameters:
+            - in: path
+              name: job_id
+              schema:
+                type: string
+              required: true
+        responses:
+            '200':
+                description: The job
+                content:
+                    application/json:
+                        schema:
+                          type: object
+            '404':
+                description: No such job
+        """
+        job = self.find (job_id)
+        job.cancel ()
+        return self.response (job.to_dict (include_result=False))
+
+class TranQLJobResult(StandardAPIResource):
+    """ The result of a query job. """
+
+    def __init__(self):
+        super().__init__()
+
+    def get(self, job_id):
+        """
+        Get a TranQL query job's result
+        ---
+        tags: [query]
+        description: >
+          Get the message produced by a finished job. While the job is still executing, its status is returned
+          with a 202 status code.
+        parameters:
+            - in: path
+              name: job_id
+              schema:
+                type: string
+              required: true
+            - in: query
+              name: store
+              schema:
+                type: boolean
+              required: false
+              default: false
+              description: Keep the result on the server and return its id and summary counts instead of the message.
+        responses:
+            '200':
+                description: Message
+                content:
+                    application/json:
+                        schema:
+                          $ref: '#/definitions/Message'
+            '202':
+                description: The job has not finished
+            '404':
+                description: No such job
+            '410':
+                description: The job was cancelled
+            '500':
+                description: An error was encountered
+                content:
+                    application/json:
+                        schema:
+                          $ref: '#/definitions/Error'
+        """
+        job = TranQLJob.find (job_id)
+        status = job.status
+        if not job.done ():
+            return (job.to_dict (include_result=False), 202)
+        if status == Job.CANCELLED:
+            return (self.handle_exception (f"Job {job_id} was cancelled."), 410)
+        if status == Job.ERROR:
+            return self.response (self.handle_exception (job.future.exception ()))
+        if request.args.get('store', 'False').upper() == 'TRUE':
+            return self.response (TranQLQuery.store (job.result ()))
+        return self.response (job.result ())
+
+class TranQLResult(StandardAPIResource):
+    """ A stored result. """
+
+    def __init__(self):
+        super().__init__()
+
+    def get(self, result_id):
+        """
+        Get a stored result's summary
+        ---
+        tags: [query]
+        description: Get the number of answers, nodes, and edges in a stored result, and the number of nodes and edges of each type.
+        parameters:
+            - in: path
+              name: result_id
+              schema:
+                type: string
+              required: true
+        responses:
+            '200':
+                description: Summary
+                content:
+                    application/json:
+                        schema:
+                          type: object
+            '404':
+                description: No such result. It may have expired.
+        """
+        summary = result_store.summary (result_id)
+        if summary is None:
+            abort (404, f"Unknown result: {result_id}")
+        return self.response ({ "result_id" : result_id, "summary" : summary })
+
+class TranQLResultPage(StandardAPIResource):
+    """ Pages of a stored result's answers, nodes, or edges. """
+
+    def __init__(self):
+        super().__init__()
+
+    def get(self, result_id, section):
+        """
+        Page through a stored result
+        ---
+        tags: [query]
+        description: >
+          Get a page of a stored result's answers (its knowledge_map), nodes, or edges.
+          Pass the returned `next` cursor to get the following page. It is null on the last page.
+        parameters:
+            - in: path
+              name: result_id
+              schema:
+                type: string
+              required: true
+            - in: path
+              name: section
+              schema:
+                type: string
+                enum: [answers, nodes, edges]
+              required: true
+            - in: query
+              name: cursor
+              schema:
+                type: string
+              required: false
+            - in: query
+              name: limit
+              schema:
+                type: integer
+              required: false
+              default: 100
+              description: The number of items per page, at most 10000.
+            - in: query
+              name: type
+              schema:
+                type: string
+              required: false
+              description: Only nodes or edges of this type.
+            - in: query
+              name: format
+              schema:
+                type: string
+                enum: [json, arrow, parquet]
+              required: false
+              default: json
+              description: >
+                Export all of the answers, unpaged, as an Arrow IPC stream or a Parquet file, with a column
+                per binding named like node_bindings.disease. Requires pyarrow on the server.
+        responses:
+            '200':
+                description: A page of items
+                content:
+                    application/json:
+                        schema:
+                          type: object
+                    application/vnd.apache.arrow.stream:
+                        schema:
+                          type: string
+                          format: binary
+                    application/vnd.apache.parquet:
+                        schema:
+                          type: string
+                          format: binary
+            '400':
+                description: Invalid cursor, section or format
+            '404':
+                description: No such result. It may have expired.
+            '501':
+                description: The server can't export answers without pyarrow.
+        """
+        if section not in ResultStore.sections:
+            abort (400, f"Unknown section: {section}. Expected one of {', '.join(ResultStore.sections)}.")
+        export = request.args.get ('format', 'json')
+        if export != 'json':
+            return self.export (result_id, section, export)
+        limit = min(max(1, request.args.get ('limit', 100, type=int)), 10000)
+        try:
+            page = result_store.page (
+                result_id,
+                section,
+                cursor=request.args.get ('cursor', None),
+                limit=limit,
+                type_name=request.args.get ('type', None))
+        except ValueError as e:
+            abort (400, str(e))
+        if page is None:
+            abort (404, f"Unknown result: {result_id}")
+        return self.response (page)
+
+    def export (self, result_id, section, export):
+        """ Export a stored result's answers as a whole. """
+        if export not in AnswerTable.exports or section != "answers":
+            abort (400, f"Answers can be exported as {', '.join(AnswerTable.exports)}, not {section} as {export}.")
+        try:
+            import pyarrow
+        except ImportError:
+            abort (501, "Exporting answers requires pyarrow.")
+        result = result_store.get (result_id)
+        if result is None:
+            abort (404, f"Unknown result: {result_id}")
+        table = AnswerTable.from_answers (result.get ('knowledge_map', []))
+        return Response (table.export (export), mimetype=AnswerTable.exports[export])
 
 class AnnotateGraph(StandardAPIResource):
     """ Request the message object to be annotated by the backplane and return the annotated message """
@@ -741,6 +1309,12 @@ class ParseIncomplete(StandardAPIResource):
 ###############################################################################################
 
 api.add_resource(TranQLQuery, '/tranql/query')
+api.add_resource(TranQLQueryStream, '/tranql/query/stream')
+api.add_resource(TranQLResult, '/tranql/results/<result_id>')
+api.add_resource(TranQLResultPage, '/tranql/results/<result_id>/<section>')
+api.add_resource(TranQLJobs, '/tranql/jobs')
+api.add_resource(TranQLJob, '/tranql/jobs/<job_id>')
+api.add_resource(TranQLJobResult, '/tranql/jobs/<job_id>/result')
 api.add_resource(SchemaGraph, '/tranql/schema')
 api.add_resource(AnnotateGraph, '/tranql/annotate')
 api.add_resource(MergeMessages,'/tranql/merge_messages')
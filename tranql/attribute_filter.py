@@ -0,0 +1,119 @@
+import logging
+import numpy as np
+
+logger = logging.getLogger (__name__)
+
+class AttributeFilter:
+    """
+    Filter a merged result by the attributes of its nodes and edges.
+
+    WHERE constraints like `edge.p_val < 0.05` or `node.name != "x"` are evaluated here instead of being
+    sent to reasoners. Each attribute is gathered into one array per element kind and each constraint is
+    evaluated over it at once. An answer binding any node or edge failing a constraint is dropped, as are
+    the nodes and edges no remaining answer needs.
+
+    Elements without the attribute fail the constraint. List valued attributes, like publications, compare
+    by their length.
+    """
+
+    """ Prefixes of constraint names evaluated here. """
+    kinds = { "node" : "nodes", "edge" : "edges" }
+
+    operators = {
+        "=" : np.equal, "eq" : np.equal,
+        "!=" : np.not_equal, "ne" : np.not_equal,
+        "<" : np.less, "lt" : np.less,
+        "<=" : np.less_equal, "le" : np.less_equal,
+        ">" : np.greater, "gt" : np.greater,
+        ">=" : np.greater_equal, "ge" : np.greater_equal
+    }
+
+    def __init__(self, constraints):
+        """ Constraints are [ name, operator, value ] lists, with names like edge.p_val. """
+        self.constraints = constraints
+
+    @classmethod
+    def applies (cls, name):
+        """ Is a constraint of this name an attribute filter rather than an option to the reasoner? """
+        prefix, _, attribute = name.partition (".")
+        return prefix in cls.kinds and len(attribute) > 0
+
+    @staticmethod
+    def ids (value):
+        return value if isinstance(value, list) else [ value ]
+
+    @staticmethod
+    def column (elements, attribute, numeric):
+        """ Gather an attribute of all elements into an array. Missing values are NaN or None. """
+        def value (element):
+            v = element.get (attribute, None)
+            return len(v) if isinstance(v, list) else v
+        values = [ value (e) for e in elements ]
+        if numeric:
+            return np.array ([ v if isinstance(v, (int, float)) and not isinstance(v, bool) else np.nan
+                               for v in values ], dtype=float)
+        return np.array (values, dtype=object)
+
+    def passing (self, kind, elements):
+        """ Evaluate the constraints on one kind of element, returning a mask of the elements that pass all of them. """
+        mask = np.ones (len(elements), dtype=bool)
+        for name, op, value in self.constraints:
+            prefix, _, attribute = name.partition (".")
+            if prefix != kind:
+                continue
+            if op not in self.operators:
+                raise ValueError (f"Unsupported operator {op} in constraint {name} {op} {value}.")
+            if isinstance(value, str) and op not in ("=", "eq", "!=", "ne"):
+                """ Orderings are numeric, whether or not the number was quoted. """
+                try:
+                    value = float(value)
+                except ValueError:
+                    raise ValueError (f"Constraint {name} {op} {value} needs a number.")
+            numeric = isinstance(value, (int, float)) and not isinstance(value, bool)
+            column = self.column (elements, attribute, numeric)
+            if numeric:
+                """ Comparisons with NaN are false, except !=. Missing values fail either way. """
+                with np.errstate (invalid='ignore'):
+                    mask &= self.operators[op] (column, value) & ~np.isnan (column)
+            else:
+                present = np.array ([ v is not None for v in column ], dtype=bool)
+                mask &= np.array (self.operators[op] (column, value), dtype=bool) & present
+        return mask
+
+    def apply (self, result):
+        """ Filter a result, returning a new result. The result passed in is not modified. """
+        if len(self.constraints) == 0:
+            return result
+        graph = result.get ('knowledge_graph', {})
+        answers = result.get ('knowledge_map', [])
+        masks = {}
+        failed = {}
+        for kind, section in self.kinds.items ():
+            elements = graph.get (section, [])
+            masks[section] = self.passing (kind, elements)
+            failed[kind] = set ([ e['id'] for e, ok in zip(elements, masks[section]) if not ok and 'id' in e ])
+        """ Flatten the answers' bindings so one lookup finds every answer binding a failed element. """
+        answer_index = []
+        bound = []
+        for index, answer in enumerate(answers):
+            for kind in self.kinds:
+                for v in answer.get (f"{kind}_bindings", {}).values ():
+                    for id in self.ids (v):
+                        answer_index.append (index)
+                        bound.append (id in failed[kind])
+        keep = np.ones (len(answers), dtype=bool)
+        if len(bound) > 0:
+            keep[np.array (answer_index)[np.array (bound, dtype=bool)]] = False
+        answers = [ a for a, ok in zip(answers, keep) if ok ]
+        logger.debug (f"attribute filters kept {len(answers)} of {len(keep)} answers")
+        node_ids = set ([ id for a in answers for v in a.get ('node_bindings', {}).values () for id in self.ids (v) ])
+        return {
+            **result,
+            "knowledge_graph" : {
+                **graph,
+                "nodes" : [ n for n in graph.get ('nodes', []) if n['id'] in node_ids ],
+                "edges" : [ e for e, ok in zip(graph.get ('edges', []), masks['edges'])
+                            if ok and e.get ('source_id', None) in node_ids and e.get ('target_id', None) in node_ids ]
+            },
+            "knowledge_map" : answers
+        }
@@ -9,12 +9,14 @@ import os
 import yaml
 import jsonschema
 import requests
-from flask import Flask, request, Response, jsonify
+from flask import Flask, request, Response, jsonify, has_request_context
 from flask_restful import Api, Resource, abort
 from flasgger import Swagger
 from flasgger.utils import validate as Validate
 from flask_cors import CORS
 from tranql.main import TranQL
+from tranql.request_util import Deadline
+from tranql.message_parser import Projection
 import networkx as nx
 from tranql.util import JSONKit
 from tranql.concept import BiolinkModelWalker
@@ -110,6 +112,10 @@ class StandardAPIResource(Resource):
                 code="invalid_arguments"
             )
 
+    @staticmethod
+    def get_timeout ():
+        """ Seconds left on the caller's deadline, if it sent one. Bounds our calls to upstream services. """
+        return Deadline.from_headers (request.headers).remaining ()
     def get_opt (self, request, opt):
         return request.get('option', {}).get (opt)
     def rename_key (self, obj, old, new, default=None):
@@ -205,6 +211,11 @@ class StandardAPIResource(Resource):
 
         if is_error:
             status_code = 500
+        else:
+            """ Drop the attributes the caller's projection would drop anyway before sending them. """
+            projection = Projection.from_headers (request.headers) if has_request_context () else None
+            if projection is not None and isinstance(data, dict):
+                data = projection.apply (data)
 
         return (data, status_code)
 class ICEESSchema(StandardAPIResource):
@@ -240,7 +251,8 @@ class ICEESSchema(StandardAPIResource):
         """
         response = requests.get (
             self.schema_url,
-            verify=False)
+            verify=False,
+            timeout=self.get_timeout ())
         if not response.ok:
             return self.response({
                 "status" : "error",
@@ -340,7 +352,8 @@ class ICEESClusterQuery(StandardAPIResource):
         app.logger.debug (f"--request.json({icees_kg_url})--> {json.dumps(request.json, indent=2)}")
         response = requests.post (icees_kg_url,
                                   json=request.json,
-                                  verify=False)
+                                  verify=False,
+                                  timeout=self.get_timeout ())
 
         with open ('icees.out', 'w') as stream:
             json.dump (response.json (), stream, indent=2)
@@ -549,7 +562,7 @@ class RtxQuery(StandardAPIResource):
 
         data = self.format_as_query(self.convert_curies_to_rtx(request.json))
         # print(json.dumps(data,indent=2))
-        response = requests.post(self.query_url, json=data)
+        response = requests.post(self.query_url, json=data, timeout=self.get_timeout ())
         if not response.ok:
             if response.status_code == 500:
                 result = {
@@ -621,7 +634,7 @@ class IndigoQuery(StandardAPIResource):
         data = self.format_as_query(request.json)
 
         # print("input",json.dumps(data,indent=2))
-        response = requests.post(self.query_url, json=data)
+        response = requests.post(self.query_url, json=data, timeout=self.get_timeout ())
         if not response.ok:
             if response.status_code == 500:
                 result = {
@@ -652,8 +665,17 @@ class GammaResource(StandardAPIResource):
         super().__init__()
         self.robokop_url = 'https://robokop.renci.org' # TODO - make a configuration setting.
         self.view_post_url = f'{self.robokop_url}/api/simple/view/'
-        self.quick_url = f'{self.robokop_url}/api/simple/quick/?rebuild=false&output_format=MESSAGE&max_connectivity=0&max_results=300'
+        """ The most answers to ask Gamma for. Queries may ask for fewer with the max_results option. """
+        self.max_results = 300
+        self.quick_url = f'{self.robokop_url}/api/simple/quick/?rebuild=false&output_format=MESSAGE&max_connectivity=0&max_results={self.max_results}'
         #                                                      ?rebuild=false&output_format=MESSAGE&max_connectivity=0&max_results=250
+    def get_quick_url (self, options):
+        """ The quick url, asking for no more answers than the max_results option, given as [ operator, value ]. """
+        max_results = options.get ('max_results', None)
+        if max_results is None:
+            return self.quick_url
+        max_results = min(int(max_results[-1]), self.max_results)
+        return f'{self.robokop_url}/api/simple/quick/?rebuild=false&output_format=MESSAGE&max_connectivity=0&max_results={max_results}'
     def view_url (self, uid):
         return f'{self.robokop_url}/simple/view/{uid}'
 
@@ -710,10 +732,10 @@ class GammaQuery(GammaResource):
         result = {}
         del request.json['knowledge_graph']
         del request.json['knowledge_maps']
-        del request.json['options']
-        app.logger.debug (f"Making request to {self.quick_url}")
+        quick_url = self.get_quick_url (request.json.pop ('options') or {})
+        app.logger.debug (f"Making request to {quick_url}")
         app.logger.debug (json.dumps(request.json, indent=2))
-        response = requests.post (self.quick_url, json=request.json)
+        response = requests.post (quick_url, json=request.json, timeout=self.get_timeout ())
         # print (f"{json.dumps(response.json (), indent=2)}")
         if response.status_code >= 300:
             result = {
@@ -773,7 +795,8 @@ class PublishToGamma(GammaResource):
         #print (f"{json.dumps(request.json, indent=2)}")
         view_post_response = requests.post(
             self.view_post_url,
-            json=request.json)
+            json=request.json,
+            timeout=self.get_timeout ())
         if view_post_response.status_code >= 300:
             print(f"{view_post_response}")
             raise Exception("Bad response view post")
@@ -782,9 +805,9 @@ class PublishToGamma(GammaResource):
         print(f"view-url: {self.view_url(uid)}")
 
 class GNBRReasoner:
-    def query (self, message):
+    def query (self, message, timeout=None):
         url=f'https://gnbr-reason.ncats.io/decorator'
-        response = requests.post(url,json=message)
+        response = requests.post(url,json=message,timeout=timeout)
         print( f"Return Status: {response.status_code}" )
         result = {}
         if response.status_code == 200:
@@ -863,7 +886,7 @@ class GNBRDecorator(StandardAPIResource):
                     'edges': edge_list
                 }
             }
-        })
+        }, timeout=self.get_timeout ())
 
 class BiolinkModelWalkerService(StandardAPIResource):
     """ Biolink Model Walk Resource. """
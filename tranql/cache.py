@@ -0,0 +1,248 @@
+import collections
+import concurrent.futures
+import json
+import logging
+import pickle
+import threading
+import time
+
+logger = logging.getLogger (__name__)
+
+class TTLCache:
+    """
+    A thread safe map whose entries expire ttl seconds after they are written.
+    At most max_entries are kept. The least recently used entry is evicted first.
+    """
+
+    def __init__(self, ttl=600, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict ()
+        self.lock = threading.RLock ()
+
+    def get (self, key, default=None):
+        with self.lock:
+            entry = self.entries.get (key, None)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and time.time () >= expires:
+                del self.entries[key]
+                return default
+            self.entries.move_to_end (key)
+            return value
+
+    def put (self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        with self.lock:
+            self.entries[key] = (value, time.time () + ttl if ttl is not None else None)
+            self.entries.move_to_end (key)
+            self.evict ()
+
+    def __contains__(self, key):
+        return self.get (key, None) is not None
+
+    def remove (self, key):
+        with self.lock:
+            self.entries.pop (key, None)
+
+    def evict (self):
+        """ Drop expired entries, then the least recently used beyond capacity. """
+        with self.lock:
+            now = time.time ()
+            for key in [ k for k, (v, expires) in self.entries.items () if expires is not None and now >= expires ]:
+                del self.entries[key]
+            while len(self.entries) > self.max_entries:
+                key, _ = self.entries.popitem (last=False)
+                logger.debug (f"evicting {key}")
+
+    def clear (self):
+        with self.lock:
+            self.entries.clear ()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+class ProgramCache:
+    """
+    The results of whole programs, by fingerprint.
+    Concurrent executions of the same program are coalesced: one executes while the others wait for its result.
+    Results are kept pickled, so each caller gets its own copy to modify.
+    """
+
+    def __init__(self, ttl=300, max_entries=256):
+        self.results = TTLCache (ttl=ttl, max_entries=max_entries)
+        self.in_flight = {}
+        self.lock = threading.Lock ()
+
+    def execute (self, key, fn, ttl=None, timeout=None):
+        """
+        Get the result of the program identified by key, calling fn() to execute it if need be.
+        fn returns the result and whether it may be cached. Returns the result and whether fn was called here.
+        Waiting on another caller's execution of the program gives up after timeout seconds.
+        """
+        payload = self.results.get (key)
+        if payload is not None:
+            return pickle.loads (payload), False
+        with self.lock:
+            payload = self.results.get (key)
+            if payload is not None:
+                return pickle.loads (payload), False
+            flight = self.in_flight.get (key, None)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = concurrent.futures.Future ()
+        if not leader:
+            logger.debug (f"waiting on execution of program {key}")
+            payload = flight.result (timeout=timeout)
+            if payload is not None:
+                return pickle.loads (payload), False
+            """ The result could not be shared. Execute the program ourselves. """
+            return fn ()[0], True
+        try:
+            value, cacheable = fn ()
+            payload = None
+            if cacheable:
+                try:
+                    payload = pickle.dumps (value)
+                    self.results.put (key, payload, ttl=ttl)
+                except (pickle.PicklingError, TypeError, AttributeError) as e:
+                    logger.debug (f"unable to cache program {key}: {e}")
+                    payload = None
+            flight.set_result (payload)
+            return value, True
+        except BaseException as e:
+            flight.set_exception (e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def clear (self):
+        self.results.clear ()
+
+""" Program results are shared by all interpreters in the process. """
+program_cache = ProgramCache ()
+
+""" The variables statements set, pickled, by statement fingerprint. Shared like program results. """
+statement_memo = TTLCache (ttl=600, max_entries=256)
+
+class SubgraphCache:
+    """
+    The knowledge graphs and answers reasoners returned for one hop questions - questions from a node
+    with a curie to nodes of a type - by reasoner, curie, direction, type, predicate, and options.
+
+    Questions sharing a hop with an earlier question are answered locally, regardless of the query they come from.
+    A question for a narrower type than a cached hop is answered from the cached hop's nodes of the narrower type.
+    """
+
+    def __init__(self, ttl=600, max_entries=10000):
+        self.hops = TTLCache (ttl=ttl, max_entries=max_entries)
+
+    @staticmethod
+    def hop (question):
+        """ Describe a one hop question by its bound node, unbound node, and edge. None if it is not a one hop question. """
+        graph = question.get ('question_graph', {})
+        nodes = graph.get ('nodes', [])
+        edges = graph.get ('edges', [])
+        if len(nodes) != 2 or len(edges) != 1:
+            return None
+        bound = [ n for n in nodes if n.get ('curie', None) ]
+        unbound = [ n for n in nodes if not n.get ('curie', None) ]
+        if len(bound) != 1 or len(unbound) != 1 or isinstance(bound[0]['curie'], list):
+            return None
+        return bound[0], unbound[0], edges[0]
+
+    @staticmethod
+    def key (service, question, bound, unbound, edge, type_name):
+        return json.dumps ([
+            service,
+            bound['curie'],
+            "source" if edge.get ('source_id', None) == bound['id'] else "target",
+            type_name,
+            edge.get ('type', None),
+            question.get ('options', {})
+        ], sort_keys=True, default=str)
+
+    @staticmethod
+    def rename (answers, names):
+        """ Rename the question node and edge ids answers are bound to. """
+        return [
+            {
+                **answer,
+                "node_bindings" : { names.get (k, k) : v for k, v in answer.get ('node_bindings', {}).items () },
+                "edge_bindings" : { names.get (k, k) : v for k, v in answer.get ('edge_bindings', {}).items () }
+            }
+            for answer in answers
+        ]
+
+    def store (self, service, question, response, ttl=None):
+        """ Remember a reasoner's response to a one hop question. """
+        hop = self.hop (question)
+        if hop is None or 'knowledge_graph' not in response:
+            return
+        bound, unbound, edge = hop
+        """ Bind answers to the roles of the question's elements rather than their names, which vary by query. """
+        answers = self.rename (response.get ('knowledge_map', []), {
+            bound['id'] : "bound", unbound['id'] : "unbound", edge['id'] : "edge"
+        })
+        self.hops.put (
+            self.key (service, question, bound, unbound, edge, unbound['type']),
+            pickle.dumps ({ "knowledge_graph" : response['knowledge_graph'], "knowledge_map" : answers }),
+            ttl=ttl)
+
+    def lookup (self, service, question, broader_types=lambda type_name: []):
+        """
+        Answer a one hop question from cached hops for its type or, failing that, a broader type.
+        broader_types(type_name) gives the types to try, nearest first.
+        Returns a response to the question, or None if no cached hop covers it.
+        """
+        hop = self.hop (question)
+        if hop is None:
+            return None
+        bound, unbound, edge = hop
+        for type_name in [ unbound['type'], *broader_types (unbound['type']) ]:
+            payload = self.hops.get (self.key (service, question, bound, unbound, edge, type_name))
+            if payload is not None:
+                break
+        else:
+            return None
+        response = pickle.loads (payload)
+        names = { "bound" : bound['id'], "unbound" : unbound['id'], "edge" : edge['id'] }
+        if type_name != unbound['type']:
+            response = self.narrow (response, unbound['type'])
+        response['knowledge_map'] = self.rename (response['knowledge_map'], names)
+        return response
+
+    @staticmethod
+    def narrow (response, type_name):
+        """ Keep only the answers whose unbound node is of the given type, and the nodes and edges they refer to. """
+        def types (node):
+            return node.get ('type', []) if isinstance(node.get ('type', []), list) else [ node['type'] ]
+        def ids (value):
+            return value if isinstance(value, list) else [ value ]
+        graph = response['knowledge_graph']
+        nodes = { n['id'] : n for n in graph.get ('nodes', []) }
+        answers = [
+            answer for answer in response['knowledge_map']
+            if any ([ type_name in types (nodes.get (id, {})) for id in ids (answer['node_bindings'].get ('unbound', [])) ])
+        ]
+        node_ids = set ([ id for answer in answers for v in answer['node_bindings'].values () for id in ids (v) ])
+        return {
+            "knowledge_graph" : {
+                "nodes" : [ n for n in graph.get ('nodes', []) if n['id'] in node_ids ],
+                "edges" : [ e for e in graph.get ('edges', [])
+                            if e.get ('source_id', None) in node_ids and e.get ('target_id', None) in node_ids ]
+            },
+            "knowledge_map" : answers
+        }
+
+    def clear (self):
+        self.hops.clear ()
+
+""" Subgraphs are shared by all interpreters in the process. """
+subgraph_cache = SubgraphCache ()
+
+""" The identifiers names resolve to, by lookup. Shared like subgraphs. """
+name_cache = TTLCache (ttl=86400, max_entries=100000)
@@ -20,6 +20,10 @@ class ServiceInvocationError(TranQLException):
     def __init__(self, message, details=""):
         super().__init__(message, details)
 
+class ServiceUnavailableError(ServiceInvocationError):
+    def __init__(self, message, details=""):
+        super().__init__(message, details)
+
 class RequestTimeoutError(TranQLException):
     def __init__(self, message, details=""):
         super().__init__(message, details)
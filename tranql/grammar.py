@@ -10,9 +10,9 @@ Statements can be 'set' or 'select' statements.
 
 """
 statement = Forward()
-SELECT, FROM, WHERE, SET, AS, CREATE, GRAPH, AT = map(
+SELECT, FROM, WHERE, LIMIT, SET, AS, CREATE, GRAPH, AT = map(
     CaselessKeyword,
-    "select from where set as create graph at".split())
+    "select from where limit set as create graph at".split())
 
 concept_name    = Word( alphas, alphanums + ":_")
 ident          = Word( "$" + alphas, alphanums + "_$" ).setName("identifier")
@@ -70,6 +70,7 @@ statement <<= (
         Group(SELECT + question_graph_expression)("concepts") + optWhite +
         Group(FROM + tableNameList) + optWhite +
         Group(Optional(WHERE + whereExpression("where"), "")) + optWhite +
+        Optional(Group(LIMIT + ( intNum | ident ))) + optWhite +
         Group(Optional(SET + setExpression("set"), ""))("select")
     )
     |
@@ -117,6 +118,7 @@ statement <<= (
         Group(SELECT + incomplete_question_graph_expression)("concepts") + Suppress(optWhite) +
         Optional(Group(FROM + (openTable | Empty()))) + Suppress(optWhite) +
         Optional(Group(WHERE + whereExpression("where"))) + Suppress(optWhite) +
+        Optional(Group(LIMIT + ( intNum | ident ))) + Suppress(optWhite) +
         Optional(Group(SET + setExpression("set")))("select")
     )
     |
@@ -0,0 +1,151 @@
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger (__name__)
+
+class Job:
+    """ A handle to work running in the background.
+    The handle can be stored in the interpreter's context and polled for status. """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    ERROR = "error"
+    CANCELLED = "cancelled"
+
+    def __init__(self, name, future, key=None):
+        self.id = str(uuid.uuid4 ())
+        self.name = name
+        self.future = future
+        self.key = key
+        self.submitted = time.time ()
+        """ Optional hooks reporting the progress of the running work and asking it to stop. """
+        self.progress = None
+        self.canceller = None
+        self.cancel_requested = False
+
+    @property
+    def status (self):
+        """ Get the job's status. """
+        if self.future.cancelled () or (self.cancel_requested and self.future.done ()):
+            return self.CANCELLED
+        if self.future.running ():
+            return self.RUNNING
+        if not self.future.done ():
+            return self.PENDING
+        return self.ERROR if self.future.exception () is not None else self.DONE
+
+    def done (self):
+        return self.future.done ()
+
+    def cancel (self):
+        """ Cancel the job. A job that has not started is dropped. A running job is asked to stop, if it can be. """
+        if self.future.cancel ():
+            return True
+        if self.canceller is not None and not self.future.done ():
+            self.cancel_requested = True
+            self.canceller ()
+            return True
+        return False
+
+    def result (self, timeout=None):
+        """ Wait for the job to finish and return its result, raising its error if it failed. """
+        return self.future.result (timeout=timeout)
+
+    def to_dict (self, include_result=True):
+        """ Describe the job in a JSON friendly way. """
+        status = self.status
+        result = {
+            "id" : self.id,
+            "name" : self.name,
+            "status" : status,
+            "elapsed" : round(time.time () - self.submitted, 3)
+        }
+        if self.progress is not None:
+            result["progress"] = self.progress ()
+        if status == self.DONE and include_result:
+            result["result"] = self.future.result ()
+        elif status == self.ERROR:
+            result["error"] = str(self.future.exception ())
+        return result
+
+    @staticmethod
+    def serialize (obj):
+        """ Use as the `default` argument to json.dumps to serialize contexts holding jobs. """
+        if isinstance(obj, Job):
+            return obj.to_dict ()
+        raise TypeError (f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    def __repr__(self):
+        return f"Job(name={self.name},status={self.status})"
+
+class JobPool:
+    """ A bounded pool of threads running jobs. """
+
+    def __init__(self, max_workers=4, name="tranql-job"):
+        self.name = name
+        self.executor = concurrent.futures.ThreadPoolExecutor (
+            max_workers=max_workers,
+            thread_name_prefix=name)
+
+    def submit (self, name, fn, *args, **kwargs):
+        """ Run fn(*args, **kwargs) in the background, returning a handle to the job. """
+        logger.debug (f"submitting job {name} to pool {self.name}")
+        future = self.executor.submit (fn, *args, **kwargs)
+        return Job (name=name, future=future)
+
+    def shutdown (self, wait=True):
+        self.executor.shutdown (wait=wait)
+
+class JobRegistry:
+    """
+    Jobs submitted to a pool, by id, so they can be polled across requests.
+    Submissions with the same key as an unfinished job are coalesced onto it.
+    Only the most recent finished jobs are retained.
+    """
+
+    def __init__(self, pool, capacity=1000):
+        self.pool = pool
+        self.capacity = capacity
+        self.jobs = collections.OrderedDict ()
+        self.active = {}
+        """ Reentrant, since a job that is already done runs its done callback immediately. """
+        self.lock = threading.RLock ()
+
+    def submit (self, key, name, fn, *args, **kwargs):
+        """ Run fn(*args, **kwargs) in the background unless an identical job is already under way.
+        Returns the job and whether it was coalesced onto an existing one. """
+        with self.lock:
+            job = self.active.get (key, None)
+            if job is not None and not job.done ():
+                logger.debug (f"coalescing {name} onto job {job.id}")
+                return job, True
+            job = self.pool.submit (name, fn, *args, **kwargs)
+            job.key = key
+            self.active[key] = job
+            self.jobs[job.id] = job
+            job.future.add_done_callback (lambda future: self.finished (job))
+            self.evict ()
+            return job, False
+
+    def finished (self, job):
+        with self.lock:
+            if self.active.get (job.key, None) is job:
+                del self.active[job.key]
+
+    def evict (self):
+        """ Forget the oldest finished jobs beyond capacity. """
+        finished = [ id for id, job in self.jobs.items () if job.done () ]
+        for id in finished[:max(0, len(self.jobs) - self.capacity)]:
+            del self.jobs[id]
+
+    def get (self, id):
+        return self.jobs.get (id, None)
+
+    def list (self):
+        with self.lock:
+            return list(self.jobs.values ())
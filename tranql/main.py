@@ -31,19 +31,34 @@
 #    available data sets.
 
 import argparse
+import concurrent.futures
+import hashlib
 import json
 import logging
 import os
+import pickle
 import requests_cache
 import sys
+import threading
 import traceback
+import time
 from tranql.config import Config
 from tranql.util import Context
 from tranql.util import JSONKit
 from tranql.util import Concept
 from tranql.util import LoggingUtil
+from tranql.jobs import Job
+from tranql.request_util import Deadline
+from tranql.request_util import RetryBudget
+from tranql.cache import program_cache
+from tranql.cache import statement_memo
+from tranql.message_parser import Projection
+from tranql.name_resolver import NameResolver
+from tranql.tranql_schema import Schema
+from tranql.exception import RequestTimeoutError
 from tranql.tranql_ast import TranQL_AST
 from tranql.grammar import program_grammar, incomplete_program_grammar
+from pyparsing import ParseException
 
 LoggingUtil.setup_logging ()
 logger = logging.getLogger (__name__)
@@ -61,6 +76,28 @@ class Parser:
         result = self.tokenize (line)
         return TranQL_AST (result.asList (), self.backplane)
 
+    def normalize (self, line):
+        """ Get a program's parse tree without whitespace and with a single quoting style.
+        Keywords are already normalized to lower case by the grammar, and comments dropped. """
+        return self.normalize_tokens (self.tokenize (line).asList ())
+
+    @staticmethod
+    def normalize_tokens (tokens):
+        """ Drop whitespace from part of a parse tree and unify its quoting style. """
+        result = []
+        for token in tokens:
+            if isinstance(token, list):
+                result.append (Parser.normalize_tokens (token))
+            elif isinstance(token, str):
+                if token.isspace ():
+                    continue
+                if len(token) > 1 and token[0] == token[-1] and token[0] in "'\"":
+                    token = f'"{token[1:-1]}"'
+                result.append (token)
+            else:
+                result.append (token)
+        return result
+
 class TranQLParser(Parser):
     """ Defines the language's grammar. """
     def __init__(self, backplane):
@@ -103,6 +140,59 @@ class TranQL:
         self.name_based_merging = options.get("name_based_merging", self.config.get('NAME_BASED_MERGING', True))
         self.resolve_names = options.get("resolve_names", self.config.get('RESOLVE_NAMES', False))
         self.dynamic_id_resolution = options.get("dynamic_id_resolution", self.config.get('DYNAMIC_ID_RESOLUTION', False))
+        self.partial_results = options.get("partial_results", self.config.get('PARTIAL_RESULTS', False))
+
+        """ Every query gets a deadline. Requested timeouts are capped so no query can occupy a worker indefinitely. """
+        max_timeout = float(self.config.get('MAX_QUERY_TIMEOUT', 300))
+        timeout = options.get("timeout", None)
+        self.timeout = min(float(timeout), max_timeout) if timeout is not None else max_timeout
+        self.deadline = Deadline (self.timeout)
+
+        """ Retries and hedged requests share a per query budget so a struggling service isn't flooded. """
+        self.retry_budget_size = int(options.get("retry_budget", self.config.get('RETRY_BUDGET', 10)))
+        self.retry_budget = RetryBudget (self.retry_budget_size)
+        self.progress = self.empty_progress ()
+        self.listeners = []
+
+        """
+        Responses to the questions asked while executing a program, pickled, so no question is asked twice.
+        Responses are only kept while a statement or plan segment still to execute could ask for them.
+        """
+        self.shared_responses = {}
+        self.pending_statements = []
+
+        """ Guards progress, errors, completeness and shared responses, which source threads update concurrently. """
+        self.lock = threading.RLock ()
+
+        """ Reuse the results of identical programs executed recently. """
+        self.program_cache = str(options.get("program_cache", self.config.get('PROGRAM_CACHE', False))).lower () == 'true'
+        self.program_cache_ttl = float(self.config.get('PROGRAM_CACHE_TTL', 300))
+
+        """ Answer one hop questions from subgraphs fetched for earlier questions sharing the hop. """
+        self.subgraph_cache = str(options.get("subgraph_cache", self.config.get('SUBGRAPH_CACHE', False))).lower () == 'true'
+        self.subgraph_cache_ttl = float(self.config.get('SUBGRAPH_CACHE_TTL', 600))
+
+        """ Reuse the results of statements that, like the variables they read, are unchanged since they last ran. """
+        self.statement_memo = str(options.get("statement_memo", self.config.get('STATEMENT_MEMO', False))).lower () == 'true'
+        self.statement_memo_ttl = float(self.config.get('STATEMENT_MEMO_TTL', 600))
+
+        """
+        Experimental. Build merged nodes and edges across this many spawned processes when merging a statement's
+        responses. Off by default: only the final folding of each group is divided among the processes, and sending
+        the groups to them and back has so far cost about what folding them does, so no speedup has been shown. Set
+        it only where bin/benchmark-merge shows one on the host.
+        """
+        self.merge_processes = int(options.get("merge_processes", self.config.get('MERGE_PROCESSES', 0)))
+
+        """ Keep only these node and edge attributes of reasoner responses, dropping the rest as responses are read. None keeps all. """
+        projection = options.get("projection", None)
+        self.projection = Projection.from_config (projection if projection is not None else self.config.get('RESPONSE_PROJECTION', None))
+
+        """ Resolve names to identifiers concurrently, caching what each resolves to, or that it resolves to nothing. """
+        self.name_resolver = NameResolver (
+            ttl=float(self.config.get('NAME_CACHE_TTL', 86400)),
+            negative_ttl=float(self.config.get('NAME_CACHE_NEGATIVE_TTL', 600)),
+            max_requests=int(self.config.get('NAME_RESOLUTION_REQUESTS', 8)))
 
     def parse (self, program):
         """ If we just want the AST. """
@@ -115,6 +205,86 @@ class TranQL:
         return result
 
     def execute (self, program, cache=False):
+        """ Execute a program - a list of statements.
+        If the program cache is enabled, the results of an identical program executed recently are reused,
+        and concurrent executions of identical programs share one execution. """
+        key = self.fingerprint (program) if self.program_cache else None
+        if key is None:
+            return self.execute_program (program, cache)
+        try:
+            writes, executed = program_cache.execute (
+                key,
+                lambda: self.execute_cacheable (program, cache),
+                ttl=self.program_cache_ttl,
+                timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            raise RequestTimeoutError (
+                "Query deadline passed waiting for an identical query to finish.",
+                details=f"The query exceeded its {self.timeout}s timeout.")
+        if not executed:
+            logger.debug (f"reusing the results of program {key}")
+            for name, value in writes.items ():
+                self.context.set (name, value)
+        return self.context
+
+    def execute_cacheable (self, program, cache=False):
+        """ Execute a program, returning the variables it set and whether its results may be reused. """
+        self.context.track_writes ()
+        try:
+            self.execute_program (program, cache)
+        finally:
+            writes = self.context.stop_tracking_writes ()
+        complete = self.context.mem.get ('completeness', {}).get ('complete', True)
+        return writes, complete and len(self.context.mem.get ('requestErrors', [])) == 0
+
+    """ Variables statements read without the program naming them. """
+    implicit_variables = [ 'id_filters' ]
+
+    def fingerprint (self, program):
+        """
+        Identify a program's results by its normalized parse tree, the values of the variables it reads,
+        the schema snapshot, and the options affecting results.
+        Returns None for programs whose results should not be reused, like those publishing graphs.
+        """
+        if not isinstance(program, str):
+            return None
+        try:
+            tree = self.parser.normalize (program)
+        except ParseException:
+            """ Let execution report the error. """
+            return None
+        if any ([ isinstance(e, list) and len(e) > 0 and isinstance(e[0], list) and e[0][:1] == ['create']
+                  for e in tree ]):
+            return None
+        return self.digest ("program", tree)
+
+    @staticmethod
+    def read_variables (tokens):
+        """ The names of the variables part of a parse tree reads. """
+        for token in tokens:
+            if isinstance(token, list):
+                yield from TranQL.read_variables (token)
+            elif isinstance(token, str) and token.startswith ("$"):
+                yield token[1:]
+
+    def digest (self, kind, tree):
+        """ Hash a normalized parse tree with the values of the variables it reads, the schema snapshot,
+        and the options affecting results. """
+        names = sorted(set([ *self.read_variables (tree), *self.implicit_variables ]))
+        return hashlib.sha256 (json.dumps ({
+            kind : tree,
+            "variables" : { name : self.context.mem.get (name, None) for name in names },
+            "schema" : Schema.snapshot_version,
+            "options" : [
+                self.context.mem.get ('backplane', None),
+                self.dynamic_id_resolution,
+                self.name_based_merging,
+                self.resolve_names,
+                self.projection.to_json () if self.projection is not None else None
+            ]
+        }, sort_keys=True, default=str).encode ('utf-8')).hexdigest ()
+
+    def execute_program (self, program, cache=False):
         """ Execute a program - a list of statements. """
         ast = None
         if cache:
@@ -127,11 +297,138 @@ class TranQL:
             ast = self.parse (program)
         if not ast:
             raise ValueError (f"Unhandled type: {type(program)}")
-        for statement in ast.statements:
+        """ The deadline starts when execution does. """
+        self.deadline = Deadline (self.timeout)
+        self.retry_budget = RetryBudget (self.retry_budget_size)
+        self.context.set ('completeness', self.empty_completeness ())
+        self.progress = self.empty_progress ()
+        self.shared_responses = {}
+        self.track ('statements', started=len(ast.statements))
+        for index, statement in enumerate(ast.statements):
             logger.debug (f"execute: {statement} type={type(statement).__name__}")
-            statement.execute (interpreter=self)
+            if self.partial_results and self.deadline.expired ():
+                """ Keep what we have. Record what we did not get to. """
+                for skipped in ast.statements[index:]:
+                    self.record_missing ("skipped_statements", str(skipped))
+                self.context.mem.setdefault ('requestErrors', []).append (RequestTimeoutError (
+                    "Query deadline passed. Returning partial results.",
+                    details=f"{len(ast.statements) - index} statement(s) were not executed."))
+                break
+            self.deadline.check (f"Query deadline passed before executing: {statement}")
+            self.emit ('statement', index=index, statement=str(statement), status="started")
+            start = time.time ()
+            self.pending_statements = ast.statements[index+1:]
+            memoized = self.execute_statement (statement)
+            self.track ('statements', done=1)
+            self.emit ('statement', index=index, status="done", elapsed=round(time.time () - start, 3),
+                       memoized=memoized)
+        self.pending_statements = []
         return self.context
 
+    def statement_fingerprint (self, statement):
+        """ Identify a statement's results by its normalized parse tree and the values of the variables it reads.
+        Returns None for statements whose results should not be reused. """
+        if not statement.memoizable or statement.tokens is None:
+            return None
+        return self.digest ("statement", self.parser.normalize_tokens (statement.tokens))
+
+    def missing_count (self):
+        completeness = self.context.mem.get ('completeness', {})
+        return sum ([ len(v) for k, v in completeness.items () if isinstance(v, list) ])
+
+    def execute_statement (self, statement):
+        """
+        Execute a statement. If statement memoization is enabled and the statement ran before, reading the
+        same values, the variables it set then are set again instead. Returns whether the statement was memoized.
+        Only statements that got complete results without errors are remembered.
+        """
+        key = self.statement_fingerprint (statement) if self.statement_memo else None
+        if key is None:
+            statement.execute (interpreter=self)
+            return False
+        payload = statement_memo.get (key)
+        if payload is not None:
+            logger.debug (f"reusing the results of unchanged statement: {statement}")
+            for name, value in pickle.loads (payload).items ():
+                self.context.set (name, value)
+            return True
+        missing = self.missing_count ()
+        self.context.track_writes ()
+        try:
+            statement.execute (interpreter=self)
+        finally:
+            writes = self.context.stop_tracking_writes ()
+        if missing == self.missing_count () and len(self.context.mem.get ('requestErrors', [])) == 0:
+            try:
+                statement_memo.put (key, pickle.dumps (writes), ttl=self.statement_memo_ttl)
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                logger.debug (f"unable to memoize statement {statement}: {e}")
+        return False
+
+    @staticmethod
+    def empty_completeness ():
+        return {
+            "complete" : True,
+            "missing_questions" : [],
+            "missing_segments" : [],
+            "skipped_statements" : []
+        }
+
+    def record_missing (self, kind, item):
+        """ Note that part of the query - a question, plan segment, or statement - is missing from the results.
+        Kind is one of missing_questions, missing_segments, or skipped_statements. """
+        with self.lock:
+            completeness = self.context.mem.setdefault ('completeness', self.empty_completeness ())
+            completeness['complete'] = False
+            completeness[kind].append (item)
+
+    def record_errors (self, errors):
+        """ Note errors to report with the results. """
+        with self.lock:
+            self.context.mem.setdefault ('requestErrors', []).extend (errors)
+
+    def share_response (self, key, payload):
+        """ Keep a pickled response for later statements or plan segments asking the same question. """
+        with self.lock:
+            self.shared_responses[key] = payload
+
+    @staticmethod
+    def empty_progress ():
+        return {
+            "statements" : { "done" : 0, "total" : 0 },
+            "segments" : { "done" : 0, "total" : 0 },
+            "questions" : { "done" : 0, "total" : 0 }
+        }
+
+    def track (self, kind, started=0, done=0):
+        """ Track progress executing statements, plan segments, or questions. """
+        with self.lock:
+            self.progress[kind]['total'] += started
+            self.progress[kind]['done'] += done
+
+    def get_progress (self):
+        """ A snapshot of the executing query's progress. """
+        with self.lock:
+            progress = { kind : dict(counts) for kind, counts in self.progress.items () }
+        progress['questions']['in_flight'] = progress['questions']['total'] - progress['questions']['done']
+        return progress
+
+    def add_listener (self, listener):
+        """ Call listener(event, data) for each event - statement started or done, segment done,
+        reasoner response, result merged - as the query executes. """
+        self.listeners.append (listener)
+
+    def emit (self, event, **data):
+        for listener in self.listeners:
+            try:
+                listener (event, data)
+            except Exception as e:
+                logger.error (f"error in listener for event {event}: {e}")
+
+    def cancel (self):
+        """ Cooperatively cancel the executing query. Outstanding reasoner requests are abandoned. """
+        self.deadline.cancel ()
+
     def execute_file (self, program):
         """ Execute a file on disk, soup to nuts. """
         with open (program, "r") as stream:
@@ -183,7 +480,7 @@ class TranQL:
                                     print (f"{val}")
                             else:
                                 response = self.execute (block)
-                                print (f"{json.dumps(response.mem, indent=2)}")
+                                print (f"{json.dumps(response.mem, indent=2, default=Job.serialize)}")
                     print (f"$ ", end='')
                 else:
                     buf.append (line)
@@ -224,6 +521,10 @@ def main ():
     arg_parser.add_argument('-x', '--asynchronous', default=True, help="Run requests asynchronously resulting in faster queries")
     arg_parser.add_argument('-n', '--name_based_merging', default=True, help="Merge nodes that have the same name properties as one another")
     arg_parser.add_argument('-r', '--resolve_names', default=False, help="(Experimental) Resolve equivalent identifiers of nodes in responses via the Bionames API. Can result in a more thoroughly merged graph.")
+    arg_parser.add_argument('-p', '--partial_results', default=False, help="When the timeout passes, return whatever results have been merged instead of failing.")
+    arg_parser.add_argument('-m', '--statement_memo', default=False, action='store_true', help="Reuse the results of statements unchanged since they last ran, along with the variables they read.")
+    arg_parser.add_argument('-j', '--projection', default=None, help="Comma separated node and edge attributes to keep, like node.description,edge.publications. Others are dropped as responses are read.")
+    arg_parser.add_argument('-t', '--timeout', default=None, type=float, help="Seconds the query may run before outstanding requests are abandoned.")
     args = arg_parser.parse_args ()
 
     global logger
@@ -239,7 +540,7 @@ def main ():
                                      allowable_methods=('GET', 'POST', ))
 
     """ Create an interpreter. """
-    options = {x: vars(args)[x] for x in vars(args) if x in ["asynchronous","name_based_merging","resolve_names","dynamic_id_resolution"]}
+    options = {x: vars(args)[x] for x in vars(args) if x in ["asynchronous","name_based_merging","resolve_names","dynamic_id_resolution","timeout","partial_results","statement_memo","projection"]}
     tranql = TranQL (backplane = args.backplane, options = options)
     for k, v in query_args.items ():
         logger.debug (f"setting {k}={v}")
@@ -252,7 +553,7 @@ def main ():
         """ Run a program. """
         context = tranql.execute_file (args.source)
         if args.output == 'stdout':
-            print (f"{json.dumps(context.mem, indent=2)}")
+            print (f"{json.dumps(context.mem, indent=2, default=Job.serialize)}")
             print (f"top-gene: {json.dumps(context.top('gene',k='chemical_pathways'), indent=2)}")
     else:
         print ("Either source or shell must be specified")
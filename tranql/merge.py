@@ -0,0 +1,386 @@
+import logging
+import multiprocessing
+import sys
+import threading
+from tranql.answer_table import AnswerTable, Vocabulary
+
+logger = logging.getLogger (__name__)
+
+def intern (value):
+    """ Intern a string, or the strings in a list, so that equal strings share one copy. """
+    if isinstance(value, str):
+        return sys.intern (value)
+    if isinstance(value, list):
+        return [ sys.intern (v) if isinstance(v, str) else v for v in value ]
+    return value
+
+class KElement:
+    """
+    A node or edge of a merged knowledge graph, kept compactly while responses are merged.
+    Strings are interned, so each distinct CURIE or type is stored once however often it recurs, lists are kept
+    as tuples, and the reasoners an element came from are bits of a mask rather than a list of names.
+    Elements are converted back to the JSON message shape by to_json.
+    """
+    __slots__ = ('id', 'type', 'reasoners', 'properties')
+
+    """ Properties kept in slots rather than among the element's other properties. """
+    fields = ('id', 'type', 'reasoner')
+
+    def __init__(self, element, reasoners):
+        """ reasoners is the mask of the element's reasoner provenance, or None if it has none. """
+        self.id = element.get ('id', None)
+        self.type = self.compact (IncrementalMerger.as_list (element.get ('type', [])))
+        self.reasoners = reasoners
+        self.properties = { k : self.compact (v) for k, v in element.items () if k not in self.fields }
+
+    @staticmethod
+    def compact (value):
+        """ Intern strings and turn lists into tuples of interned strings. """
+        if isinstance(value, list):
+            return tuple(intern (value))
+        return intern (value)
+
+    @staticmethod
+    def union (current, value):
+        try:
+            return tuple(dict.fromkeys (current + value))
+        except TypeError:
+            return current + value
+
+    def merge (self, element, reasoners):
+        """ Fold an element's properties into this one's. Lists are combined. Otherwise, values already here win. """
+        self.type = self.union (self.type, self.compact (IncrementalMerger.as_list (element.get ('type', []))))
+        if reasoners is not None:
+            self.reasoners = (self.reasoners or 0) | reasoners
+        for key, value in element.items ():
+            if key in self.fields:
+                continue
+            current = self.properties.get (key, None)
+            if key not in self.properties:
+                self.properties[key] = self.compact (value)
+            elif isinstance(current, tuple) and isinstance(value, list):
+                self.properties[key] = self.union (current, self.compact (value))
+
+    def to_json (self, reasoner_names):
+        element = {
+            "type" : list(self.type),
+            **{ k : list(v) if isinstance(v, tuple) else v for k, v in self.properties.items () }
+        }
+        if self.id is not None:
+            element['id'] = self.id
+        if self.reasoners is not None:
+            element['reasoner'] = [ name for bit, name in enumerate(reasoner_names) if self.reasoners >> bit & 1 ]
+        return element
+
+class KNode(KElement):
+    __slots__ = ('equivalent_identifiers',)
+
+    fields = ('id', 'type', 'reasoner', 'equivalent_identifiers')
+
+    def __init__(self, node, reasoners, equivalent_identifiers):
+        super().__init__(node, reasoners)
+        self.id = intern (self.id)
+        self.equivalent_identifiers = self.compact (equivalent_identifiers)
+
+    def merge (self, node, reasoners, equivalent_identifiers):
+        super().merge (node, reasoners)
+        self.equivalent_identifiers = self.union (self.equivalent_identifiers, self.compact (equivalent_identifiers))
+
+    def to_json (self, reasoner_names):
+        return {
+            **super().to_json (reasoner_names),
+            "equivalent_identifiers" : list(self.equivalent_identifiers)
+        }
+
+class KEdge(KElement):
+    __slots__ = ('source_id', 'target_id')
+
+    fields = ('id', 'type', 'reasoner', 'source_id', 'target_id')
+
+    def __init__(self, edge, reasoners, source_id, target_id):
+        super().__init__(edge, reasoners)
+        self.source_id = intern (source_id)
+        self.target_id = intern (target_id)
+
+    def to_json (self, reasoner_names):
+        edge = super().to_json (reasoner_names)
+        for end in ('source_id', 'target_id'):
+            if getattr (self, end) is not None:
+                edge[end] = getattr (self, end)
+        return edge
+
+class IncrementalMerger:
+    """
+    Merge responses one at a time, as they arrive, rather than all at once at the end of a query.
+
+    A node is folded into the first node seen that shares one of its equivalent identifiers or, if merging by
+    name, its name. Edges between the same nodes with the same types are folded into the first such edge. The
+    ids an answer binds are rewritten to those of the nodes and edges they were folded into as the answer's
+    response is added, so only the merged knowledge graph, as KNodes and KEdges, and the answers, as
+    AnswerTables, are kept, not the responses themselves.
+    """
+
+    def __init__(self, name_based_merging=True, resolve=None):
+        """
+        If given, resolve([ (name, type names) ]) gives the equivalent identifiers of nodes that lack them, by
+        name and tuple of type names. The nodes of each response are resolved together.
+        """
+        self.name_based_merging = name_based_merging
+        self.resolve = resolve
+        self.resolved = {}
+        self.nodes = []
+        self.edges = []
+        self.node_index = {}
+        """ The id of the merged node each node id and equivalent identifier belongs to, and each name's. """
+        self.canonical = {}
+        self.names = {}
+        self.edge_index = {}
+        """ The reasoners elements came from, in the order of their bits in reasoner masks. """
+        self.reasoner_names = []
+        self.reasoner_bits = {}
+        """ The question order and answers of each response added. Answers share a vocabulary, so they can be joined. """
+        self.vocabulary = Vocabulary ()
+        self.responses = []
+        self.marks = (0, 0, 0)
+        self.lock = threading.RLock ()
+
+    def __len__(self):
+        return len(self.responses)
+
+    @staticmethod
+    def as_list (value):
+        return value if isinstance(value, list) else [ value ]
+
+    def add (self, response):
+        """ Fold a response into the merged result. """
+        with self.lock:
+            graph = response.get ('knowledge_graph', {})
+            if self.resolve is not None:
+                self.resolve_nodes (graph.get ('nodes', []))
+            for node in graph.get ('nodes', []):
+                self.add_node (node)
+            edge_ids = {}
+            for edge in graph.get ('edges', []):
+                id = edge.get ('id', None)
+                edge_ids[id] = self.add_edge (edge)
+            answers = AnswerTable.from_answers (response.get ('knowledge_map', []), self.vocabulary)
+            answers.remap ("node_bindings", lambda id: self.canonical.get (id, id))
+            answers.remap ("edge_bindings", lambda id: edge_ids.get (id, id))
+            self.responses.append ((response.get ('question_order', None), answers))
+
+    def resolve_nodes (self, nodes):
+        """ Resolve the names of nodes lacking equivalent identifiers, unless resolved for an earlier response. """
+        names = dict.fromkeys ([ self.name_key (node) for node in nodes if 'equivalent_identifiers' not in node ])
+        names = [ name for name in names if name not in self.resolved ]
+        if len(names) > 0:
+            self.resolved.update (self.resolve (names))
+
+    def name_key (self, node):
+        return (node.get ('name', None), tuple(self.as_list (node.get ('type', []))))
+
+    def reasoner_mask (self, element):
+        """ Encode the reasoners an element came from as a mask, with a bit for each reasoner seen so far. """
+        if 'reasoner' not in element:
+            return None
+        mask = 0
+        for name in self.as_list (element['reasoner']):
+            bit = self.reasoner_bits.get (name, None)
+            if bit is None:
+                bit = self.reasoner_bits[name] = len(self.reasoner_names)
+                self.reasoner_names.append (name)
+            mask |= 1 << bit
+        return mask
+
+    def place_node (self, node):
+        """
+        Find the merged node a node is folded into, recording its identifiers and name as that node's.
+        Returns the merged node's id, the node's equivalent identifiers, and whether the node is the first of its merged node.
+        """
+        if 'equivalent_identifiers' in node:
+            equivalent_identifiers = list(node['equivalent_identifiers'])
+        elif self.resolve is not None:
+            equivalent_identifiers = list(self.resolved.get (self.name_key (node), []))
+        else:
+            equivalent_identifiers = [ node['id'] ]
+        if node['id'] not in equivalent_identifiers:
+            equivalent_identifiers.append (node['id'])
+        name = node.get ('name', None)
+        known = [ self.canonical[id] for id in equivalent_identifiers if id in self.canonical ]
+        if len(known) == 0 and self.name_based_merging and name is not None:
+            known = [ self.names[name] ] if name in self.names else []
+        id = known[0] if len(known) > 0 else intern (node['id'])
+        for equivalent in equivalent_identifiers:
+            self.canonical.setdefault (intern (equivalent), id)
+        if name is not None:
+            self.names.setdefault (intern (name), id)
+        return id, equivalent_identifiers, len(known) == 0
+
+    def add_node (self, node):
+        id, equivalent_identifiers, first = self.place_node (node)
+        if first:
+            merged = KNode (node, self.reasoner_mask (node), equivalent_identifiers)
+            self.nodes.append (merged)
+            self.node_index[id] = merged
+        else:
+            """ Ensure that both nodes' properties are represented in the merged node. """
+            self.node_index[id].merge (node, self.reasoner_mask (node), equivalent_identifiers)
+
+    def place_edge (self, edge):
+        """ The ends of an edge, as merged node ids, and the key of the edges it's folded together with. """
+        source_id, target_id = [ self.canonical.get (edge[end], edge[end]) if end in edge else None
+                                 for end in ('source_id', 'target_id') ]
+        return (tuple(sorted(self.as_list (edge.get ('type', [])))), source_id, target_id), source_id, target_id
+
+    def add_edge (self, edge):
+        """ Add an edge, or fold it into an equivalent one. Returns the id of the edge it ends up as. """
+        key, source_id, target_id = self.place_edge (edge)
+        merged = self.edge_index.get (key, None)
+        if merged is None:
+            merged = self.edge_index[key] = KEdge (edge, self.reasoner_mask (edge), source_id, target_id)
+            self.edges.append (merged)
+        else:
+            merged.merge (edge, self.reasoner_mask (edge))
+        return merged.id
+
+    def to_json (self, nodes, edges):
+        return {
+            "nodes" : [ n.to_json (self.reasoner_names) for n in nodes ],
+            "edges" : [ e.to_json (self.reasoner_names) for e in edges ]
+        }
+
+    def snapshot (self, question_graph=None, root_order=None):
+        """ The result merged so far, as a message. Answers are joined along root_order if given. """
+        with self.lock:
+            return {
+                "knowledge_graph" : self.to_json (self.nodes, self.edges),
+                "knowledge_map" : AnswerTable.connect (self.responses, root_order).to_answers (),
+                "question_graph" : question_graph
+            }
+
+    def delta (self):
+        """ The nodes, edges, and answers added since the last delta. Nodes merged into earlier nodes are not repeated. """
+        with self.lock:
+            nodes, edges, responses = self.marks
+            self.marks = (len(self.nodes), len(self.edges), len(self.responses))
+            return {
+                "knowledge_graph" : self.to_json (self.nodes[nodes:], self.edges[edges:]),
+                "knowledge_map" : AnswerTable.concat ([ answers for order, answers in self.responses[responses:] ], self.vocabulary).to_answers ()
+            }
+
+def fold_nodes (group):
+    """ Fold a group of (node, reasoner mask, equivalent identifiers) into one merged node, first to last. """
+    node, mask, equivalent_identifiers = group[0]
+    merged = KNode (node, mask, equivalent_identifiers)
+    for node, mask, equivalent_identifiers in group[1:]:
+        merged.merge (node, mask, equivalent_identifiers)
+    return merged
+
+def fold_edges (group):
+    """ Fold a group of (edge, reasoner mask, source id, target id) into one merged edge, first to last. """
+    edge, mask, source_id, target_id = group[0]
+    merged = KEdge (edge, mask, source_id, target_id)
+    for edge, mask, source_id, target_id in group[1:]:
+        merged.merge (edge, mask)
+    return merged
+
+def fold_partition (partition):
+    """ Fold a partition of (node groups, edge groups, reasoner names), returning the merged nodes and edges as messages. """
+    node_groups, edge_groups, reasoner_names = partition
+    return (
+        [ fold_nodes (group).to_json (reasoner_names) for group in node_groups ],
+        [ fold_edges (group).to_json (reasoner_names) for group in edge_groups ]
+    )
+
+""" Process pools for merging, by size, shared by all merges. """
+merge_pools = {}
+merge_pools_lock = threading.Lock ()
+
+def merge_pool (processes):
+    """
+    A pool of merge processes. Its processes are spawned rather than forked: forking a process with other threads
+    running, like a web server's, can leave locks held in the child that no thread there will release.
+    The pool is kept for later merges, so processes are spawned once, not per merge.
+    """
+    with merge_pools_lock:
+        pool = merge_pools.get (processes, None)
+        if pool is None:
+            pool = merge_pools[processes] = multiprocessing.get_context ('spawn').Pool (processes)
+        return pool
+
+class PartitionedMerger(IncrementalMerger):
+    """
+    Merge a batch of responses, building the merged nodes and edges across a pool of spawned processes.
+    Experimental, and unused unless merge_processes is set: no speedup over IncrementalMerger has been shown yet.
+
+    Which node or edge each is folded into depends on those before it, so that is decided here, as
+    IncrementalMerger decides it, along with the answers. Only the groups of nodes and edges folded together are
+    divided among the processes, by their order of appearance, and their merged elements are put back in that
+    order. The result is the same as IncrementalMerger's.
+
+    Nothing is shared with the processes: the groups are pickled to them, in contiguous partitions, and the merged
+    elements are pickled back, so the processes have to fold enough to pay for that. With fewer than two processes, groups are folded here.
+    """
+
+    """ Partitions per process, so processes finishing early take on more. """
+    partitions_per_process = 4
+
+    def __init__(self, processes, name_based_merging=True, resolve=None):
+        super().__init__(name_based_merging=name_based_merging, resolve=resolve)
+        self.processes = processes
+        self.node_groups = []
+        self.edge_groups = []
+
+    def add_node (self, node):
+        id, equivalent_identifiers, first = self.place_node (node)
+        if first:
+            self.node_index[id] = len(self.node_groups)
+            self.node_groups.append ([])
+        self.node_groups[self.node_index[id]].append ((node, self.reasoner_mask (node), equivalent_identifiers))
+
+    def add_edge (self, edge):
+        key, source_id, target_id = self.place_edge (edge)
+        group = self.edge_index.get (key, None)
+        if group is None:
+            group = self.edge_index[key] = len(self.edge_groups)
+            self.edge_groups.append ([])
+        self.edge_groups[group].append ((edge, self.reasoner_mask (edge), source_id, target_id))
+        return self.edge_groups[group][0][0].get ('id', None)
+
+    def fold (self):
+        """ Build the merged nodes and edges, as messages. """
+        processes = min(self.processes, len(self.node_groups) + len(self.edge_groups))
+        if processes < 2:
+            return fold_partition ((self.node_groups, self.edge_groups, self.reasoner_names))
+        count = processes * self.partitions_per_process
+        def split (groups):
+            size = -(-len(groups) // count)
+            return [ groups[i * size : (i + 1) * size] for i in range(count) ]
+        partitions = [ (node_groups, edge_groups, self.reasoner_names)
+                       for node_groups, edge_groups in zip(split (self.node_groups), split (self.edge_groups)) ]
+        nodes = []
+        edges = []
+        for partition_nodes, partition_edges in merge_pool (processes).map (fold_partition, partitions):
+            nodes.extend (partition_nodes)
+            edges.extend (partition_edges)
+        logger.debug (f"folded {len(nodes)} nodes and {len(edges)} edges in {processes} processes")
+        return nodes, edges
+
+    def snapshot (self, question_graph=None, root_order=None):
+        with self.lock:
+            nodes, edges = self.fold ()
+            return {
+                "knowledge_graph" : { "nodes" : nodes, "edges" : edges },
+                "knowledge_map" : AnswerTable.connect (self.responses, root_order).to_answers (),
+                "question_graph" : question_graph
+            }
+
+    def delta (self):
+        """ The nodes, edges, and answers added since the last delta. Deltas are small, so they're folded here. """
+        with self.lock:
+            nodes, edges, responses = self.marks
+            self.marks = (len(self.node_groups), len(self.edge_groups), len(self.responses))
+            folded_nodes, folded_edges = fold_partition ((self.node_groups[nodes:], self.edge_groups[edges:], self.reasoner_names))
+            return {
+                "knowledge_graph" : { "nodes" : folded_nodes, "edges" : folded_edges },
+                "knowledge_map" : AnswerTable.concat ([ answers for order, answers in self.responses[responses:] ], self.vocabulary).to_answers ()
+            }
@@ -0,0 +1,204 @@
+import json
+import logging
+import sys
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger (__name__)
+
+class Projection:
+    """
+    The node and edge attributes a query keeps from reasoner responses. Attributes the interpreter relies on,
+    like ids, types, names and reasoners, are always kept. Everything else not listed is dropped as the
+    response is read, so large attributes like publications and descriptions are never built.
+    """
+
+    """ Propagates a projection to the backplane, so it can drop attributes before sending them. """
+    header = "X-TranQL-Projection"
+
+    essential = {
+        "nodes" : ( "id", "type", "name", "equivalent_identifiers", "reasoner" ),
+        "edges" : ( "id", "type", "source_id", "target_id", "reasoner", "source_database" )
+    }
+
+    def __init__(self, nodes=[], edges=[]):
+        self.attributes = {
+            "nodes" : frozenset ([ *self.essential["nodes"], *nodes ]),
+            "edges" : frozenset ([ *self.essential["edges"], *edges ])
+        }
+
+    @staticmethod
+    def from_config (config):
+        """
+        A projection from a mapping of nodes and edges to the attributes to keep, or from a list or comma
+        separated string of names like node.description and edge.publications. None keeps everything.
+        """
+        if config is None or isinstance(config, Projection):
+            return config
+        if isinstance(config, str):
+            if config.strip ().lower () in ("", "none", "null"):
+                return None
+            config = [ name.strip () for name in config.split (",") if len(name.strip ()) > 0 ]
+        if isinstance(config, list):
+            mapping = { "nodes" : [], "edges" : [] }
+            for name in config:
+                kind, _, attribute = name.partition (".")
+                if kind not in ("node", "edge") or len(attribute) == 0:
+                    raise ValueError (f"Projected attribute {name} must be named like node.name or edge.publications.")
+                mapping[kind + "s"].append (attribute)
+            config = mapping
+        return Projection (config.get ("nodes", []), config.get ("edges", []))
+
+    def including (self, names):
+        """ This projection, also keeping the named attributes, named like node.name. """
+        if len(names) == 0:
+            return self
+        extra = Projection.from_config (list(names))
+        return Projection (self.attributes["nodes"] | extra.attributes["nodes"],
+                           self.attributes["edges"] | extra.attributes["edges"])
+
+    def names (self):
+        """ The attributes kept, named like node.name. """
+        return [ f"{section[:-1]}.{a}" for section, attributes in self.attributes.items () for a in sorted(attributes) ]
+
+    def headers (self):
+        """ Headers propagating this projection to a downstream service. """
+        return { self.header : ",".join (self.names ()) }
+
+    @staticmethod
+    def from_headers (headers):
+        """ Recreate a projection from a request's headers. None if the request keeps everything. """
+        try:
+            return Projection.from_config (headers.get (Projection.header, None))
+        except ValueError:
+            return None
+
+    def keeps (self, section, attribute):
+        return attribute in self.attributes[section]
+
+    def apply (self, message):
+        """ Drop the attributes not kept from a message already read. The message is modified. """
+        graph = message.get ("knowledge_graph", None) if isinstance(message, dict) else None
+        if not isinstance(graph, dict):
+            return message
+        for section, kept in self.attributes.items ():
+            for element in graph.get (section, []) or []:
+                for attribute in [ a for a in element if a not in kept ]:
+                    del element[attribute]
+        return message
+
+    def to_json (self):
+        return { section : sorted(attributes) for section, attributes in self.attributes.items () }
+
+    def __eq__(self, other):
+        return isinstance(other, Projection) and self.attributes == other.attributes
+
+    def __hash__(self):
+        return hash((self.attributes["nodes"], self.attributes["edges"]))
+
+    def __repr__(self):
+        return f"Projection({self.to_json ()})"
+
+class MessageBuilder:
+    """
+    Build a message from parse events, as ijson produces them, leaving out node and edge attributes the
+    projection drops. Dropped values are skipped event by event and never built. Keys are interned, so the
+    many elements of a response share them.
+    """
+
+    def __init__(self, projection):
+        self.sections = {
+            "knowledge_graph.nodes.item" : projection.attributes["nodes"],
+            "knowledge_graph.edges.item" : projection.attributes["edges"]
+        }
+        self.root = []
+        self.containers = [ self.root ]
+        self.keys = [ None ]
+        self.key = None
+        """ While skipping a dropped value, one more than how many containers deep into it the parse is. """
+        self.skipping = 0
+
+    @property
+    def value (self):
+        return self.root[0] if len(self.root) > 0 else None
+
+    def feed (self, events):
+        """ Add a batch of (prefix, event, value) events. The loop runs once per event, so its state is kept in locals. """
+        sections = self.sections
+        containers = self.containers
+        keys = self.keys
+        container = containers[-1]
+        key = self.key
+        skipping = self.skipping
+        for prefix, event, value in events:
+            if skipping:
+                if event == 'start_map' or event == 'start_array':
+                    skipping += 1
+                elif event == 'end_map' or event == 'end_array':
+                    skipping -= 1
+                if skipping == 1:
+                    skipping = 0
+                continue
+            if event == 'map_key':
+                kept = sections.get (prefix, None)
+                if kept is not None and value not in kept:
+                    skipping = 1
+                else:
+                    key = sys.intern (value)
+                continue
+            if event == 'end_map' or event == 'end_array':
+                containers.pop ()
+                keys.pop ()
+                container = containers[-1]
+                key = keys[-1]
+                continue
+            started = event == 'start_map' or event == 'start_array'
+            if started:
+                value = {} if event == 'start_map' else []
+            if container.__class__ is list:
+                container.append (value)
+            else:
+                container[key] = value
+            if started:
+                keys[-1] = key
+                containers.append (value)
+                keys.append (None)
+                container = value
+                key = None
+        self.key = key
+        self.skipping = skipping
+
+def streaming ():
+    """ Can responses be parsed as they are read? """
+    return ijson is not None
+
+def parse_message (stream, projection=None):
+    """ Read a message from a binary stream, keeping only the attributes of the projection. """
+    if projection is None or ijson is None:
+        message = json.load (stream)
+        return projection.apply (message) if projection is not None else message
+    builder = MessageBuilder (projection)
+    builder.feed (ijson.parse (stream, use_float=True))
+    return builder.value
+
+async def parse_message_async (http_response, projection=None, chunk_size=65536):
+    """ Read a message from an aiohttp response as it arrives, keeping only the attributes of the projection. """
+    if projection is None or ijson is None:
+        message = await http_response.json ()
+        return projection.apply (message) if projection is not None else message
+    builder = MessageBuilder (projection)
+    events = ijson.sendable_list ()
+    parser = ijson.parse_coro (events, use_float=True)
+    while True:
+        chunk = await http_response.content.read (chunk_size)
+        if len(chunk) == 0:
+            break
+        parser.send (chunk)
+        builder.feed (events)
+        del events[:]
+    parser.close ()
+    builder.feed (events)
+    return builder.value
@@ -0,0 +1,154 @@
+import asyncio
+import concurrent.futures
+import logging
+import urllib.parse
+from tranql.cache import name_cache
+from tranql.exception import ServiceInvocationError
+from tranql.exception import UnknownServiceError
+from tranql.request_util import async_make_requests, breakers
+
+logger = logging.getLogger (__name__)
+
+class NameResolver:
+    """
+    Resolve natural language names to ontology identifiers with Bionames and, for chemicals, MyChem.
+
+    A name is resolved by a lookup per type at Bionames, plus one at MyChem if it names a chemical. Lookups are
+    resolved in batches: each distinct lookup in a batch is made once, those already in the cache aren't made,
+    and the rest are made concurrently, at most max_requests at a time. Results are cached for ttl seconds.
+    Lookups finding nothing are cached too, for negative_ttl seconds. Failed lookups are not cached.
+
+    The cache is shared by all interpreters in the process. Bionames and MyChem each have a circuit breaker,
+    so a struggling service isn't flooded. A name the services don't know resolves to nothing. A name whose
+    lookups failed can't be resolved: resolve raises ServiceInvocationError.
+    """
+
+    bionames_url = "https://bionames.renci.org/lookup/{input}/{type}/"
+    mychem_url = "http://mychem.info/v1/query?q={input}"
+
+    def __init__(self, cache=name_cache, ttl=86400, negative_ttl=600, max_requests=8):
+        self.cache = cache
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_requests = max_requests
+
+    @staticmethod
+    def lookups (name, type_names):
+        """ The lookups resolving a name: (service, name, type) tuples. """
+        if name is None:
+            return []
+        type_names = type_names if isinstance(type_names, (list, tuple)) else [ type_names ]
+        lookups = [ ("bionames", name, type_name) for type_name in type_names ]
+        if 'chemical_substance' in type_names:
+            lookups.append (("mychem", name, None))
+        return lookups
+
+    @staticmethod
+    def cache_key (lookup):
+        return ("names", *lookup)
+
+    def resolve (self, name, type_names, deadline=None):
+        """
+        The identifiers a name of the given types resolves to. An empty list if the services don't know the name.
+        Raises ServiceInvocationError if nothing was found because lookups failed.
+        """
+        type_names = self.type_key (type_names)
+        found = self.find ([ (name, type_names) ], deadline)
+        identifiers = self.found_identifiers (name, type_names, found)
+        failed = [ lookup for lookup in self.lookups (name, type_names) if found[lookup] is None ]
+        if len(identifiers) == 0 and len(failed) > 0:
+            raise ServiceInvocationError (
+                f"Unable to resolve {name}: {', '.join ([ lookup[0] for lookup in failed ])} failed.",
+                details=f"Failed lookups: {failed}")
+        return identifiers
+
+    @staticmethod
+    def type_key (type_names):
+        return tuple(type_names) if isinstance(type_names, (list, tuple)) else (type_names,)
+
+    def resolve_all (self, names, deadline=None):
+        """
+        Resolve (name, type names) pairs. Returns the identifiers of each, by name and tuple of type names.
+        Identifiers are in the order of the lookups finding them: Bionames' by type, then MyChem's.
+        Failed lookups find nothing.
+        """
+        names = list(dict.fromkeys ([ (name, self.type_key (type_names)) for name, type_names in names ]))
+        found = self.find (names, deadline)
+        return { (name, type_names) : self.found_identifiers (name, type_names, found) for name, type_names in names }
+
+    def find (self, names, deadline=None):
+        """ Make the lookups resolving (name, type names) pairs. Returns each lookup's identifiers, or None if it failed. """
+        lookups = list(dict.fromkeys ([ lookup for name, type_names in names for lookup in self.lookups (name, type_names) ]))
+        found = { lookup : self.cache.get (self.cache_key (lookup)) for lookup in lookups }
+        missing = [ lookup for lookup, identifiers in found.items () if identifiers is None ]
+        logger.debug (f"resolving {len(names)} names: {len(lookups)} lookups, {len(missing)} not cached")
+        if len(missing) > 0:
+            for lookup, identifiers in self.fetch (missing, deadline).items ():
+                if identifiers is not None:
+                    self.cache.put (self.cache_key (lookup), identifiers,
+                                    ttl=self.ttl if len(identifiers) > 0 else self.negative_ttl)
+                found[lookup] = identifiers
+        return found
+
+    def found_identifiers (self, name, type_names, found):
+        return [ i for lookup in self.lookups (name, type_names) for i in found[lookup] or [] ]
+
+    def request (self, lookup):
+        service, name, type_name = lookup
+        url = self.bionames_url if service == "bionames" else self.mychem_url
+        return {
+            "method" : "get",
+            "url" : url.format (input=urllib.parse.quote (name, safe=''), type=type_name),
+            "headers" : {
+                "accept" : "application/json"
+            },
+            "breaker" : breakers.get (service)
+        }
+
+    @staticmethod
+    def identifiers (lookup, response):
+        """ The identifiers in a service's response to a lookup. """
+        if lookup[0] == "bionames":
+            return [ i["id"] for i in response ]
+        result = []
+        for obj in response.get ('hits', []):
+            if 'chebi' in obj:
+                result.append (obj['chebi']['id'])
+            if 'chembl' in obj:
+                result.append ("CHEMBL:"+obj['chembl']['molecule_chembl_id'])
+        return result
+
+    def fetch (self, lookups, deadline=None):
+        """ Make lookups concurrently. Returns the identifiers each found, or None if it failed. """
+        responses = self.run (lambda: async_make_requests ([ self.request (lookup) for lookup in lookups ],
+                                                           self.max_requests, deadline=deadline))
+        result = {}
+        for lookup, response in zip(lookups, responses["results"]):
+            errors = response["errors"]
+            if len(errors) == 0:
+                result[lookup] = self.identifiers (lookup, response["response"])
+            elif all ([ isinstance(e, UnknownServiceError) for e in errors ]):
+                """ Bionames answers names it doesn't know with a 404. """
+                result[lookup] = []
+            else:
+                logger.warning (f"unable to resolve {lookup}: {errors}")
+                result[lookup] = None
+        return result
+
+    @staticmethod
+    def run (fn):
+        """ Run fn, which runs an event loop, on a thread of its own if this thread's loop is already running. """
+        try:
+            running = asyncio.get_event_loop ().is_running ()
+        except RuntimeError:
+            running = False
+        if not running:
+            return fn ()
+        def run_in_new_loop ():
+            asyncio.set_event_loop (asyncio.new_event_loop ())
+            try:
+                return fn ()
+            finally:
+                asyncio.get_event_loop ().close ()
+        with concurrent.futures.ThreadPoolExecutor (max_workers=1) as executor:
+            return executor.submit (run_in_new_loop).result ()
@@ -4,31 +4,314 @@ import logging
 import aiohttp
 import concurrent.futures
 import random
+import threading
+from collections import defaultdict, deque
 from time import time as now
-from tranql.exception import ServiceInvocationError, RequestTimeoutError
+from tranql.message_parser import parse_message_async
+from tranql.exception import ServiceInvocationError, RequestTimeoutError, UnknownServiceError, ServiceUnavailableError
 
 logger = logging.getLogger (__name__)
 
-async def make_request_async (semaphore, **kwargs):
+class Deadline:
+    """
+    The point in time after which outstanding work on behalf of a query is abandoned.
+    It doubles as a cooperative cancellation token: once cancelled, it reports itself expired.
+    """
+
+    """ Header propagating the remaining time, in seconds, to the services we call. """
+    header = "X-TranQL-Timeout"
+
+    def __init__(self, timeout=None, parent=None):
+        self.timeout = timeout
+        self.expires = now () + timeout if timeout is not None else None
+        self.parent = parent
+        self.cancelled = False
+
+    def remaining (self):
+        """ Seconds left before the deadline, or None if there is no deadline. """
+        if self.is_cancelled ():
+            return 0
+        return max(0, self.expires - now ()) if self.expires is not None else None
+
+    def is_cancelled (self):
+        return self.cancelled or (self.parent is not None and self.parent.is_cancelled ())
+
+    def expired (self):
+        return self.is_cancelled () or (self.expires is not None and now () >= self.expires)
+
+    def cancel (self):
+        """ Cancel outstanding work, e.g. because the client went away. """
+        self.cancelled = True
+
+    def child (self, timeout=None):
+        """ Create a deadline that expires after timeout seconds but never outlives this one. """
+        remaining = self.remaining ()
+        if timeout is None or (remaining is not None and remaining < timeout):
+            timeout = remaining
+        return Deadline (timeout, parent=self)
+
+    def check (self, message="Query deadline exceeded."):
+        """ Raise a timeout error if the deadline has passed. """
+        if self.expired ():
+            reason = "was cancelled" if self.is_cancelled () else f"exceeded its {self.timeout}s timeout"
+            raise RequestTimeoutError (message, details=f"The query {reason}.")
+
+    def headers (self):
+        """ Headers propagating this deadline to a downstream service. """
+        remaining = self.remaining ()
+        return { self.header : str(round(remaining, 3)) } if remaining is not None else {}
+
+    @staticmethod
+    def from_headers (headers, default=None):
+        """ Recreate a deadline from a request's headers. """
+        value = headers.get (Deadline.header, None)
+        try:
+            return Deadline (float(value) if value is not None else default)
+        except ValueError:
+            return Deadline (default)
+
+    def __repr__(self):
+        return f"Deadline(timeout={self.timeout},remaining={self.remaining()})"
+
+class RequestPolicy:
+    """
+    How requests to a reasoner are retried and hedged. Configured per reasoner in conf/schema.yaml:
+
+        request:
+          retries: 2       # Retry transient failures up to this many times.
+          backoff: 0.5     # Base delay, in seconds, of the jittered exponential backoff between retries.
+          hedge: true      # Send a duplicate request if the first is slower than the reasoner usually is.
+    """
+    def __init__(self, retries=0, backoff=0.5, max_backoff=8, hedge=False, hedge_percentile=95,
+                 hedge_min_samples=20, retry_statuses=[429, 502, 503, 504]):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.retry_statuses = retry_statuses
+
+    @staticmethod
+    def from_config (config):
+        return RequestPolicy (**(config or {}))
+
+    def backoff_delay (self, attempt):
+        """ Exponential backoff with full jitter. """
+        return random.uniform (0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def hedge_delay (self, url):
+        """ How long to wait before hedging a request to url, or None if we should not hedge. """
+        if not self.hedge:
+            return None
+        return latencies.percentile (url, self.hedge_percentile, self.hedge_min_samples)
+
+class RetryBudget:
+    """ Caps the retries and hedged requests one query may add on top of its questions. """
+    def __init__(self, budget=10):
+        self.remaining = budget
+        """ Sources asked on separate threads share the budget. """
+        self.lock = threading.Lock ()
+
+    def spend (self):
+        """ Take one extra request from the budget, if any remain. """
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+class LatencyTracker:
+    """ Recent response times of each service. """
+    def __init__(self, window=200):
+        self.samples = defaultdict (lambda: deque (maxlen=window))
+
+    def record (self, url, seconds):
+        self.samples[url].append (seconds)
+
+    def percentile (self, url, percentile, min_samples=1):
+        """ The given percentile of the recent response times of url, or None without enough samples. """
+        samples = sorted (self.samples.get (url, []))
+        if len(samples) < max(1, min_samples):
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+""" Response times are shared by all queries in the process. """
+latencies = LatencyTracker ()
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a reasoner that is failing.
+
+    Closed: requests flow, and their outcomes are tracked.
+    Open: too many recent requests failed or timed out. Requests are rejected without being sent.
+    Half open: the reset timeout has passed. One probe request is let through. Its success closes
+    the breaker, its failure opens it again.
+
+    Configured per reasoner in conf/schema.yaml:
+
+        breaker:
+          failure_rate: 0.5   # Open when at least this fraction of recent requests failed...
+          min_requests: 5     # ...and at least this many outcomes have been seen.
+          window: 20          # How many recent outcomes to consider.
+          reset_timeout: 30   # Seconds to stay open before probing the reasoner again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, failure_rate=0.5, min_requests=5, window=20, reset_timeout=30):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.outcomes = deque (maxlen=window)
+        self.opened = None
+        self.probing = False
+        self.lock = threading.Lock ()
+
+    @property
+    def state (self):
+        if self.opened is None:
+            return self.CLOSED
+        if now () - self.opened >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def is_open (self):
+        """ Is the reasoner known to be failing? Half open breakers are not, so that a query can probe them. """
+        return self.state == self.OPEN
+
+    def retry_after (self):
+        """ Seconds until an open breaker will let a probe through. """
+        return max(0, self.opened + self.reset_timeout - now ()) if self.opened is not None else 0
+
+    def allow (self):
+        """ May a request be sent? A half open breaker admits one probe at a time. """
+        with self.lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def abandon (self):
+        """ A request let through was abandoned before it completed, e.g. because its query's deadline passed. """
+        with self.lock:
+            self.probing = False
+
+    def record (self, success):
+        """ Record the outcome of a request, opening or closing the breaker as needed. """
+        with self.lock:
+            if self.opened is not None:
+                if not self.probing:
+                    """ A request sent before the breaker opened. Its outcome is stale. """
+                    return
+                self.probing = False
+                if success:
+                    logger.info (f"circuit breaker for {self.name} closed")
+                    self.opened = None
+                    self.outcomes.clear ()
+                else:
+                    self.opened = now ()
+                return
+            self.outcomes.append (success)
+            failures = self.outcomes.count (False)
+            if len(self.outcomes) >= self.min_requests and failures >= self.failure_rate * len(self.outcomes):
+                logger.warning (f"circuit breaker for {self.name} opened after {failures} of {len(self.outcomes)} requests failed")
+                self.opened = now ()
+
+    def reset (self):
+        with self.lock:
+            self.opened = None
+            self.probing = False
+            self.outcomes.clear ()
+
+    def to_dict (self):
+        return {
+            "name" : self.name,
+            "state" : self.state,
+            "retry_after" : round(self.retry_after (), 3)
+        }
+
+    def __repr__(self):
+        return f"CircuitBreaker(name={self.name},state={self.state})"
+
+class CircuitBreakerRegistry:
+    """ The circuit breakers of all reasoners, by name. """
+    def __init__(self):
+        self.breakers = {}
+        self.lock = threading.Lock ()
+
+    def get (self, name, config=None):
+        """ Get the named breaker, creating it from config the first time it is asked for. """
+        with self.lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker (name, **(config or {}))
+            return self.breakers[name]
+
+    def is_open (self, name):
+        breaker = self.breakers.get (name, None)
+        return breaker is not None and breaker.is_open ()
+
+    def reset (self):
+        with self.lock:
+            self.breakers.clear ()
+
+""" Like response times, reasoner health is shared by all queries in the process. """
+breakers = CircuitBreakerRegistry ()
+
+def is_failure (errors):
+    """ Do these errors mean the service is unhealthy? Errors the service reports about a question do not. """
+    return any ([ not isinstance (e, (ServiceInvocationError, UnknownServiceError)) for e in errors ])
+
+async def make_request_once (semaphore, deadline=None, retry_statuses=[], projection=None, **kwargs):
+    """
+    Make a single attempt at a request. Says whether a failure is worth retrying.
+    With a projection, the response is parsed as it arrives, keeping only the node and edge attributes it names.
+    """
     response = {}
     errors = []
-    async with aiohttp.ClientSession () as session:
+    retryable = False
+    if projection is not None:
+        """ Let the service drop what we would drop anyway before sending it. """
+        kwargs['headers'] = { **kwargs.get('headers', {}), **projection.headers () }
+    async with semaphore, aiohttp.ClientSession () as session:
+        if deadline is not None:
+            """
+            Bound the request by the time left and tell the service how long it has. With no time left, fail
+            without sending anything: aiohttp takes a total timeout of 0 to mean no timeout at all.
+            """
+            try:
+                deadline.check (f'Query deadline passed before requesting content from url: "{kwargs.get("url","undefined")}"')
+            except RequestTimeoutError as e:
+                return { "response" : {}, "errors" : [ e ], "retryable" : False }
+            remaining = deadline.remaining ()
+            if remaining is not None:
+                kwargs['timeout'] = aiohttp.ClientTimeout (total=max(remaining, 0.001))
+            kwargs['headers'] = { **kwargs.get('headers', {}), **deadline.headers () }
+        start = now ()
         try:
             async with session.request (**kwargs) as http_response:
                 # print(f"[{kwargs['method'].upper()}] requesting at url: {kwargs['url']}")
                 """ Check status and handle response. """
                 if http_response.status == 200 or http_response.status == 202:
-                    response = await http_response.json ()
+                    response = await parse_message_async (http_response, projection)
                     #logger.error (f" response: {json.dumps(response, indent=2)}")
-                    status = response.get('status', None)
+                    status = response.get('status', None) if isinstance(response, dict) else None
                     if status == "error":
                         raise ServiceInvocationError(
                             f"An error occurred invoking service: {kwargs['url']}.",
                             response['message'])
+                    latencies.record (kwargs['url'], now () - start)
                     # print (f"** asyncio-response: {json.dumps(response,indent=2)}")
                 elif http_response.status == 404:
-                    raise UnknownServiceError (f"Service {url} was not found. Is it misspelled?")
+                    raise UnknownServiceError (f"Service {kwargs['url']} was not found. Is it misspelled?")
                 else:
+                    retryable = http_response.status in retry_statuses
                     http_response.raise_for_status()
                     # logger.error (f"error {http_response.status} processing request: {message}")
                 # logger.error (http_response.text)
@@ -36,25 +319,167 @@ async def make_request_async (semaphore, **kwargs):
             errors.append (RequestTimeoutError(f'Timeout error requesting content from url: "{kwargs.get("url","undefined")}"',kwargs))
         except ServiceInvocationError as e:
             errors.append (e)
+        except asyncio.CancelledError:
+            raise
+        except aiohttp.ClientConnectionError as e:
+            retryable = True
+            errors.append (e)
         except Exception as e:
             errors.append (e)
     return {
         "response" : response,
-        "errors" : errors
+        "errors" : errors,
+        "retryable" : retryable
+    }
+
+async def make_hedged_request (semaphore, deadline, policy, budget, **kwargs):
+    """ Make a request. If it takes longer than the service usually does, race a duplicate against it. """
+    attempt = lambda: asyncio.ensure_future (make_request_once (
+        semaphore, deadline=deadline, retry_statuses=policy.retry_statuses, **kwargs))
+    first = attempt ()
+    delay = policy.hedge_delay (kwargs['url'])
+    if delay is None:
+        return await first
+    done, pending = await asyncio.wait ({ first }, timeout=delay)
+    if len(done) > 0 or not budget.spend ():
+        return await first
+    logger.debug (f"hedging request to {kwargs['url']} after {delay}s")
+    pending = { first, attempt () }
+    result = None
+    try:
+        while len(pending) > 0:
+            done, pending = await asyncio.wait (pending, return_when=asyncio.FIRST_COMPLETED)
+            """ Take the first success. Fall back to a failure only if both attempts fail. """
+            result = done.pop ().result ()
+            if len(result['errors']) == 0:
+                break
+    finally:
+        for task in pending:
+            task.cancel ()
+        await asyncio.gather (*pending, return_exceptions=True)
+    return result
+
+async def make_request_async (semaphore, deadline=None, policy=None, budget=None, breaker=None, **kwargs):
+    """
+    Make a request, retrying transient failures with backoff as allowed by the policy and the query's retry budget.
+    If the service's circuit breaker is open, fail immediately without sending anything.
+    """
+    policy = policy if policy is not None else RequestPolicy ()
+    budget = budget if budget is not None else RetryBudget (0)
+    start = now ()
+    if breaker is not None and not breaker.allow ():
+        return {
+            "response" : {},
+            "elapsed" : 0,
+            "errors" : [ ServiceUnavailableError (
+                f"Service {kwargs['url']} is unavailable.",
+                f"Recent requests to {breaker.name} failed. It will be retried in {round(breaker.retry_after ())}s.") ]
+        }
+    attempt = 0
+    try:
+        while True:
+            result = await make_hedged_request (semaphore, deadline, policy, budget, **kwargs)
+            if not result['retryable'] or attempt >= policy.retries:
+                break
+            delay = policy.backoff_delay (attempt)
+            if deadline is not None and deadline.remaining () is not None and deadline.remaining () <= delay:
+                break
+            if not budget.spend ():
+                logger.debug (f"retry budget exhausted; not retrying request to {kwargs['url']}")
+                break
+            logger.debug (f"retrying request to {kwargs['url']} in {delay}s after: {result['errors']}")
+            await asyncio.sleep (delay)
+            attempt += 1
+    except asyncio.CancelledError:
+        if breaker is not None:
+            breaker.abandon ()
+        raise
+    if breaker is not None:
+        breaker.record (not is_failure (result['errors']))
+    return {
+        "response" : result['response'],
+        "elapsed" : round(now () - start, 3),
+        "errors" : result['errors']
     }
 
+async def gather_requests (semaphore, requestPool, deadline=None, budget=None, on_result=None, poll_interval=0.1,
+                           until=None):
+    """
+    Run all requests, cancelling whatever is still in flight once the deadline passes or is cancelled.
+    If given, on_result(index, result) is called as each request finishes. It takes the response: once it
+    returns, the result's response is dropped, so responses already merged aren't kept to the end.
+    If given, requests still outstanding once until() is true are dropped: their results are marked skipped.
+    """
+    tasks = [ asyncio.ensure_future (make_request_async (semaphore, deadline=deadline, budget=budget, **request))
+              for request in requestPool ]
+    index = { task : i for i, task in enumerate(tasks) }
+    results = [ None ] * len(tasks)
+    def finish (task, skipped=False):
+        i = index[task]
+        if skipped:
+            results[i] = { "response" : {}, "elapsed" : None, "errors" : [], "skipped" : True }
+        elif task.cancelled ():
+            results[i] = {
+                "response" : {},
+                "elapsed" : None,
+                "errors" : [ RequestTimeoutError (
+                    f'Request to url "{requestPool[i].get("url","undefined")}" was cancelled when the query deadline passed.',
+                    requestPool[i].get('json', '')) ]
+            }
+        else:
+            results[i] = task.result ()
+        if on_result is not None:
+            on_result (i, results[i])
+            results[i]["response"] = {}
+    pending = set(tasks)
+    while len(pending) > 0:
+        timeout = None
+        if deadline is not None:
+            """ Wake up periodically to notice cancellation as well as expiry. """
+            remaining = deadline.remaining ()
+            timeout = poll_interval if remaining is None else min(poll_interval, remaining)
+        elif until is not None:
+            timeout = poll_interval
+        done, pending = await asyncio.wait (pending, timeout=timeout)
+        for task in done:
+            finish (task)
+        if until is not None and len(pending) > 0 and until ():
+            logger.debug (f"dropping {len(pending)} of {len(tasks)} requests no longer needed.")
+            for task in pending:
+                task.cancel ()
+            await asyncio.gather (*pending, return_exceptions=True)
+            for task in pending:
+                finish (task, skipped=True)
+            break
+        if deadline is not None and deadline.expired () and len(pending) > 0:
+            logger.warning (f"deadline passed with {len(pending)} of {len(tasks)} requests outstanding; cancelling them.")
+            for task in pending:
+                task.cancel ()
+            await asyncio.gather (*pending, return_exceptions=True)
+            for task in pending:
+                finish (task)
+            break
+    return results
+
 """
 Concurrently makes all requests from a given pool of requests
 
 Args:
     requestPool (dict[]): List of **kwarg dictionaries. Keyword arguments will be passed directly to the requests.request call
         Ex: {"method":"post","url":url} => requests.request(method="post",url=url)
+        A request may also carry a `policy` (RequestPolicy) governing its retries and hedging,
+        and a `breaker` (CircuitBreaker) tracking the health of the service.
     maxRequests (int, optional): Maximum number of requests that may be executing at any given time
+    deadline (Deadline, optional): Bounds each request and cancels those still outstanding when it passes
+    budget (RetryBudget, optional): Caps the retries and hedged requests across the pool
+    on_result (callable, optional): Called with the index and result of each request as it finishes.
+        Responses handed to it are not kept in the results.
+    until (callable, optional): Requests outstanding once it returns True are skipped rather than made
 
 Returns:
-    Dict containing `responses` and `errors`
+    Dict containing `errors`, as well as `results`: the response and errors of each request, in order.
 """
-def async_make_requests (requestPool, maxRequests=3):
+def async_make_requests (requestPool, maxRequests=3, deadline=None, budget=None, on_result=None, until=None):
 
     # Duck test approach
     try:
@@ -67,26 +492,16 @@ def async_make_requests (requestPool, maxRequests=3):
 
     semaphore = asyncio.BoundedSemaphore (maxRequests)
 
-    # tasks = asyncio.gather (*[make_request (**request) for request in requestPool])
-
-    tasks = asyncio.gather(*[(make_request_async (semaphore, **request)) for request in requestPool])
-
-    # for request in requestPool:
-        # tasks.append (asyncio.ensure_future (make_request (semaphore, **request)))
-
-    results = loop.run_until_complete(tasks)
+    results = loop.run_until_complete(gather_requests (semaphore, requestPool, deadline, budget, on_result, until=until))
 
-    responses = []
     errors = []
 
     for response in results:
         errors.extend (response["errors"])
-        if len(response["errors"]) == 0:
-            responses.append (response["response"])
 
     return {
-        "responses" : responses,
-        "errors" : errors
+        "errors" : errors,
+        "results" : results
     }
 
 if __name__ == "__main__":
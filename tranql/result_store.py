@@ -0,0 +1,112 @@
+import base64
+import collections
+import hashlib
+import json
+import logging
+import zlib
+from tranql.cache import TTLCache
+
+logger = logging.getLogger (__name__)
+
+class ResultStore:
+    """
+    Keeps query results on the server so clients can page through them instead of downloading them whole.
+
+    Results are content addressed - their id is the hash of their content, so storing the same result
+    twice stores it once - and kept compressed until they expire.
+    """
+
+    """ The parts of a result that can be paged through, and where they live in the message. """
+    sections = {
+        "answers" : ("knowledge_map",),
+        "nodes" : ("knowledge_graph", "nodes"),
+        "edges" : ("knowledge_graph", "edges")
+    }
+
+    def __init__(self, ttl=3600, max_entries=100):
+        self.results = TTLCache (ttl=ttl, max_entries=max_entries)
+        """ Recently paged results, decompressed, so each page doesn't decompress the whole result again. """
+        self.decompressed = TTLCache (ttl=60, max_entries=4)
+
+    def put (self, result):
+        """ Store a result, returning its id. """
+        data = json.dumps (result, sort_keys=True).encode ('utf-8')
+        id = hashlib.sha256 (data).hexdigest ()
+        if id not in self.results:
+            self.results.put (id, {
+                "data" : zlib.compress (data),
+                "summary" : self.summarize (result)
+            })
+        return id
+
+    def get (self, id):
+        """ Get a stored result, or None if there is no such result or it has expired. """
+        result = self.decompressed.get (id)
+        if result is None:
+            entry = self.results.get (id)
+            if entry is None:
+                return None
+            result = json.loads (zlib.decompress (entry['data']).decode ('utf-8'))
+            self.decompressed.put (id, result)
+        return result
+
+    def summary (self, id):
+        entry = self.results.get (id)
+        return entry['summary'] if entry is not None else None
+
+    @staticmethod
+    def summarize (result):
+        """ Count the answers, nodes and edges of a result, and the nodes and edges of each type. """
+        graph = result.get ('knowledge_graph', {})
+        def count_types (elements):
+            counts = collections.Counter ()
+            for element in elements:
+                counts.update (ResultStore.types (element))
+            return dict(counts)
+        return {
+            "answers" : len(result.get ('knowledge_map', [])),
+            "nodes" : len(graph.get ('nodes', [])),
+            "edges" : len(graph.get ('edges', [])),
+            "node_types" : count_types (graph.get ('nodes', [])),
+            "edge_types" : count_types (graph.get ('edges', []))
+        }
+
+    @staticmethod
+    def types (element):
+        type_name = element.get ('type', [])
+        return type_name if isinstance(type_name, list) else [ type_name ]
+
+    def page (self, id, section, cursor=None, limit=100, type_name=None):
+        """
+        Get a page of a result's answers, nodes, or edges, optionally only the nodes or edges of a type.
+        Returns None if there is no such result. Otherwise, the page's items, the total number of items,
+        and the cursor of the next page, which is None on the last page.
+        """
+        result = self.get (id)
+        if result is None:
+            return None
+        items = result
+        for key in self.sections[section]:
+            items = items.get (key, {} if key != self.sections[section][-1] else [])
+        if type_name is not None and section != "answers":
+            items = [ item for item in items if type_name in self.types (item) ]
+        offset = self.decode_cursor (cursor)
+        end = offset + limit
+        return {
+            "items" : items[offset:end],
+            "total" : len(items),
+            "next" : self.encode_cursor (end) if end < len(items) else None
+        }
+
+    @staticmethod
+    def encode_cursor (offset):
+        return base64.urlsafe_b64encode (str(offset).encode ('utf-8')).decode ('utf-8')
+
+    @staticmethod
+    def decode_cursor (cursor):
+        if not cursor:
+            return 0
+        try:
+            return max(0, int(base64.urlsafe_b64decode (cursor.encode ('utf-8')).decode ('utf-8')))
+        except ValueError:
+            raise ValueError (f"Invalid cursor: {cursor}")
@@ -0,0 +1,111 @@
+import json
+import logging
+import queue
+from tranql.merge import IncrementalMerger
+
+logger = logging.getLogger (__name__)
+
+class QueryStream:
+    """
+    Streams a query's execution as it happens.
+
+    The stream carries the interpreter's progress events (statement started or done, segment done,
+    reasoner response timings) and knowledge graph deltas: the new nodes and edges an IncrementalMerger finds
+    as it merges reasoner responses as they arrive. When a statement's responses are merged, a final delta
+    reconciles what was sent with the merged graph, remapping the ids of nodes sent under another id.
+    The stream ends with the query's knowledge_map, status, and errors.
+
+    Each message is a JSON object with an `event` field. Deltas apply to the statement most recently started.
+    """
+
+    def __init__(self, tranql):
+        self.tranql = tranql
+        self.queue = queue.Queue ()
+        self.finished = False
+        self.reset ()
+        tranql.add_listener (self.on_event)
+
+    def reset (self):
+        """ Forget the graph sent so far. Each statement streams its own graph. """
+        self.merger = IncrementalMerger (name_based_merging=self.tranql.name_based_merging)
+
+    def put (self, event, data):
+        """ Serialize now. Merging goes on to modify the responses we send parts of. """
+        self.queue.put ((event, json.dumps ({ "event" : event, **data })))
+
+    def on_event (self, event, data):
+        if event == "statement" and data.get ('status', None) == "started":
+            self.reset ()
+        if event == "response":
+            message = data.pop ('message', {}) or {}
+            graph = message.get ('knowledge_graph', {})
+            data['nodes'] = len(graph.get ('nodes', []))
+            data['edges'] = len(graph.get ('edges', []))
+            self.put (event, data)
+            self.put_delta (self.delta (graph))
+        elif event == "merged":
+            self.put_delta (self.delta (data['result'].get ('knowledge_graph', {}), merged=True))
+        else:
+            self.put (event, data)
+
+    def put_delta (self, delta):
+        if any ([ len(v) > 0 for v in delta.values () ]):
+            self.put ("delta", delta)
+
+    def delta (self, graph, merged=False):
+        """
+        Merge graph into what was sent, returning the nodes and edges the merger hasn't sent before.
+        Merged nodes are authoritative: where one was sent under other ids, those are remapped to its id.
+        """
+        with self.merger.lock:
+            remaps = {}
+            if merged:
+                for node in graph.get ('nodes', []):
+                    for id in [ node['id'], *node.get ('equivalent_identifiers', []) ]:
+                        sent = self.merger.canonical.get (id, None)
+                        if sent is not None and sent != node['id']:
+                            remaps[sent] = node['id']
+            self.merger.add ({ "knowledge_graph" : graph })
+            delta = self.merger.delta ()['knowledge_graph']
+        def remapped (id):
+            return remaps.get (id, id)
+        return {
+            "nodes" : delta['nodes'],
+            "edges" : [ { **e, "source_id" : remapped (e.get ('source_id', None)), "target_id" : remapped (e.get ('target_id', None)) }
+                        for e in delta['edges'] ],
+            "remaps" : [ { "from" : previous, "to" : id } for previous, id in remaps.items () ]
+        }
+
+    def run (self, execute):
+        """ Run execute(), which returns the query's message, sending the result when it is done. """
+        try:
+            result = execute ()
+            graph = result.get ('knowledge_graph', {})
+            self.put ("result", {
+                **{ k : v for k, v in result.items () if k != 'knowledge_graph' },
+                "nodes" : len(graph.get ('nodes', [])),
+                "edges" : len(graph.get ('edges', []))
+            })
+        except Exception as e:
+            logger.error (f"error streaming query: {e}")
+            self.put ("result", { "status" : "Error", "errors" : [ { "message" : str(e), "details" : "" } ] })
+        finally:
+            self.queue.put (None)
+
+    def messages (self, format="ndjson"):
+        """ Generate the stream's messages as newline delimited JSON or server sent events.
+        If the consumer goes away before the query finishes, the query is cancelled. """
+        try:
+            while True:
+                message = self.queue.get ()
+                if message is None:
+                    self.finished = True
+                    return
+                event, text = message
+                if format == "sse":
+                    yield f"event: {event}\ndata: {text}\n\n"
+                else:
+                    yield f"{text}\n"
+        finally:
+            if not self.finished:
+                self.tranql.cancel ()
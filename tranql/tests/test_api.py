@@ -1,8 +1,11 @@
 import pytest
 import json
+import threading
 from tranql.tests.util import assert_lists_equal, set_mock, ordered
 from tranql.exception import TranQLException
-from tranql.api import api, app, StandardAPIResource
+from tranql.api import api, app, StandardAPIResource, query_jobs, result_store
+from tranql.main import TranQL
+from tranql.stream import QueryStream
 
 @pytest.fixture
 def client():
@@ -295,6 +298,225 @@ def test_query(client, requests_mock):
     assert response.status_code == 500
     assert response.json['status'] == 'Error'
 
+def test_query_projection(client, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    program = """
+        SELECT population_of_individual_organisms->drug_exposure
+          FROM "/clinical/cohort/disease_to_chemical_exposure"
+         WHERE EstResidentialDensity < '2'
+           AND population_of_individual_organizms = 'x'
+           AND cohort = 'all_patients'
+           AND max_p_value = '0.1'
+    """
+    def query(projection=None):
+        args = { "asynchronous" : False }
+        if projection is not None:
+            args['projection'] = projection
+        return client.post('/tranql/query', query_string=args, data=program, content_type='application/json')
+    edges = query().json['knowledge_graph']['edges']
+    assert len(edges) > 0 and all(['attributes' in e for e in edges])
+    projected = query("node.description").json['knowledge_graph']['edges']
+    assert [ e['id'] for e in projected ] == [ e['id'] for e in edges ]
+    assert not any(['attributes' in e for e in projected])
+    assert all(['attributes' in e for e in query("edge.attributes").json['knowledge_graph']['edges']])
+
+    assert query("description").status_code == 400
+
+def test_query_job(client, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that query jobs run in the background, coalesce identical submissions, and can be polled. """
+    release = threading.Event ()
+    def respond (request, context):
+        release.wait (timeout=10)
+        return {
+            "knowledge_graph" : {
+                "nodes" : [ { "id" : "CHEBI:28177", "type" : "chemical_substance" } ],
+                "edges" : []
+            },
+            "knowledge_map" : [ { "node_bindings" : { "chemical_substance" : "CHEBI:28177" }, "edge_bindings" : {} } ]
+        }
+    requests_mock.post ("http://localhost:8099/graph/gamma/quick", json=respond)
+    program = """
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = "CHEBI:28177"
+    """
+    args = { "asynchronous" : False }
+    response = client.post('/tranql/jobs', query_string=args, data=program)
+    assert response.status_code == 202
+    job_id = response.json['id']
+    assert not response.json['coalesced']
+
+    response = client.post('/tranql/jobs', query_string=args, data=program)
+    assert response.json['coalesced'] and response.json['id'] == job_id
+
+    response = client.get(f'/tranql/jobs/{job_id}/result')
+    assert response.status_code == 202
+    assert response.json['progress']['statements']['total'] == 1
+
+    release.set ()
+    query_jobs.get (job_id).result (timeout=10)
+    response = client.get(f'/tranql/jobs/{job_id}')
+    assert response.json['status'] == 'done'
+    assert response.json['progress']['questions'] == { "done" : 1, "total" : 1, "in_flight" : 0 }
+    response = client.get(f'/tranql/jobs/{job_id}/result')
+    assert response.status_code == 200
+    assert response.json['knowledge_graph']['nodes'][0]['id'] == "CHEBI:28177"
+    assert job_id in [ job['id'] for job in client.get('/tranql/jobs').json ]
+    assert client.get('/tranql/jobs/foo').status_code == 404
+
+def test_query_job_projection(client, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that a job keeping only some attributes runs, and is told apart from one keeping them all. """
+    requests_mock.post ("http://localhost:8099/graph/gamma/quick", json={
+        "knowledge_graph" : {
+            "nodes" : [ { "id" : "CHEBI:28177", "type" : "chemical_substance", "description" : "d", "synonyms" : [ "s" ] } ],
+            "edges" : []
+        },
+        "knowledge_map" : [ { "node_bindings" : { "chemical_substance" : "CHEBI:28177" }, "edge_bindings" : {} } ]
+    })
+    program = """
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = "CHEBI:28177"
+    """
+    args = { "asynchronous" : False, "projection" : "node.description" }
+    response = client.post('/tranql/jobs', query_string=args, data=program)
+    assert response.status_code == 202
+    job_id = response.json['id']
+    query_jobs.get (job_id).result (timeout=10)
+    response = client.get(f'/tranql/jobs/{job_id}/result')
+    assert response.status_code == 200
+    node = response.json['knowledge_graph']['nodes'][0]
+    assert node['description'] == "d" and 'synonyms' not in node
+    response = client.post('/tranql/jobs', query_string={ "asynchronous" : False }, data=program)
+    assert response.json['id'] != job_id
+
+def test_query_stream(client, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that streamed queries report progress and graph deltas before the final knowledge_map. """
+    requests_mock.post ("http://localhost:8099/graph/gamma/quick", json={
+        "knowledge_graph" : {
+            "nodes" : [
+                { "id" : "CHEBI:28177", "type" : "chemical_substance" },
+                { "id" : "NCBIGene:1", "type" : "gene" },
+                { "id" : "HGNC:1", "type" : "gene", "equivalent_identifiers" : [ "NCBIGene:1" ] }
+            ],
+            "edges" : [ { "source_id" : "CHEBI:28177", "target_id" : "HGNC:1", "type" : "affects" } ]
+        },
+        "knowledge_map" : [ { "node_bindings" : { "chemical_substance" : "CHEBI:28177", "gene" : "HGNC:1" }, "edge_bindings" : {} } ]
+    })
+    response = client.post(
+        '/tranql/query/stream',
+        query_string={ "asynchronous" : False },
+        data="""
+            SELECT chemical_substance->gene
+              FROM "/graph/gamma/quick"
+             WHERE chemical_substance = "CHEBI:28177"
+        """)
+    assert response.mimetype == 'application/x-ndjson'
+    events = [ json.loads (line) for line in response.data.decode ('utf-8').splitlines () ]
+    assert [ e['event'] for e in events if e['event'] != 'delta' ] == [ 'statement', 'response', 'statement', 'result' ]
+    assert events[1]['nodes'] == 3 and events[1]['elapsed'] is not None
+    delta = events[2]
+    assert delta['event'] == 'delta'
+    assert [ n['id'] for n in delta['nodes'] ] == [ "CHEBI:28177", "NCBIGene:1" ]
+    """ HGNC:1 is folded into NCBIGene:1 before it is sent, so nothing needs remapping. """
+    assert delta['remaps'] == []
+    assert delta['edges'][0]['target_id'] == "NCBIGene:1"
+    result = events[-1]
+    assert 'knowledge_graph' not in result
+    assert result['knowledge_map'][0]['node_bindings']['chemical_substance'] == "CHEBI:28177"
+    assert result['nodes'] == 2
+
+def test_query_stream_remaps(client, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that the merged graph's ids replace those of nodes already streamed under another id. """
+    stream = QueryStream (TranQL ())
+    stream.on_event ("statement", { "status" : "started" })
+    stream.on_event ("response", { "message" : { "knowledge_graph" : {
+        "nodes" : [ { "id" : "HGNC:1", "type" : "gene" }, { "id" : "CHEBI:1", "type" : "chemical_substance" } ],
+        "edges" : []
+    } } })
+    stream.on_event ("merged", { "result" : { "knowledge_graph" : {
+        "nodes" : [
+            { "id" : "NCBIGene:1", "type" : [ "gene" ], "equivalent_identifiers" : [ "NCBIGene:1", "HGNC:1" ] },
+            { "id" : "CHEBI:1", "type" : [ "chemical_substance" ], "equivalent_identifiers" : [ "CHEBI:1" ] },
+            { "id" : "HGNC:2", "type" : [ "gene" ], "equivalent_identifiers" : [ "HGNC:2" ] }
+        ],
+        "edges" : [ { "id" : "e", "source_id" : "CHEBI:1", "target_id" : "NCBIGene:1", "type" : [ "affects" ] } ]
+    } } })
+    events = []
+    while not stream.queue.empty ():
+        events.append (json.loads (stream.queue.get ()[1]))
+    deltas = [ e for e in events if e['event'] == 'delta' ]
+    assert [ n['id'] for n in deltas[0]['nodes'] ] == [ "HGNC:1", "CHEBI:1" ]
+    merged = deltas[1]
+    assert merged['remaps'] == [ { "from" : "HGNC:1", "to" : "NCBIGene:1" } ]
+    assert [ n['id'] for n in merged['nodes'] ] == [ "HGNC:2" ]
+    assert [ (e['source_id'], e['target_id']) for e in merged['edges'] ] == [ ("CHEBI:1", "NCBIGene:1") ]
+
+def test_query_result_store(client, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that stored results are summarized and can be paged through. """
+    requests_mock.post ("http://localhost:8099/graph/gamma/quick", json={
+        "knowledge_graph" : {
+            "nodes" : [
+                { "id" : "CHEBI:28177", "type" : "chemical_substance" },
+                { "id" : "HGNC:1", "type" : "gene" },
+                { "id" : "HGNC:2", "type" : "gene" }
+            ],
+            "edges" : []
+        },
+        "knowledge_map" : [
+            { "node_bindings" : { "chemical_substance" : "CHEBI:28177", "gene" : gene }, "edge_bindings" : {} }
+            for gene in [ "HGNC:1", "HGNC:2" ]
+        ]
+    })
+    response = client.post(
+        '/tranql/query',
+        query_string={ "asynchronous" : False, "store" : True },
+        data="""
+            SELECT chemical_substance->gene
+              FROM "/graph/gamma/quick"
+             WHERE chemical_substance = "CHEBI:28177"
+        """)
+    assert 'knowledge_graph' not in response.json
+    result_id = response.json['result_id']
+    summary = response.json['summary']
+    assert (summary['answers'], summary['nodes'], summary['node_types']['gene']) == (2, 3, 2)
+    assert client.get(f'/tranql/results/{result_id}').json['summary'] == summary
+
+    page = client.get(f'/tranql/results/{result_id}/nodes', query_string={ "type" : "gene", "limit" : 1 }).json
+    assert page['total'] == 2 and [ n['id'] for n in page['items'] ] == [ "HGNC:1" ]
+    page = client.get(f'/tranql/results/{result_id}/nodes', query_string={ "type" : "gene", "cursor" : page['next'] }).json
+    assert [ n['id'] for n in page['items'] ] == [ "HGNC:2" ] and page['next'] is None
+    page = client.get(f'/tranql/results/{result_id}/answers').json
+    assert len(page['items']) == 2
+
+    assert client.get(f'/tranql/results/{result_id}/foo').status_code == 400
+    assert client.get(f'/tranql/results/{result_id}/nodes', query_string={ "cursor" : "?" }).status_code == 400
+    assert client.get('/tranql/results/foo').status_code == 404
+
+
+def test_query_result_export(client):
+    """ Validate that a stored result's answers can be exported whole, as Arrow. """
+    pyarrow = pytest.importorskip ("pyarrow")
+    result_id = result_store.put ({
+        "knowledge_graph" : { "nodes" : [], "edges" : [] },
+        "knowledge_map" : [
+            { "node_bindings" : { "gene" : "HGNC:1" }, "edge_bindings" : {} },
+            { "node_bindings" : { "gene" : "HGNC:2" }, "edge_bindings" : {} }
+        ]
+    })
+    response = client.get(f'/tranql/results/{result_id}/answers', query_string={ "format" : "arrow" })
+    assert response.mimetype == "application/vnd.apache.arrow.stream"
+    table = pyarrow.ipc.open_stream (pyarrow.py_buffer (response.data)).read_all ()
+    assert table.to_pydict () == { "node_bindings.gene" : [ "HGNC:1", "HGNC:2" ] }
+    response = client.get(f'/tranql/results/{result_id}/answers', query_string={ "format" : "parquet" })
+    assert response.mimetype == "application/vnd.apache.parquet"
+    assert client.get(f'/tranql/results/{result_id}/nodes', query_string={ "format" : "arrow" }).status_code == 400
+
 # def test_root (client):
     # assert client.get('/').status_code == 200
 
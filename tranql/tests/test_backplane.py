@@ -2,7 +2,7 @@ import pytest
 import json
 from tranql.tests.util import assert_lists_equal, set_mock, ordered
 from tranql.backplane.server import api, app
-from tranql.backplane.server import RtxQuery
+from tranql.backplane.server import RtxQuery, StandardAPIResource
 
 @pytest.fixture
 def client():
@@ -117,3 +117,20 @@ def test_rtx_convert_curies(client):
 #         data=json.dumps()
 #         content_type='application/json'
 #     )
+
+def test_response_projection(client):
+    """ Validate that the backplane drops attributes outside the caller's projection. """
+    message = {
+        "knowledge_graph" : {
+            "nodes" : [ { "id" : "HGNC:1", "name" : "gene 1", "synonyms" : [ "g1" ] } ],
+            "edges" : [ { "id" : "e0", "source_id" : "HGNC:1", "target_id" : "HGNC:1", "publications" : [ "PMID:1" ], "p_val" : 0.1 } ]
+        },
+        "knowledge_map" : []
+    }
+    with app.test_request_context (headers={ "X-TranQL-Projection" : "edge.p_val" }):
+        data, status = StandardAPIResource.response (json.loads (json.dumps (message)))
+    assert status == 200
+    assert data['knowledge_graph']['nodes'] == [ { "id" : "HGNC:1", "name" : "gene 1" } ]
+    assert data['knowledge_graph']['edges'] == [ { "id" : "e0", "source_id" : "HGNC:1", "target_id" : "HGNC:1", "p_val" : 0.1 } ]
+    with app.test_request_context ():
+        assert StandardAPIResource.response (json.loads (json.dumps (message))) == (message, 200)
@@ -1,13 +1,31 @@
+import asyncio
+import io
 import json
 import pytest
 import os
 import itertools
+import socket
+import threading
+import time
 import requests
+import requests_cache
+import urllib.parse
+from aiohttp import web
 from pprint import pprint
 from deepdiff import DeepDiff
 from tranql.main import TranQL
 from tranql.main import TranQLParser, set_verbose
-from tranql.tranql_ast import SetStatement, SelectStatement
+from tranql.util import Concept, PatternMatcher, JSONKit
+from tranql.tranql_ast import SetStatement, SelectStatement, CreateGraphStatement
+from tranql.merge import IncrementalMerger, PartitionedMerger
+from tranql.jobs import Job
+from tranql.cache import program_cache, subgraph_cache, statement_memo, TTLCache
+from tranql.answer_table import AnswerTable, Vocabulary
+from tranql.message_parser import Projection, MessageBuilder, parse_message, streaming
+from tranql.name_resolver import NameResolver
+from tranql.request_util import RequestPolicy, RetryBudget, CircuitBreaker, breakers
+from tranql.exception import TranQLException, RequestTimeoutError, ServiceUnavailableError
+from tranql.exception import ServiceInvocationError, UnableToGenerateQuestionError
 from tranql.tests.util import assert_lists_equal, set_mock, ordered
 from tranql.tests.mocks import MockHelper
 from tranql.tests.mocks import MockMap
@@ -324,13 +342,66 @@ def test_ast_decorate_element (requests_mock):
 
     assert_lists_equal(edge["reasoner"],["robokop"])
     assert_lists_equal(edge["source_database"],["unknown"])
-def test_ast_resolve_name (requests_mock):
-    set_mock(requests_mock, "resolve_name")
+@pytest.fixture
+def name_services ():
+    """
+    Bionames and MyChem, served locally by aiohttp from mock responses, as the resolver requests them. Yields a
+    NameResolver using them and the Bionames paths and MyChem queries it requested. Bionames doesn't know "unknown"
+    and fails on "broken".
+    """
+    helper = MockHelper ()
+    requested = []
+    async def bionames (request):
+        requested.append (request.raw_path)
+        name = urllib.parse.unquote (request.match_info['input'])
+        if name == "ibuprofen":
+            return web.json_response (helper.get_obj ("bionames_ibuprofen_chemical_substance.json"))
+        if name == "ibuprofen/advil 200":
+            return web.json_response ([ { "id" : "CHEBI:5855", "label" : "ibuprofen" } ])
+        if name == "broken":
+            return web.Response (status=500)
+        return web.Response (status=404)
+    async def mychem (request):
+        name = urllib.parse.parse_qs (urllib.parse.urlsplit (request.raw_path).query)['q'][0]
+        requested.append (f"mychem {name}")
+        if name == "ibuprofen":
+            return web.json_response (helper.get_obj ("mychem_ibuprofen.json"))
+        return web.json_response ({ "total" : 0, "hits" : [] })
+    sock = socket.socket ()
+    sock.bind (("127.0.0.1", 0))
+    port = sock.getsockname ()[1]
+    loop = asyncio.new_event_loop ()
+    app = web.Application ()
+    app.router.add_get ("/lookup/{input}/{type}/", bionames)
+    app.router.add_get ("/v1/query", mychem)
+    runner = web.AppRunner (app)
+    listening = threading.Event ()
+    def serve ():
+        asyncio.set_event_loop (loop)
+        loop.run_until_complete (runner.setup ())
+        loop.run_until_complete (web.SockSite (runner, sock).start ())
+        listening.set ()
+        loop.run_forever ()
+    server = threading.Thread (target=serve, daemon=True)
+    server.start ()
+    listening.wait ()
+    class Resolver(NameResolver):
+        bionames_url = f"http://127.0.0.1:{port}/lookup/{{input}}/{{type}}/"
+        mychem_url = f"http://127.0.0.1:{port}/v1/query?q={{input}}"
+    yield Resolver (cache=TTLCache ()), requested
+    """ Forget the failures the services' circuit breakers saw. """
+    breakers.reset ()
+    asyncio.run_coroutine_threadsafe (runner.cleanup (), loop).result ()
+    loop.call_soon_threadsafe (loop.stop)
+    server.join ()
+
+def test_ast_resolve_name (name_services):
     """ Validate that
             -- The SelectStatement::resolve_name method will correctly retrieve equivalent identifiers from a given name
     """
     print("test_ast_resolve_name ()")
-    assert_lists_equal(SelectStatement.resolve_name("ibuprofen","chemical_substance"),[
+    resolver, requested = name_services
+    assert_lists_equal(SelectStatement.resolve_name("ibuprofen","chemical_substance",resolver=resolver),[
         'CHEBI:132922',
         'CHEBI:5855',
         'CHEBI:43415',
@@ -857,6 +928,194 @@ def test_ast_bidirectional_query (requests_mock):
         assert nodes[0]['curie'] == chemical
         assert node_index[edges[-1]['target_id']] == node_index[edges[-1]['source_id']] - 1
 
+def test_ast_create_graph (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that publishing a graph runs in the background and binds a pollable job handle. """
+    print ("test_ast_create_graph ()")
+    release = threading.Event ()
+    def respond (request, context):
+        release.wait (timeout=10)
+        return { "published" : request.json()['knowledge_graph']['nodes'][0]['id'] }
+    requests_mock.post ("http://localhost:8099/visualize/ndex", json=respond)
+    tranql = TranQL ()
+    tranql.context.set ("graph", {
+        "knowledge_graph" : { "nodes" : [ { "id" : "x:y" } ], "edges" : [] }
+    })
+    statement = CreateGraphStatement (graph="$graph", service="/visualize/ndex", name="publication")
+    job = statement.execute (tranql)
+    assert tranql.context.resolve_arg ("$publication") is job
+    assert job.status in [ Job.PENDING, Job.RUNNING ]
+    release.set ()
+    assert job.result (timeout=10) == { "published" : "x:y" }
+    assert job.status == Job.DONE
+    assert job.to_dict ()['result'] == { "published" : "x:y" }
+
+    """ Publications are never cached, and leave the cache queries use installed. """
+    requests_cache.install_cache ('test_ast_create_graph', backend='memory', allowable_methods=('POST', ))
+    try:
+        calls = requests_mock.call_count
+        for publication in [ statement.execute (tranql), statement.execute (tranql) ]:
+            assert publication.result (timeout=10) == { "published" : "x:y" }
+        assert requests_mock.call_count == calls + 2
+        assert statement.caching_responses ()
+    finally:
+        requests_cache.uninstall_cache ()
+
+def test_ast_timeout_constraint (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that a timeout constraint bounds the statement's deadline and is not passed to the service. """
+    print ("test_ast_timeout_constraint ()")
+    tranql = TranQL (options = { "timeout" : 60 })
+    ast = tranql.parse ("""
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = "CHEBI:28177"
+           AND timeout = 5
+    """)
+    select = ast.statements[0]
+    questions = select.generate_questions (tranql)
+    assert 'timeout' not in questions[0]['options']
+    deadline = select.get_deadline (tranql)
+    assert deadline.remaining () <= 5
+    tranql.cancel ()
+    assert deadline.expired ()
+    """ A statement executed again gets a deadline of its own, from the interpreter executing it. """
+    assert not select.get_deadline (TranQL (options = { "timeout" : 60 })).expired ()
+
+def test_ast_request_retry (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that transient failures are retried within the query's retry budget. """
+    print ("test_ast_request_retry ()")
+    url = "http://localhost:8099/graph/flaky"
+    requests_mock.post (url, [
+        { "status_code" : 503, "text" : "unavailable" },
+        { "status_code" : 200, "json" : { "knowledge_graph" : {} } }
+    ])
+    statement = SetStatement (variable="x")
+    policy = RequestPolicy (retries=2, backoff=0)
+    budget = RetryBudget (1)
+    assert statement.request (url, {}, policy=policy, budget=budget) == { "knowledge_graph" : {} }
+    assert budget.remaining == 0
+    """ Without budget left, failures are not retried. """
+    requests_mock.post (url, [
+        { "status_code" : 503, "text" : "unavailable" },
+        { "status_code" : 200, "json" : { "knowledge_graph" : {} } }
+    ])
+    assert statement.request (url, {}, policy=policy, budget=budget) == {}
+    """ Nor are errors that are not transient. """
+    requests_mock.post (url, [
+        { "status_code" : 500, "text" : "error" },
+        { "status_code" : 200, "json" : { "knowledge_graph" : {} } }
+    ])
+    assert statement.request (url, {}, policy=policy, budget=RetryBudget (1)) == {}
+
+def test_retry_budget_threads (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that sources spending a budget on separate threads never overspend it, and that progress adds up. """
+    print ("test_retry_budget_threads ()")
+    budget = RetryBudget (1000)
+    tranql = TranQL ()
+    tranql.progress = tranql.empty_progress ()
+    spent = []
+    def spend ():
+        for i in range(500):
+            if budget.spend ():
+                spent.append (i)
+            tranql.track ('questions', started=1, done=1)
+    threads = [ threading.Thread (target=spend) for i in range(4) ]
+    for thread in threads:
+        thread.start ()
+    for thread in threads:
+        thread.join ()
+    assert len(spent) == 1000
+    assert budget.remaining == 0
+    assert tranql.get_progress ()['questions'] == { "done" : 2000, "total" : 2000, "in_flight" : 0 }
+
+def test_ast_request_cached (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that responses are projected, and not streamed, when requests_cache stores them. """
+    print ("test_ast_request_cached ()")
+    url = "http://localhost:8099/graph/cached"
+    requests_mock.post (url, json={
+        "knowledge_graph" : { "nodes" : [ { "id" : "HGNC:1", "type" : "gene", "synonyms" : [ "x" ] } ], "edges" : [] }
+    })
+    projection = Projection.from_config ("node.description")
+    expected = { "knowledge_graph" : { "nodes" : [ { "id" : "HGNC:1", "type" : "gene" } ], "edges" : [] } }
+    statement = SetStatement (variable="x")
+    """ Without a cache, the response is parsed as it is read. """
+    assert streaming () and not statement.caching_responses ()
+    assert statement.request_once (url, {}, projection=projection) == (expected, False, [])
+    requests_cache.install_cache ('test_ast_request_cached', backend='memory', allowable_methods=('POST', ))
+    try:
+        assert statement.caching_responses ()
+        assert statement.request_once (url, {}, projection=projection) == (expected, False, [])
+        """ The second is read from the cache. """
+        assert statement.request_once (url, {}, projection=projection) == (expected, False, [])
+        assert requests_mock.call_count == 2
+    finally:
+        requests_cache.uninstall_cache ()
+    assert not statement.caching_responses ()
+
+def test_ast_circuit_breaker (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that failing reasoners are routed around, and fail fast when there is no alternative. """
+    print ("test_ast_circuit_breaker ()")
+    breaker = CircuitBreaker ("flaky", min_requests=2, reset_timeout=0)
+    breaker.record (True)
+    breaker.record (False)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    """ A half open breaker admits one probe, whose success closes it. """
+    assert breaker.allow () and not breaker.allow ()
+    breaker.record (True)
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow ()
+
+    tranql = TranQL ()
+    tranql.resolve_names = False
+    ast = tranql.parse ("""
+        SELECT cohort_diagnosis:disease->diagnoses:disease
+          FROM '/schema'
+         WHERE cohort_diagnosis = 'MONDO:0004979'
+    """)
+    select = ast.statements[0]
+    breakers.reset ()
+    try:
+        for name in [ "robokop", "rtx" ]:
+            breakers.get (name, { "min_requests" : 1, "reset_timeout" : 60 }).record (False)
+            assert breakers.is_open (name)
+        with pytest.raises (ServiceUnavailableError):
+            select.planner.plan (select.query)
+        breakers.get ("rtx").reset ()
+        plan = select.planner.plan (select.query)
+        assert [ segment[0] for segment in plan ] == [ "rtx" ]
+        """ Queries sent directly to a failing reasoner fail without sending questions. """
+        gamma = tranql.parse ("""
+            SELECT disease->gene
+              FROM "/graph/gamma/quick"
+             WHERE disease = "MONDO:0004979"
+        """).statements[0]
+        requests_mock.reset_mock ()
+        with pytest.raises (ServiceUnavailableError):
+            gamma.execute (tranql)
+        assert not any ([ "gamma" in r.url for r in requests_mock.request_history ])
+    finally:
+        breakers.reset ()
+
+def test_ast_circuit_breaker_empty_responses (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that a reasoner answering with nothing is healthy, while one returning errors is not. """
+    print ("test_ast_circuit_breaker_empty_responses ()")
+    url = "http://localhost:8099/graph/empty"
+    requests_mock.post (url, json={})
+    statement = SetStatement (variable="x")
+    breaker = CircuitBreaker ("empty", min_requests=2, reset_timeout=60)
+    for attempt in range(3):
+        assert statement.request (url, {}, breaker=breaker) == {}
+    assert breaker.state == CircuitBreaker.CLOSED
+    requests_mock.post (url, status_code=500, text="error")
+    for attempt in range(3):
+        statement.request (url, {}, breaker=breaker)
+    assert breaker.state == CircuitBreaker.OPEN
+
 #####################################################
 #
 # Interpreter tests. Test the interpreter interface.
@@ -926,3 +1185,827 @@ def test_program (requests_mock):
     kg = tranql.context.resolve_arg("$knowledge_graph")
     assert kg['knowledge_graph']['nodes'][0]['id'] == "CHEBI:28177"
     assert kg['knowledge_map'][0]['node_bindings']['chemical_substance'] == "CHEBI:28177"
+
+def test_interpreter_deadline (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that a query whose deadline passes stops asking questions and reports a timeout. """
+    print ("test_interpreter_deadline ()")
+    tranql = TranQL (options = {
+        "asynchronous" : False,
+        "timeout" : 0
+    })
+    with pytest.raises (RequestTimeoutError):
+        tranql.execute ("""
+            SELECT chemical_substance->gene
+              FROM "/graph/gamma/quick"
+             WHERE chemical_substance = "CHEBI:28177"
+        """)
+    assert requests_mock.request_history[-1].url != "http://localhost:8099/graph/gamma/quick"
+
+def test_interpreter_partial_results (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that, in partial result mode, a query whose deadline passes returns what it has merged
+    and records what is missing. """
+    print ("test_interpreter_partial_results ()")
+    gamma_response = MockHelper ().get_obj_text ("gamma_quick.json")
+    def slow_response (request, context):
+        time.sleep (0.5)
+        return gamma_response
+    requests_mock.post ("http://localhost:8099/graph/gamma/quick", text=slow_response)
+    tranql = TranQL (options = {
+        "asynchronous" : False,
+        "partial_results" : True,
+        "timeout" : 0.25
+    })
+    tranql.context.set ("chemicals", [ "CHEBI:28177", "CHEBI:15365" ])
+    context = tranql.execute ("""
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = $chemicals
+
+        SELECT gene->disease
+          FROM "/graph/gamma/quick"
+         WHERE gene = "HGNC:2597"
+    """)
+    result = context.resolve_arg ("$result")
+    assert len(result['knowledge_graph']['nodes']) > 0
+    completeness = context.resolve_arg ("$completeness")
+    assert not completeness['complete']
+    assert len(completeness['missing_questions']) == 1
+    assert completeness['missing_questions'][0]['question_graph']['nodes'][0]['curie'] == "CHEBI:15365"
+    assert len(completeness['skipped_statements']) == 1
+
+def test_interpreter_program_cache (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that identical programs share results, including concurrent executions of them. """
+    print ("test_interpreter_program_cache ()")
+    release = threading.Event ()
+    calls = []
+    def respond (request, context):
+        calls.append (request)
+        release.wait (timeout=10)
+        return {
+            "knowledge_graph" : { "nodes" : [ { "id" : "CHEBI:28177", "type" : "chemical_substance" } ], "edges" : [] },
+            "knowledge_map" : [ { "node_bindings" : { "chemical_substance" : "CHEBI:28177" }, "edge_bindings" : {} } ]
+        }
+    requests_mock.post ("http://localhost:8099/graph/gamma/quick", json=respond)
+    program = """
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = $chemical
+    """
+    options = { "program_cache" : True, "asynchronous" : False }
+    def interpreter ():
+        tranql = TranQL (options = options)
+        tranql.context.set ('chemical', "CHEBI:28177")
+        return tranql
+    tranql = interpreter ()
+    """ Fingerprints ignore formatting but not the values of the variables programs read. """
+    assert tranql.fingerprint (program) == tranql.fingerprint ("""
+        -- The same program.
+        select chemical_substance->gene from '/graph/gamma/quick' where chemical_substance = $chemical
+    """)
+    other = interpreter ()
+    other.context.set ('chemical', "CHEBI:0")
+    assert tranql.fingerprint (program) != other.fingerprint (program)
+
+    program_cache.clear ()
+    try:
+        interpreters = [ interpreter () for i in range(3) ]
+        threads = [ threading.Thread (target=i.execute, args=(program,)) for i in interpreters[:2] ]
+        [ thread.start () for thread in threads ]
+        time.sleep (0.5)
+        release.set ()
+        [ thread.join (timeout=10) for thread in threads ]
+        interpreters[2].execute (program)
+        assert len(calls) == 1
+        results = [ i.context.resolve_arg ('$result') for i in interpreters ]
+        assert all ([ r['knowledge_map'] == results[0]['knowledge_map'] for r in results ])
+        assert results[0] is not results[1] and results[1] is not results[2]
+    finally:
+        program_cache.clear ()
+
+def test_interpreter_subgraph_cache (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that questions sharing a hop with earlier questions, or narrowing it, are answered locally. """
+    print ("test_interpreter_subgraph_cache ()")
+    calls = []
+    def respond (request, context):
+        calls.append (request)
+        return {
+            "knowledge_graph" : {
+                "nodes" : [
+                    { "id" : "CHEBI:28177", "type" : "chemical_substance" },
+                    { "id" : "HGNC:1", "type" : "gene" },
+                    { "id" : "UniProtKB:1", "type" : "protein" }
+                ],
+                "edges" : [
+                    { "id" : "e1", "source_id" : "CHEBI:28177", "target_id" : "HGNC:1", "type" : "affects" },
+                    { "id" : "e2", "source_id" : "CHEBI:28177", "target_id" : "UniProtKB:1", "type" : "affects" }
+                ]
+            },
+            "knowledge_map" : [
+                { "node_bindings" : { "chemical_substance" : "CHEBI:28177", "gene" : "HGNC:1" },
+                  "edge_bindings" : { "e0" : [ "e1" ] } },
+                { "node_bindings" : { "chemical_substance" : "CHEBI:28177", "gene" : "UniProtKB:1" },
+                  "edge_bindings" : { "e0" : [ "e2" ] } }
+            ]
+        }
+    requests_mock.post ("http://localhost:8099/graph/gamma/quick", json=respond)
+    program = """
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = "CHEBI:28177"
+    """
+    def execute ():
+        tranql = TranQL (options = { "subgraph_cache" : True, "asynchronous" : False })
+        tranql.execute (program)
+        return tranql.context.resolve_arg ('$result')
+
+    subgraph_cache.clear ()
+    try:
+        first = execute ()
+        second = execute ()
+        assert len(calls) == 1
+        assert ordered (first['knowledge_map']) == ordered (second['knowledge_map'])
+
+        """ A question for a narrower type is answered from the broader hop's nodes of that type. """
+        def question (target):
+            return {
+                "question_graph" : {
+                    "nodes" : [
+                        { "id" : "drug", "type" : "chemical_substance", "curie" : "CHEBI:28177" },
+                        { "id" : "target", "type" : target }
+                    ],
+                    "edges" : [ { "id" : "e0", "source_id" : "drug", "target_id" : "target" } ]
+                }
+            }
+        subgraph_cache.store ("robokop", question ("genomic_entity"), {
+            "knowledge_graph" : respond (None, None)['knowledge_graph'],
+            "knowledge_map" : [
+                { "node_bindings" : { "drug" : "CHEBI:28177", "target" : id }, "edge_bindings" : { "e0" : [ edge ] } }
+                for id, edge in [ ("HGNC:1", "e1"), ("UniProtKB:1", "e2") ]
+            ]
+        })
+        assert subgraph_cache.lookup ("robokop", question ("gene")) is None
+        genes = subgraph_cache.lookup ("robokop", question ("gene"), SelectStatement.broader_types)
+        assert [ a['node_bindings']['target'] for a in genes['knowledge_map'] ] == [ "HGNC:1" ]
+        assert sorted ([ n['id'] for n in genes['knowledge_graph']['nodes'] ]) == [ "CHEBI:28177", "HGNC:1" ]
+        assert [ e['id'] for e in genes['knowledge_graph']['edges'] ] == [ "e1" ]
+    finally:
+        subgraph_cache.clear ()
+
+def test_interpreter_statement_memo (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that editing a program re-runs only the statements affected by the edit. """
+    print ("test_interpreter_statement_memo ()")
+    calls = []
+    def respond (request, context):
+        calls.append (request)
+        return {
+            "knowledge_graph" : { "nodes" : [ { "id" : "CHEBI:28177", "type" : "chemical_substance" } ], "edges" : [] },
+            "knowledge_map" : [ { "node_bindings" : { "chemical_substance" : "CHEBI:28177" }, "edge_bindings" : {} } ]
+        }
+    requests_mock.post ("http://localhost:8099/graph/gamma/quick", json=respond)
+    genes = """
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = $chemical
+           SET genes
+    """
+    diseases = """
+        SELECT chemical_substance->disease
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = $chemical
+    """
+    tranql = TranQL (options = { "statement_memo" : True, "asynchronous" : False })
+    tranql.context.set ('chemical', "CHEBI:28177")
+    statement_memo.clear ()
+    try:
+        tranql.execute (genes)
+        assert len(calls) == 1
+        first = tranql.context.resolve_arg ('$genes')
+        tranql.context.set ('genes', None)
+
+        """ The unchanged statement and its SET binding are reused. Only the new statement runs. """
+        tranql.execute (genes + diseases)
+        assert len(calls) == 2
+        assert tranql.context.resolve_arg ('$genes') == first
+
+        """ Changing a variable a statement reads runs it again. """
+        tranql.context.set ('chemical', "CHEBI:0")
+        tranql.execute (genes)
+        assert len(calls) == 3
+    finally:
+        statement_memo.clear ()
+
+def test_interpreter_shared_questions (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that a question asked by several statements of a program is asked once. """
+    print ("test_interpreter_shared_questions ()")
+    calls = []
+    def respond (request, context):
+        calls.append (request)
+        return {
+            "knowledge_graph" : { "nodes" : [ { "id" : "CHEBI:28177", "type" : "chemical_substance" } ], "edges" : [] },
+            "knowledge_map" : [ { "node_bindings" : { "chemical_substance" : "CHEBI:28177" }, "edge_bindings" : {} } ]
+        }
+    requests_mock.post ("http://localhost:8099/graph/gamma/quick", json=respond)
+    tranql = TranQL (options = { "asynchronous" : False })
+    tranql.execute ("""
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = "CHEBI:28177"
+           SET first
+
+        SELECT chemical_substance->gene
+          FROM '/graph/gamma/quick'
+         WHERE chemical_substance = "CHEBI:28177"
+           SET second
+    """)
+    assert len(calls) == 1
+    first = tranql.context.resolve_arg ('$first')
+    second = tranql.context.resolve_arg ('$second')
+    assert first['knowledge_map'] == second['knowledge_map']
+    assert first is not second
+
+    """ Programs don't share responses. """
+    tranql.execute ("""
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = "CHEBI:28177"
+    """)
+    assert len(calls) == 2
+    """ Responses no later statement could ask for aren't kept. """
+    assert tranql.shared_responses == {}
+
+def test_ast_multiple_sources (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that a statement with several services asks them all concurrently and merges their answers. """
+    print ("test_ast_multiple_sources ()")
+    threads = set ()
+    def respond (gene):
+        def respond (request, context):
+            threads.add (threading.current_thread ().name)
+            return {
+                "knowledge_graph" : {
+                    "nodes" : [
+                        { "id" : "CHEBI:28177", "type" : "chemical_substance" },
+                        { "id" : gene, "type" : "gene" }
+                    ],
+                    "edges" : [ { "id" : gene, "source_id" : "CHEBI:28177", "target_id" : gene, "type" : "affects" } ]
+                },
+                "knowledge_map" : [
+                    { "node_bindings" : { "chemical_substance" : "CHEBI:28177", "gene" : gene },
+                      "edge_bindings" : { "e0" : [ gene ] } }
+                ]
+            }
+        return respond
+    requests_mock.post ("http://localhost:8099/graph/gamma/quick", json=respond ("HGNC:1"))
+    requests_mock.post ("http://localhost:8099/graph/rtx", json=respond ("HGNC:2"))
+    requests_mock.post ("http://localhost:8099/graph/unknown", status_code=404)
+    tranql = TranQL (options = { "asynchronous" : False })
+    tranql.execute ("""
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick", "/graph/rtx", "/graph/unknown"
+         WHERE chemical_substance = "CHEBI:28177"
+    """)
+    """ The mock serializes requests, so check each service was asked from its own worker. """
+    assert len(threads) == 2 and all ([ t.startswith ("tranql-sources") for t in threads ])
+    result = tranql.context.resolve_arg ('$result')
+    assert sorted ([ a['node_bindings']['gene'] for a in result['knowledge_map'] ]) == [ "HGNC:1", "HGNC:2" ]
+    reasoners = { n['id'] : n['reasoner'] for n in result['knowledge_graph']['nodes'] }
+    assert reasoners['HGNC:1'] == [ "robokop" ] and reasoners['HGNC:2'] == [ "rtx" ]
+    assert len(tranql.context.resolve_arg ('$requestErrors')) == 1
+
+def test_parse_select_limit (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Verify the token stream of a select statement with a limit. """
+    print (f"test_parse_select_limit()")
+    assert_parse_tree (
+        code = """
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = $chemical
+         LIMIT 10
+           SET genes """,
+        expected = [
+            [["select", "chemical_substance", "->", "gene", "\n"],
+             "          ",
+             ["from", ["/graph/gamma/quick"]],
+             ["where", ["chemical_substance", "=", "$chemical"]],
+             ["limit", 10],
+             "\n",
+             "           ",
+             ["set", ["genes"]]]
+        ])
+
+def test_ast_limit (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that a limit is pushed down to reasoners and stops questions once enough answers are in. """
+    print ("test_ast_limit ()")
+    questions = []
+    def respond (request, context):
+        question = request.json ()
+        questions.append (question)
+        chemical = question['question_graph']['nodes'][0]['curie']
+        return {
+            "knowledge_graph" : {
+                "nodes" : [
+                    { "id" : chemical, "type" : "chemical_substance" },
+                    { "id" : "HGNC:1", "type" : "gene" },
+                    { "id" : "HGNC:2", "type" : "gene" }
+                ],
+                "edges" : [
+                    { "id" : f"{chemical}-1", "source_id" : chemical, "target_id" : "HGNC:1", "type" : "affects" },
+                    { "id" : f"{chemical}-2", "source_id" : chemical, "target_id" : "HGNC:2", "type" : "affects" }
+                ]
+            },
+            "knowledge_map" : [
+                { "node_bindings" : { "chemical_substance" : chemical, "gene" : gene },
+                  "edge_bindings" : { "e1" : [ f"{chemical}-{gene[-1]}" ] } }
+                for gene in [ "HGNC:1", "HGNC:2" ]
+            ]
+        }
+    requests_mock.post ("http://localhost:8099/graph/gamma/quick", json=respond)
+    tranql = TranQL (options = { "asynchronous" : False })
+    tranql.context.set ('chemicals', [ "CHEBI:1", "CHEBI:2", "CHEBI:3" ])
+    tranql.context.set ('n', 2)
+    query = """
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = $chemicals
+         LIMIT $n
+    """
+    tranql.execute (query)
+    """ The first question brings enough answers. """
+    assert len(questions) == 1
+    assert questions[0]['options']['max_results'] == [ "=", 2 ]
+    result = tranql.context.resolve_arg ('$result')
+    assert len(result['knowledge_map']) == 2
+
+    questions.clear ()
+    tranql.execute ("""
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = $chemicals
+         LIMIT 3
+    """)
+    assert len(questions) == 2
+    result = tranql.context.resolve_arg ('$result')
+    assert len(result['knowledge_map']) == 3
+    bound = set ([ v for a in result['knowledge_map'] for v in a['node_bindings'].values () ])
+    assert set ([ n['id'] for n in result['knowledge_graph']['nodes'] ]) == bound
+    assert all ([ e['source_id'] in bound and e['target_id'] in bound for e in result['knowledge_graph']['edges'] ])
+
+    """ A limit of zero asks nothing and returns no answers. """
+    questions.clear ()
+    tranql.context.set ('n', 0)
+    tranql.execute (query)
+    assert len(questions) == 0
+    result = tranql.context.resolve_arg ('$result')
+    assert result['knowledge_map'] == []
+    assert result['knowledge_graph'] == { "nodes" : [], "edges" : [] }
+
+    """ A negative limit is an error. """
+    tranql.context.set ('n', -1)
+    with pytest.raises (TranQLException):
+        tranql.execute (query)
+    assert len(questions) == 0
+
+def test_ast_attribute_filters (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that constraints on node and edge attributes filter the merged answers instead of going to the reasoner. """
+    print ("test_ast_attribute_filters ()")
+    questions = []
+    def respond (request, context):
+        questions.append (request.json ())
+        genes = [
+            ("HGNC:1", 0.9, [ "PMID:1", "PMID:2" ], "A"),
+            ("HGNC:2", 0.2, [ "PMID:3", "PMID:4" ], "B"),
+            ("HGNC:3", 0.8, [ "PMID:5" ], "C"),
+            ("HGNC:4", 0.7, [ "PMID:6", "PMID:7" ], "excluded"),
+            ("HGNC:5", None, [ "PMID:8", "PMID:9" ], "E")
+        ]
+        edges = []
+        for gene, weight, publications, name in genes:
+            edge = { "id" : f"e-{gene}", "source_id" : "CHEBI:28177", "target_id" : gene,
+                     "type" : "affects", "publications" : publications }
+            if weight is not None:
+                edge['weight'] = weight
+            edges.append (edge)
+        return {
+            "knowledge_graph" : {
+                "nodes" : [ { "id" : "CHEBI:28177", "type" : "chemical_substance", "name" : "chemical" } ] + [
+                    { "id" : gene, "type" : "gene", "name" : name } for gene, weight, publications, name in genes
+                ],
+                "edges" : edges
+            },
+            "knowledge_map" : [
+                { "node_bindings" : { "chemical_substance" : "CHEBI:28177", "gene" : gene },
+                  "edge_bindings" : { "e1" : [ f"e-{gene}" ] } }
+                for gene, weight, publications, name in genes
+            ]
+        }
+    requests_mock.post ("http://localhost:8099/graph/gamma/quick", json=respond)
+    tranql = TranQL (options = { "asynchronous" : False })
+    tranql.context.set ('min_weight', 0.5)
+    tranql.execute ("""
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = "CHEBI:28177"
+           AND edge.weight >= $min_weight
+           AND edge.publications > 1
+           AND node.name != "excluded"
+    """)
+    assert not any ([ k.startswith ("edge.") or k.startswith ("node.") for k in questions[0]['options'] ])
+    result = tranql.context.resolve_arg ('$result')
+    assert [ a['node_bindings']['gene'] for a in result['knowledge_map'] ] == [ "HGNC:1" ]
+    assert sorted ([ n['id'] for n in result['knowledge_graph']['nodes'] ]) == [ "CHEBI:28177", "HGNC:1" ]
+    assert [ e['target_id'] for e in result['knowledge_graph']['edges'] ] == [ "HGNC:1" ]
+
+def test_concept_patterns ():
+    """ Validate that compiled include and exclude patterns match as re.search would. """
+    print ("test_concept_patterns ()")
+    chemical = Concept (name="chemical_substance", type_name="chemical_substance")
+    chemical.include_patterns.append ("CHEBI:")
+    chemical.include_patterns.append ("^mesh:")
+    chemical.exclude_patterns.append ("CHEBI:1[0-9]+$")
+    chemical.set_nodes ([ "CHEBI:1", "chebi:15", "MESH:D1", "XMESH:D2", { "id" : "CHEBI:2" }, { "curie" : "PUBCHEM:CHEBI:3" } ])
+    assert chemical.nodes == [ "CHEBI:1", "MESH:D1", { "id" : "CHEBI:2" }, { "curie" : "PUBCHEM:CHEBI:3" } ]
+    """ Each concept has its own patterns. """
+    assert Concept (name="gene", type_name="gene").include_patterns == []
+
+    assert PatternMatcher.compile (("a(b)c", "x(y)z")).matches ("XYZ")
+    excluded = PatternMatcher.for_prefixes ([ "SCTID", "CAS" ])
+    assert [ c for c in [ "sctid:1", "CAS:2", "CHEBI:CAS:3", "CASE:4" ] if not excluded.matches (c) ] == [ "CHEBI:CAS:3", "CASE:4" ]
+
+def test_jsonkit_select ():
+    """ Validate that selecting answer bindings without jsonpath gives what jsonpath gives. """
+    print ("test_jsonkit_select ()")
+    from jsonpath_rw import parse
+    message = {
+        "knowledge_map" : [
+            { "node_bindings" : { "gene" : "HGNC:1", "disease" : [ "MONDO:1", "MONDO:2" ] } },
+            [ { "node_bindings" : { "gene" : "HGNC:2" } } ],
+            { "node_bindings" : { "disease" : "MONDO:3" } },
+            { "edge_bindings" : {} }
+        ],
+        "knowledge_graph" : { "nodes" : [ { "id" : "HGNC:1", "type" : "gene" }, { "id" : "MONDO:1", "type" : "disease" } ] }
+    }
+    jsonkit = JSONKit ()
+    for query in [
+            "$.knowledge_map.[*].[*].node_bindings.gene",
+            "$.knowledge_map.[*].node_bindings.gene",
+            "$.knowledge_map[*].node_bindings.disease",
+            "$.answers.[*].node_bindings.gene",
+            "$.knowledge_graph.nodes.[*]" ]:
+        assert jsonkit.select (query, message) == [ m.value for m in parse (query).find (message) ]
+    assert jsonkit.select ("$.knowledge_graph.nodes.[*]", message, target=[ "gene" ]) == [ { "id" : "HGNC:1", "type" : "gene" } ]
+
+def test_ast_handoff_values (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Validate that handoff values are canonicalized as merging the segments' responses would. """
+    print ("test_ast_handoff_values ()")
+    tranql = TranQL ()
+    first = {
+        "knowledge_graph" : { "nodes" : [
+            { "id" : "MONDO:1", "type" : "disease", "name" : "asthma" },
+            { "id" : "HGNC:1", "type" : "gene", "name" : "a", "equivalent_identifiers" : [ "NCBIGene:1" ] }
+        ], "edges" : [] },
+        "knowledge_map" : [ { "node_bindings" : { "disease" : "MONDO:1", "gene" : "HGNC:1" }, "edge_bindings" : {} } ]
+    }
+    second = {
+        "knowledge_graph" : { "nodes" : [
+            { "id" : "DOID:1", "type" : "disease", "name" : "asthma" },
+            { "id" : "NCBIGene:1", "type" : "gene" },
+            { "id" : "NCBIGene:2", "type" : "gene" }
+        ], "edges" : [] },
+        "knowledge_map" : [
+            { "node_bindings" : { "disease" : "DOID:1", "gene" : "NCBIGene:1" }, "edge_bindings" : {} },
+            { "node_bindings" : { "disease" : "DOID:1", "gene" : [ "NCBIGene:2" ] }, "edge_bindings" : {} }
+        ]
+    }
+    merger = IncrementalMerger ()
+    for response in [ first, second ]:
+        merger.add (response)
+    values = SelectStatement.handoff_values ([ second ], "gene", merger.canonical)
+    assert values == [ "HGNC:1", "NCBIGene:2" ]
+    assert SelectStatement.handoff_values ([ second ], "disease", merger.canonical) == [ "MONDO:1", "MONDO:1" ]
+    merged = merger.snapshot ({})
+    assert sorted ([ n['id'] for n in merged['knowledge_graph']['nodes'] ]) == [ "HGNC:1", "MONDO:1", "NCBIGene:2" ]
+
+def test_incremental_merger ():
+    """ Validate that responses merged one at a time merge as they would all at once, and that deltas report what is new. """
+    print ("test_incremental_merger ()")
+    def responses ():
+        return [
+            {
+                "knowledge_graph" : {
+                    "nodes" : [
+                        { "id" : "CHEBI:1", "type" : "chemical_substance", "name" : "aspirin" },
+                        { "id" : "HGNC:1", "type" : "gene", "equivalent_identifiers" : [ "NCBIGene:1" ] }
+                    ],
+                    "edges" : [ { "id" : "a", "source_id" : "CHEBI:1", "target_id" : "HGNC:1", "type" : "affects" } ]
+                },
+                "knowledge_map" : [ { "node_bindings" : { "chemical_substance" : "CHEBI:1", "gene" : "HGNC:1" },
+                                      "edge_bindings" : { "e0" : "a" } } ]
+            },
+            {
+                "knowledge_graph" : {
+                    "nodes" : [
+                        { "id" : "CHEMBL:1", "type" : "chemical_substance", "name" : "aspirin" },
+                        { "id" : "NCBIGene:1", "type" : "gene" },
+                        { "id" : "HGNC:2", "type" : "gene" }
+                    ],
+                    "edges" : [
+                        { "id" : "b", "source_id" : "CHEMBL:1", "target_id" : "NCBIGene:1", "type" : [ "affects" ], "p_val" : 0.1 },
+                        { "id" : "c", "source_id" : "CHEMBL:1", "target_id" : "HGNC:2", "type" : "affects" }
+                    ]
+                },
+                "knowledge_map" : [
+                    { "node_bindings" : { "chemical_substance" : "CHEMBL:1", "gene" : "NCBIGene:1" }, "edge_bindings" : { "e0" : [ "b" ] } },
+                    { "node_bindings" : { "chemical_substance" : "CHEMBL:1", "gene" : "HGNC:2" }, "edge_bindings" : { "e0" : [ "c" ] } }
+                ]
+            }
+        ]
+    merger = IncrementalMerger ()
+    first, second = responses ()
+    merger.add (first)
+    delta = merger.delta ()
+    assert [ n['id'] for n in delta['knowledge_graph']['nodes'] ] == [ "CHEBI:1", "HGNC:1" ]
+    merger.add (second)
+    delta = merger.delta ()
+    """ Only the node and edge not folded into earlier ones are new. """
+    assert [ n['id'] for n in delta['knowledge_graph']['nodes'] ] == [ "HGNC:2" ]
+    assert [ e['id'] for e in delta['knowledge_graph']['edges'] ] == [ "c" ]
+    assert delta['knowledge_map'][0] == {
+        "node_bindings" : { "chemical_substance" : "CHEBI:1", "gene" : "HGNC:1" },
+        "edge_bindings" : { "e0" : [ "a" ] }
+    }
+    assert merger.delta ()['knowledge_map'] == []
+
+    """
+    The result merge_results gave for these responses before merging was incremental. Edge b is folded into
+    edge a; the answer binding it then still named b, an edge no longer in the graph, and now names a.
+    """
+    expected = {
+        "knowledge_graph" : {
+            "nodes" : [
+                { "id" : "CHEBI:1", "type" : [ "chemical_substance" ], "name" : "aspirin", "equivalent_identifiers" : [ "CHEBI:1", "CHEMBL:1" ] },
+                { "id" : "HGNC:1", "type" : [ "gene" ], "equivalent_identifiers" : [ "HGNC:1", "NCBIGene:1" ] },
+                { "id" : "HGNC:2", "type" : [ "gene" ], "equivalent_identifiers" : [ "HGNC:2" ] }
+            ],
+            "edges" : [
+                { "id" : "a", "source_id" : "CHEBI:1", "target_id" : "HGNC:1", "type" : [ "affects" ], "p_val" : 0.1 },
+                { "id" : "c", "source_id" : "CHEBI:1", "target_id" : "HGNC:2", "type" : [ "affects" ] }
+            ]
+        },
+        "knowledge_map" : [
+            { "node_bindings" : { "chemical_substance" : "CHEBI:1", "gene" : "HGNC:1" }, "edge_bindings" : { "e0" : "a" } },
+            { "node_bindings" : { "chemical_substance" : "CHEBI:1", "gene" : "HGNC:1" }, "edge_bindings" : { "e0" : [ "a" ] } },
+            { "node_bindings" : { "chemical_substance" : "CHEBI:1", "gene" : "HGNC:2" }, "edge_bindings" : { "e0" : [ "c" ] } }
+        ],
+        "question_graph" : {}
+    }
+    def normalized (result):
+        for node in result['knowledge_graph']['nodes']:
+            node['equivalent_identifiers'] = sorted (node['equivalent_identifiers'])
+        return result
+    assert normalized (merger.snapshot ({})) == expected
+    assert normalized (SelectStatement.merge_results (responses (), TranQL (), {})) == expected
+
+def test_incremental_merger_compact ():
+    """ Validate that merged elements intern their identifiers and encode their reasoners as masks. """
+    print ("test_incremental_merger_compact ()")
+    merger = IncrementalMerger ()
+    for reasoner in [ "robokop", "rtx" ]:
+        merger.add ({
+            "knowledge_graph" : {
+                "nodes" : [ { "id" : "".join ([ "HGNC:", "1" ]), "type" : "gene", "reasoner" : [ reasoner ] } ],
+                "edges" : [ { "id" : reasoner, "source_id" : "".join ([ "HGNC:", "1" ]), "target_id" : "HGNC:1",
+                              "type" : [ "related_to" ], "publications" : [ f"PMID:{reasoner}" ], "reasoner" : [ reasoner ] } ]
+            },
+            "knowledge_map" : []
+        })
+    node = merger.nodes[0]
+    edge = merger.edges[0]
+    assert node.reasoners == 0b11
+    assert edge.source_id is node.id
+    assert merger.snapshot ()['knowledge_graph'] == {
+        "nodes" : [ { "id" : "HGNC:1", "type" : [ "gene" ], "reasoner" : [ "robokop", "rtx" ], "equivalent_identifiers" : [ "HGNC:1" ] } ],
+        "edges" : [ { "id" : "robokop", "source_id" : "HGNC:1", "target_id" : "HGNC:1", "type" : [ "related_to" ],
+                      "publications" : [ "PMID:robokop", "PMID:rtx" ], "reasoner" : [ "robokop", "rtx" ] } ]
+    }
+
+def test_answer_table ():
+    """ Validate joining, renaming, and deduplicating answers as columns. """
+    print ("test_answer_table ()")
+    vocabulary = Vocabulary ()
+    first = AnswerTable.from_answers ([
+        { "node_bindings" : { "disease" : "MONDO:1", "gene" : "HGNC:1" }, "edge_bindings" : { "e0" : "a" }, "score" : 1 },
+        { "node_bindings" : { "disease" : "MONDO:2", "gene" : "NCBIGene:2" }, "edge_bindings" : { "e0" : "b" } },
+        { "node_bindings" : { "disease" : "MONDO:3", "gene" : "HGNC:3" }, "edge_bindings" : { "e0" : "c" } }
+    ], vocabulary)
+    second = AnswerTable.from_answers ([
+        { "node_bindings" : { "gene" : "HGNC:2", "chemical_substance" : "CHEBI:1" }, "edge_bindings" : { "e1" : [ "x" ] } },
+        { "node_bindings" : { "gene" : "HGNC:1", "chemical_substance" : "CHEBI:2" }, "edge_bindings" : { "e1" : [ "y", "z" ] } },
+        { "node_bindings" : { "gene" : "HGNC:1", "chemical_substance" : "CHEBI:3" }, "edge_bindings" : { "e1" : [ "y" ] } }
+    ], vocabulary)
+    first.remap ("node_bindings", lambda id: "HGNC:2" if id == "NCBIGene:2" else id)
+    joined = first.join (second, "gene", "gene")
+    assert joined.to_answers () == [
+        { "node_bindings" : { "disease" : "MONDO:1", "gene" : "HGNC:1", "chemical_substance" : "CHEBI:2" },
+          "edge_bindings" : { "e0" : "a", "e1" : [ "y", "z" ] }, "score" : 1 },
+        { "node_bindings" : { "disease" : "MONDO:1", "gene" : "HGNC:1", "chemical_substance" : "CHEBI:3" },
+          "edge_bindings" : { "e0" : "a", "e1" : [ "y" ] }, "score" : 1 },
+        { "node_bindings" : { "disease" : "MONDO:2", "gene" : "HGNC:2", "chemical_substance" : "CHEBI:1" },
+          "edge_bindings" : { "e0" : "b", "e1" : [ "x" ] } }
+    ]
+    doubled = AnswerTable.concat ([ joined, joined ], vocabulary).dedup ()
+    assert doubled.to_answers () == joined.to_answers ()
+
+def test_answer_table_arrow ():
+    """ Validate exporting answers to Arrow. """
+    print ("test_answer_table_arrow ()")
+    pytest.importorskip ("pyarrow")
+    table = AnswerTable.from_answers ([
+        { "node_bindings" : { "gene" : "HGNC:1" }, "edge_bindings" : { "e0" : [ "a", "b" ] } },
+        { "node_bindings" : { "gene" : "HGNC:2" }, "edge_bindings" : { "e0" : "c" } }
+    ]).to_arrow ()
+    assert table.to_pydict () == {
+        "node_bindings.gene" : [ "HGNC:1", "HGNC:2" ],
+        "edge_bindings.e0" : [ [ "a", "b" ], [ "c" ] ]
+    }
+
+def test_partitioned_merger ():
+    """ Validate that merging across processes gives the same result as merging in one. """
+    print ("test_partitioned_merger ()")
+    def responses ():
+        return [
+            {
+                "knowledge_graph" : {
+                    "nodes" : [
+                        { "id" : f"CHEBI:{i}", "type" : "chemical_substance", "name" : f"chemical {i % 7}", "reasoner" : [ reasoner ] }
+                        for i in range(r, r + 20)
+                    ] + [
+                        { "id" : f"HGNC:{i}", "type" : [ "gene" ], "equivalent_identifiers" : [ f"NCBIGene:{i % 9}" ], "reasoner" : [ reasoner ] }
+                        for i in range(r, r + 20)
+                    ],
+                    "edges" : [
+                        { "id" : f"{reasoner}{i}", "source_id" : f"CHEBI:{i}", "target_id" : f"HGNC:{i}",
+                          "type" : "affects", "publications" : [ f"PMID:{i}" ], "reasoner" : [ reasoner ] }
+                        for i in range(r, r + 20)
+                    ]
+                },
+                "knowledge_map" : [
+                    { "node_bindings" : { "chemical_substance" : f"CHEBI:{i}", "gene" : f"HGNC:{i}" },
+                      "edge_bindings" : { "e0" : [ f"{reasoner}{i}" ] } }
+                    for i in range(r, r + 20)
+                ]
+            }
+            for r, reasoner in zip([ 0, 5, 10, 15 ], [ "robokop", "rtx", "robokop", "indigo" ])
+        ]
+    expected = IncrementalMerger ()
+    partitioned = PartitionedMerger (3)
+    for response in responses ():
+        expected.add (response)
+    for response in responses ():
+        partitioned.add (response)
+    assert partitioned.snapshot ({}) == expected.snapshot ({})
+    assert partitioned.delta () == expected.delta ()
+    """ Statements merge across the interpreter's merge processes. """
+    assert isinstance (SelectStatement.merger (TranQL (options = { "merge_processes" : 3 })), PartitionedMerger)
+    assert not isinstance (SelectStatement.merger (TranQL ()), PartitionedMerger)
+
+def test_message_projection ():
+    """ Validate dropping node and edge attributes outside a projection, from events and from a whole response. """
+    print ("test_message_projection ()")
+    projection = Projection.from_config ("node.description, edge.p_val")
+    assert projection.keeps ("nodes", "description") and projection.keeps ("nodes", "name")
+    assert not projection.keeps ("edges", "publications")
+    assert Projection.from_config (None) is None
+    message = {
+        "question_graph" : { "nodes" : [ { "id" : "n0", "synonyms" : [ "x" ] } ] },
+        "knowledge_graph" : {
+            "nodes" : [ { "id" : "HGNC:1", "name" : "gene 1", "description" : "d", "synonyms" : [ "a", "b" ] } ],
+            "edges" : [ { "id" : "e1", "source_id" : "HGNC:1", "target_id" : "HGNC:1", "p_val" : 0.01,
+                          "publications" : [ "PMID:1" ], "provenance" : { "tool" : [ { "v" : 1 } ] } } ]
+        }
+    }
+    expected = {
+        "question_graph" : { "nodes" : [ { "id" : "n0", "synonyms" : [ "x" ] } ] },
+        "knowledge_graph" : {
+            "nodes" : [ { "id" : "HGNC:1", "name" : "gene 1", "description" : "d" } ],
+            "edges" : [ { "id" : "e1", "source_id" : "HGNC:1", "target_id" : "HGNC:1", "p_val" : 0.01 } ]
+        }
+    }
+    assert streaming ()
+    assert parse_message (io.BytesIO (json.dumps (message).encode ()), projection) == expected
+    """ Events as an incremental parser gives them. """
+    def events (value, prefix=""):
+        item = f"{prefix}.item" if prefix else "item"
+        if isinstance(value, dict):
+            yield prefix, "start_map", None
+            for k, v in value.items ():
+                yield prefix, "map_key", k
+                yield from events (v, f"{prefix}.{k}" if prefix else k)
+            yield prefix, "end_map", None
+        elif isinstance(value, list):
+            yield prefix, "start_array", None
+            for v in value:
+                yield from events (v, item)
+            yield prefix, "end_array", None
+        else:
+            yield prefix, "number" if isinstance(value, float) else "string", value
+    builder = MessageBuilder (projection)
+    all_events = list(events (message))
+    builder.feed (all_events[:17])
+    builder.feed (all_events[17:])
+    assert builder.value == expected
+
+def test_name_resolver_requests (name_services):
+    """ Validate the requests names are looked up with, and how responses, unknown names, and failures are read. """
+    print ("test_name_resolver_requests ()")
+    resolver, requested = name_services
+    assert resolver.resolve ("ibuprofen/advil 200", "chemical_substance") == [ "CHEBI:5855" ]
+    assert sorted (requested) == sorted ([
+        "/lookup/ibuprofen%2Fadvil%20200/chemical_substance/",
+        "mychem ibuprofen/advil 200"
+    ])
+    """ Bionames answers names it doesn't know with a 404. They resolve to nothing, which is cached. """
+    requested.clear ()
+    assert resolver.resolve ("unknown", "gene") == []
+    assert resolver.resolve ("unknown", "gene") == []
+    assert requested == [ "/lookup/unknown/gene/" ]
+    """ A failed lookup is not the same as an unknown name, and it is tried again. """
+    requested.clear ()
+    for attempt in range(2):
+        with pytest.raises (ServiceInvocationError):
+            resolver.resolve ("broken", "gene")
+    assert requested == [ "/lookup/broken/gene/" ] * 2
+    """ A name resolving to nothing can't constrain a query. """
+    tranql = TranQL (options = { "dynamic_id_resolution" : True })
+    tranql.name_resolver = resolver
+    select = tranql.parse ("""
+        SELECT chemical_substance->gene
+          FROM "/graph/gamma/quick"
+         WHERE chemical_substance = "unknown"
+    """).statements[0]
+    with pytest.raises (UnableToGenerateQuestionError):
+        select.generate_questions (tranql)
+
+def test_name_resolver ():
+    """ Validate that names are looked up once each, concurrently, with hits and misses cached and failures retried. """
+    print ("test_name_resolver ()")
+    class Resolver(NameResolver):
+        def __init__(self, known, failing=[]):
+            super().__init__(cache=TTLCache (), ttl=60, negative_ttl=1)
+            self.known = known
+            self.failing = failing
+            self.fetched = []
+        def fetch (self, lookups, deadline=None):
+            self.fetched.append (lookups)
+            return { lookup : None if lookup[1] in self.failing else self.known.get (lookup, []) for lookup in lookups }
+    resolver = Resolver ({
+        ("bionames", "ibuprofen", "chemical_substance") : [ "CHEBI:5855" ],
+        ("mychem", "ibuprofen", None) : [ "CHEMBL:CHEMBL521" ],
+        ("bionames", "asthma", "disease") : [ "MONDO:0004979" ]
+    }, failing=[ "flaky" ])
+    resolved = resolver.resolve_all ([
+        ("ibuprofen", "chemical_substance"),
+        ("asthma", [ "disease" ]),
+        ("asthma", [ "disease" ]),
+        ("unknown", [ "disease" ]),
+        ("flaky", [ "gene" ])
+    ])
+    assert resolved == {
+        ("ibuprofen", ("chemical_substance",)) : [ "CHEBI:5855", "CHEMBL:CHEMBL521" ],
+        ("asthma", ("disease",)) : [ "MONDO:0004979" ],
+        ("unknown", ("disease",)) : [],
+        ("flaky", ("gene",)) : []
+    }
+    assert len(resolver.fetched) == 1 and len(resolver.fetched[0]) == 5
+    """ Hits and misses come from the cache. Failures are looked up again. """
+    assert resolver.resolve ("unknown", "disease") == []
+    assert resolver.resolve ("asthma", "disease") == [ "MONDO:0004979" ]
+    with pytest.raises (ServiceInvocationError):
+        resolver.resolve ("flaky", "gene")
+    assert resolver.fetched[1:] == [ [ ("bionames", "flaky", "gene") ] ]
+    """ The merger resolves the nodes of a response together. """
+    merger = IncrementalMerger (name_based_merging=False, resolve=resolver.resolve_all)
+    merger.add ({
+        "knowledge_graph" : {
+            "nodes" : [
+                { "id" : "A", "name" : "ibuprofen", "type" : [ "chemical_substance" ] },
+                { "id" : "B", "name" : "ibuprofen", "type" : "chemical_substance" },
+                { "id" : "C", "name" : "asthma", "type" : [ "disease" ], "equivalent_identifiers" : [ "C" ] }
+            ],
+            "edges" : []
+        },
+        "knowledge_map" : []
+    })
+    nodes = merger.snapshot ({})['knowledge_graph']['nodes']
+    assert [ n['id'] for n in nodes ] == [ "A", "C" ]
+    assert sorted(nodes[0]['equivalent_identifiers']) == [ "A", "B", "CHEBI:5855", "CHEMBL:CHEMBL521" ]
+    assert len(resolver.fetched) == 2
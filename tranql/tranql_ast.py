@@ -1,6 +1,8 @@
 import copy
+import io
 import json
 import logging
+import pickle
 import requests
 import requests_cache
 import sys
@@ -11,12 +13,26 @@ from tranql.concept import ConceptModel
 from tranql.concept import BiolinkModelWalker
 from tranql.tranql_schema import Schema
 from tranql.util import Concept
+from tranql.util import PatternMatcher
 from tranql.util import JSONKit
 from tranql.util import deep_merge, light_merge
 from tranql.request_util import async_make_requests
+from tranql.request_util import RequestPolicy
+from tranql.request_util import breakers
+from tranql.request_util import is_failure
+from tranql.cache import subgraph_cache
+from tranql.attribute_filter import AttributeFilter
+from tranql.message_parser import Projection, parse_message, streaming
+from tranql.answer_table import AnswerTable, Vocabulary
+from tranql.merge import IncrementalMerger, PartitionedMerger
+from tranql.name_resolver import NameResolver
+from tranql.jobs import JobPool
 from tranql.util import Text
 from tranql.tranql_schema import Schema
+from tranql.exception import TranQLException
 from tranql.exception import ServiceInvocationError
+from tranql.exception import ServiceUnavailableError
+from tranql.exception import RequestTimeoutError
 from tranql.exception import UndefinedVariableError
 from tranql.exception import UnableToGenerateQuestionError
 from tranql.exception import MalformedResponseError
@@ -29,30 +45,15 @@ logger = logging.getLogger (__name__)
 def truncate (s, max_length=75):
     return (s[:max_length] + '..') if len(s) > max_length else s
 
-class Bionames:
-    """ Resolve natural language names to ontology identifiers. """
-    url = "https://bionames.renci.org/lookup/{input}/{type}/"
-
-    @staticmethod
-    def get_ids (name, type_name):
-        url = Bionames.url.format (**{
-            "input" : name,
-            "type"  : type_name
-        })
-        result = None
-        response = requests.get(
-            url = url,
-            headers = {
-                'accept': 'application/json'
-            })
-        if response.status_code == 200 or response.status_code == 202:
-            result = response.json ()
-        else:
-            raise ServiceInvocationError (response.text)
-        return result
-
 class Statement:
     """ The interface contract for a statement. """
+
+    """ The parse tree the statement came from, if it was parsed from a program. """
+    tokens = None
+
+    """ Whether the statement's results may be reused when neither it nor the variables it reads change. """
+    memoizable = True
+
     def execute (self, interpreter, context={}):
         pass
 
@@ -80,42 +81,118 @@ class Statement:
             "options" : options
         }
 
-    def request (self, url, message):
-        """ Make a web request to a service (url) posting a message. """
+    def request (self, url, message, deadline=None, policy=None, budget=None, breaker=None, projection=None, session=None):
+        """ Make a web request to a service (url) posting a message.
+        If a deadline is given, the request is bounded by it and the service is told how long it has.
+        Transient failures are retried with backoff as allowed by the policy and the retry budget.
+        If a circuit breaker is given and open, fail without sending anything.
+        If a projection is given, only the node and edge attributes it keeps are read from the response.
+        If a session is given, the request is made with it rather than with requests' default session. """
+        policy = policy if policy is not None else RequestPolicy ()
+        if breaker is not None and not breaker.allow ():
+            raise ServiceUnavailableError (
+                f"Service {url} is unavailable.",
+                details=f"Recent requests to {breaker.name} failed. It will be retried in {round(breaker.retry_after ())}s.")
+        attempt = 0
+        try:
+            while True:
+                response, retryable, errors = self.request_once (url, message, deadline, policy.retry_statuses, projection, session)
+                if not retryable or attempt >= policy.retries:
+                    break
+                delay = policy.backoff_delay (attempt)
+                if deadline is not None and deadline.remaining () is not None and deadline.remaining () <= delay:
+                    break
+                if budget is None or not budget.spend ():
+                    break
+                logger.debug (f"retrying request to {url} in {delay}s")
+                time.sleep (delay)
+                attempt += 1
+        except RequestTimeoutError:
+            if breaker is not None:
+                breaker.record (False)
+            raise
+        except UnknownServiceError:
+            if breaker is not None:
+                breaker.abandon ()
+            raise
+        if breaker is not None:
+            """ Judge the service's health as asynchronous requests do: an empty answer is still an answer. """
+            breaker.record (not is_failure (errors))
+        return response
+
+    @staticmethod
+    def caching_responses (session=None):
+        """ Is a requests_cache installed? It reads each response whole to store it, so responses can't be streamed. """
+        if session is not None:
+            return isinstance(session, requests_cache.CachedSession)
+        return issubclass(requests.Session, requests_cache.CachedSession)
+
+    def request_once (self, url, message, deadline=None, retry_statuses=[], projection=None, session=None):
+        """
+        Make a single attempt at a request. Returns the response, whether a failure is worth retrying, and the
+        errors it met, like make_request_once's.
+        """
+        stream = projection is not None and streaming () and not self.caching_responses (session)
         logger.debug (f"request({url})> {json.dumps(message, indent=2)}")
         response = {}
+        errors = []
         unknown_service = False
+        retryable = False
         try:
-            http_response = requests.post (
-                url = url,
-                json = message,
-                headers = {
-                    'accept': 'application/json'
-                })
-            """ Check status and handle response. """
-            if http_response.status_code == 200 or http_response.status_code == 202:
-                response = http_response.json ()
-                #logger.error (f" response: {json.dumps(response, indent=2)}")
-                status = response.get('status', None)
-                if status == "error":
-                    raise ServiceInvocationError(
-                        message=f"An error occurred invoking service: {url}.",
-                        details=truncate(response['message'], max_length=5000))
-                logging.debug (f"{json.dumps(response, indent=2)}")
-            elif http_response.status_code == 404:
-                unknown_service = True
-            else:
-                logger.error (f"error {http_response.status_code} processing request: {message}")
-                logger.error (http_response.text)
+            with (session if session is not None else requests).post (
+                    url = url,
+                    json = message,
+                    headers = {
+                        'accept': 'application/json',
+                        **(deadline.headers () if deadline else {}),
+                        **(projection.headers () if projection else {})
+                    },
+                    timeout = deadline.remaining () if deadline else None,
+                    stream = stream) as http_response:
+                """ Check status and handle response. """
+                if http_response.status_code == 200 or http_response.status_code == 202:
+                    if stream and not getattr (http_response, 'from_cache', False):
+                        """ Parse the response as it is read, dropping attributes outside the projection. """
+                        http_response.raw.decode_content = True
+                        response = parse_message (http_response.raw, projection)
+                    elif projection is not None:
+                        """ The response was read whole. Still, don't build the attributes the projection drops. """
+                        response = parse_message (io.BytesIO (http_response.content), projection)
+                    else:
+                        response = http_response.json ()
+                    #logger.error (f" response: {json.dumps(response, indent=2)}")
+                    status = response.get('status', None)
+                    if status == "error":
+                        raise ServiceInvocationError(
+                            message=f"An error occurred invoking service: {url}.",
+                            details=truncate(response['message'], max_length=5000))
+                    logging.debug (f"{json.dumps(response, indent=2)}")
+                elif http_response.status_code == 404:
+                    unknown_service = True
+                else:
+                    retryable = http_response.status_code in retry_statuses
+                    logger.error (f"error {http_response.status_code} processing request: {message}")
+                    logger.error (http_response.text)
+                    errors.append (requests.exceptions.HTTPError (
+                        f"{http_response.status_code} error from {url}", response=http_response))
         except ServiceInvocationError as e:
-            pass #raise e
+            errors.append (e)
+        except requests.exceptions.Timeout as e:
+            raise RequestTimeoutError (
+                f'Timeout error requesting content from url: "{url}"',
+                details=str(e))
+        except requests.exceptions.ConnectionError as e:
+            retryable = True
+            errors.append (e)
+            logger.error (f"unable to connect to {url}: {e}")
         except Exception as e:
+            errors.append (e)
             logger.error (f"error performing request: {json.dumps(message, indent=2)} to url: {url}")
             #traceback.print_exc ()
             logger.error (traceback.format_exc ())
         if unknown_service:
             raise UnknownServiceError (f"Service {url} was not found. Is it misspelled?")
-        return response
+        return response, retryable, errors
 
 class SetStatement(Statement):
     """ Model the set statement's semantics and variants. """
@@ -161,7 +238,15 @@ class SetStatement(Statement):
         return result
 
 class CreateGraphStatement(Statement):
-    """ Create a graph, sending it to a sink. """
+    """ Create a graph, sending it to a sink.
+    Publishing runs in the background so visualization services stay off the query path. """
+
+    # Publications share a bounded pool so they run concurrently with one another and with later statements.
+    publisher = JobPool (max_workers=4, name="tranql-publish")
+
+    # Publishing is a side effect. Do it every time.
+    memoizable = False
+
     def __init__(self, graph, service, name):
         """ Construct a graph creation statement. """
         self.graph = graph
@@ -170,18 +255,28 @@ class CreateGraphStatement(Statement):
     def __repr__(self):
         return f"CREATE GRAPH {self.graph} AT {self.service} AS {self.name}"
     def execute (self, interpreter):
-        """ Execute the statement. """
+        """ Execute the statement. The context variable is bound to a handle to the publication job. """
         self.service = self.resolve_backplane_url(self.service,
                                                   interpreter)
         graph = interpreter.context.resolve_arg (self.graph)
         logger.debug (f"------- {type(graph).__name__}")
         logger.debug (f"--- create graph {self.service} graph-> {json.dumps(graph, indent=2)}")
-        response = None
-        with requests_cache.disabled ():
-            response = self.request (url=self.service,
-                                     message=graph)
-        interpreter.context.set (self.name, response)
-        return response
+        job = self.publisher.submit (
+            name=f"{self.service}:{self.name}",
+            fn=self.publish,
+            graph=graph)
+        interpreter.context.set (self.name, job)
+        return job
+
+    def publish (self, graph):
+        """
+        Send the graph to the sink, never from or to the cache. Publications run on threads alongside queries, so they
+        use a session of their own rather than disabling the process wide cache the queries use.
+        """
+        with requests_cache.core.OriginalSession () as session:
+            return self.request (url=self.service,
+                                 message=graph,
+                                 session=session)
 
 def synonymize(nodetype,identifier):
     robokop_server = 'robokopdb2.renci.org'
@@ -204,13 +299,20 @@ class SelectStatement(Statement):
         self.ast = ast
         self.query = Query ()
         self.service = service
+        """ All the services named in the FROM clause, when there are several. The first is also self.service. """
+        self.services = []
         self.where = []
         self.set_statements = []
+        """ The most answers to return, from a LIMIT clause: a number or a variable. """
+        self.limit = None
         self.jsonkit = JSONKit ()
         self.planner = QueryPlanStrategy (ast.schema)
+        """ The deadline of the current execution, and that of the statement this one was planned from, if it was. """
+        self.deadline = None
+        self.parent_deadline = None
 
     def __repr__(self):
-        return f"SELECT {self.query} from:{self.service} where:{self.where} set:{self.set_statements}"
+        return f"SELECT {self.query} from:{self.service} where:{self.where} limit:{self.limit} set:{self.set_statements}"
 
     def edge (self, index, source, target, type_name=None):
         """ Generate a question edge. """
@@ -243,22 +345,12 @@ class SelectStatement(Statement):
         return result
 
     @staticmethod
-    def resolve_name (name, type_names):
-        if not isinstance(type_names, list):
-            type_names = [type_names]
-        result = []
-        for type_name in type_names:
-            equivalent_identifiers = Bionames.get_ids (name, type_name)
-            for i in equivalent_identifiers:
-                result.append(i["id"])
-        for type_name in type_names:
-            if type_name == 'chemical_substance':
-                response = requests.get (f"http://mychem.info/v1/query?q={name}").json ()
-                for obj in response['hits']:
-                    if 'chebi' in obj:
-                        result.append (obj['chebi']['id'])
-                    if 'chembl' in obj:
-                        result.append ("CHEMBL:"+obj['chembl']['molecule_chembl_id'])
+    def resolve_name (name, type_names, deadline=None, resolver=None):
+        """
+        Resolve a name to identifiers with Bionames and, for chemicals, MyChem.
+        Raises ServiceInvocationError if the lookups failed rather than found nothing.
+        """
+        result = (resolver if resolver is not None else NameResolver ()).resolve (name, type_names, deadline)
         logger.debug (f"name resolution result: {name} => {result}")
         return result
 
@@ -290,7 +382,11 @@ class SelectStatement(Statement):
                     This is frowned upon. While it *may* be useful for prototyping and,
                     interactive exploration, it will probably be removed. """
                     logger.debug (f"performing dynamic lookup resolving {concept}={value}")
-                    concept.set_nodes (self.resolve_name (value, concept.type_name))
+                    identifiers = self.resolve_name (value, concept.type_name, interpreter.deadline, interpreter.name_resolver)
+                    if len(identifiers) == 0:
+                        """ Without identifiers, the node would be unconstrained rather than bound to the name. """
+                        raise UnableToGenerateQuestionError (f"No identifiers were found for {concept.type_name} {value}.")
+                    concept.set_nodes (identifiers)
                     logger.debug (f"resolved {value} to identifiers: {concept.nodes}")
                 else:
                     """ This is a single curie. Bind it to the node. """
@@ -316,6 +412,7 @@ class SelectStatement(Statement):
                     """ If this is the last concept, add the object as well. """
                     statement.query.add (obj)
                 statement.where = self.where
+                statement.parent_deadline = self.deadline
         self.query.disable = True # = Query ()
         return statements
 
@@ -351,10 +448,10 @@ class SelectStatement(Statement):
                 ])
                 filters = interpreter.context.resolve_arg ('$id_filters')
                 if filters:
-                    filters = [ f.lower () for f in filters.split(",") ]
+                    excluded = PatternMatcher.for_prefixes (filters.split(","))
                     concept.set_nodes ([
                         n for n in concept.nodes
-                        if not n['curie'].split(':')[0].lower () in filters
+                        if not excluded.matches (n['curie'])
                     ])
             else:
                 """ There are no values - it's just a template for a model type. """
@@ -369,12 +466,22 @@ class SelectStatement(Statement):
             logger.debug (f"manage constraint: {constraint}")
             name, op, value = constraint
             value = interpreter.context.resolve_arg (value)
+            if name == 'timeout':
+                """ The statement's deadline is ours to enforce, not an option to the service. """
+                continue
+            if AttributeFilter.applies (name):
+                """ Filters on node and edge attributes are applied to the merged result. """
+                continue
             if not name in self.query:
                 """
                 This is not constraining a concept name in the graph query.
                 So interpret it as an option to the underlying service.
                 """
                 options[name] = constraint[1:]
+        limit = self.get_early_limit (interpreter)
+        if limit is not None and self.get_reasoner_config (interpreter).get ('max_results', False):
+            """ Let reasoners that can return fewer answers do so. """
+            options['max_results'] = [ "=", limit ]
         edges = []
         questions = []
         logger.debug (f"concept order> {self.query.order}")
@@ -508,6 +615,102 @@ class SelectStatement(Statement):
                 break
         return schema
 
+    @staticmethod
+    def broader_types (type_name):
+        """ The ancestors of a type in the concept model, nearest first. """
+        types = []
+        concept = Query.concept_model.get (type_name)
+        while concept is not None and concept.is_a is not None:
+            concept = concept.is_a
+            types.append (concept.name)
+        return types
+
+    def get_reasoner_config (self, interpreter):
+        """ The schema's configuration of this statement's reasoner, if it is one the schema knows. """
+        schema = self.get_schema_name (interpreter)
+        return self.planner.schema.config["schema"].get (schema, {}) if schema else {}
+
+    def get_request_policy (self, interpreter):
+        """ How requests to this statement's service are retried and hedged. Configured per reasoner in the schema. """
+        return RequestPolicy.from_config (self.get_reasoner_config (interpreter).get ('request', None))
+
+    def get_breaker (self, interpreter, service):
+        """ The circuit breaker tracking the health of this statement's service. """
+        schema = self.get_schema_name (interpreter)
+        return breakers.get (schema if schema else service, self.get_reasoner_config (interpreter).get ('breaker', None))
+
+    def get_limit (self, interpreter):
+        """ The most answers the statement may return, or None for all of them. """
+        if self.limit is None:
+            return None
+        limit = interpreter.context.resolve_arg (self.limit)
+        if limit is None:
+            raise UndefinedVariableError (f"Undefined variable {self.limit} in LIMIT clause.")
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            raise TranQLException (f"LIMIT must be a whole number, not {limit}.")
+        if limit < 0:
+            raise TranQLException (f"LIMIT must not be negative, not {limit}.")
+        return limit
+
+    def get_early_limit (self, interpreter):
+        """ The limit, if answers may be cut off before the merge. Attribute filters may drop answers after it. """
+        return self.get_limit (interpreter) if len(self.get_attribute_filters (interpreter)) == 0 else None
+
+    def get_attribute_filters (self, interpreter):
+        """ The constraints on node and edge attributes, with their values resolved. """
+        return [
+            [ name, op, interpreter.context.resolve_arg (value) ]
+            for name, op, value in self.where
+            if AttributeFilter.applies (name)
+        ]
+
+    def get_projection (self, interpreter):
+        """ The node and edge attributes to keep from responses: the query's projection and any attribute filters read. """
+        if interpreter.projection is None:
+            return None
+        return interpreter.projection.including ([ name for name, op, value in self.get_attribute_filters (interpreter) ])
+
+    @staticmethod
+    def collect_answers (answers, response):
+        """ Add the distinct answers of a response to a set of answers. """
+        for answer in response.get ('knowledge_map', []):
+            answers.add (json.dumps (answer.get ('node_bindings', {}), sort_keys=True, default=str))
+
+    @staticmethod
+    def limit_answers (result, limit):
+        """ Keep the first limit answers of a result, and only the nodes they bind and the edges between them. """
+        if len(result.get ('knowledge_map', [])) <= limit:
+            return result
+        def ids (value):
+            return value if isinstance(value, list) else [ value ]
+        answers = result['knowledge_map'][:limit]
+        node_ids = set ([ id for answer in answers for v in answer.get ('node_bindings', {}).values () for id in ids (v) ])
+        graph = result.get ('knowledge_graph', {})
+        return {
+            **result,
+            "knowledge_graph" : {
+                **graph,
+                "nodes" : [ n for n in graph.get ('nodes', []) if n['id'] in node_ids ],
+                "edges" : [ e for e in graph.get ('edges', [])
+                            if e.get ('source_id', None) in node_ids and e.get ('target_id', None) in node_ids ]
+            },
+            "knowledge_map" : answers
+        }
+
+    def get_deadline (self, interpreter):
+        """
+        The statement's deadline for this execution: the query's, or that of the statement it was planned from,
+        tightened by a `timeout` constraint if one is given. It is made anew each time the statement executes.
+        """
+        timeout = None
+        for name, op, value in self.where:
+            if name == 'timeout':
+                timeout = float(interpreter.context.resolve_arg (value))
+        parent = self.parent_deadline if self.parent_deadline is not None else interpreter.deadline
+        return parent.child (timeout)
+
     def execute (self, interpreter, context={}):
         """
         Execute all statements in the abstract syntax tree.
@@ -516,108 +719,335 @@ class SelectStatement(Statement):
         - Execute the questions.
         """
         result = None
-        if self.service == "/schema":
+        deadline = self.deadline = self.get_deadline (interpreter)
+        limit = self.get_limit (interpreter)
+        if limit == 0:
+            """ No answers are wanted, so there is nothing to ask. """
+            interpreter.context.set('requestErrors',[])
+            result = self.merger (interpreter).snapshot ()
+        elif len(self.services) > 1:
+            result = self.execute_sources (interpreter, deadline)
+        elif self.service == "/schema":
             result = self.execute_plan (interpreter)
         else:
-            """ We want to find what schema name corresponds to the url we are querying.
-            Then we can format the constraints accordingly (e.g. the ICEES schema name is 'icces'). """
+            interpreter.context.set('requestErrors',[])
+            merger = self.merger (interpreter)
+            root_question_graph = self.ask (interpreter, deadline, merger)
+            result = merger.snapshot (root_question_graph)
+        result = AttributeFilter (self.get_attribute_filters (interpreter)).apply (result)
+        if limit is not None:
+            result = self.limit_answers (result, limit)
+        interpreter.context.set('result', result)
+        interpreter.emit ('merged', service=self.service, result=result)
+        """ Execute set statements associated with this statement. """
+        for set_statement in self.set_statements:
+            logger.debug (f"{set_statement}")
+            set_statement.execute (interpreter, context = { "result" : result })
+        return result
 
-            self.format_constraints(interpreter)
+    """ The services of a statement with several are asked concurrently. """
+    source_pool = JobPool (max_workers=8, name="tranql-sources")
 
-            self.service = self.resolve_backplane_url (self.service, interpreter)
-            questions = self.generate_questions (interpreter)
+    def source (self, service):
+        """ A copy of this statement asking only one of its services. """
+        statement = copy.copy (self)
+        statement.service = service
+        statement.services = []
+        statement.query = copy.deepcopy (self.query)
+        statement.where = copy.deepcopy (self.where)
+        statement.set_statements = []
+        return statement
 
-            [self.ast.schema.validate_question(question) for question in questions]
+    def execute_sources (self, interpreter, deadline):
+        """
+        Ask each of the statement's services the same questions concurrently, merging their responses as they arrive.
+        A service that fails only loses its own answers, unless every service fails.
+        """
+        if "/schema" in self.services:
+            """ Querying /schema already plans across every reasoner in the schema. """
+            raise UnknownServiceError (f"/schema can't be combined with other services in {self.services}.")
+        interpreter.context.set('requestErrors',[])
+        merger = self.merger (interpreter)
+        jobs = [
+            self.source_pool.submit (f"ask {service}", self.source (service).ask, interpreter, deadline, merger)
+            for service in self.services
+        ]
+        root_question_graph = None
+        failures = []
+        for service, job in zip(self.services, jobs):
+            try:
+                question_graph = job.result ()
+            except TranQLException as e:
+                logger.error (f"service {service} failed: {e}")
+                failures.append (e)
+                interpreter.record_errors ([ e ])
+                continue
+            if root_question_graph is None:
+                root_question_graph = question_graph
+        if len(failures) == len(jobs):
+            raise failures[0]
+        return merger.snapshot (root_question_graph)
 
-            root_question_graph = questions[0]['question_graph']
+    def ask (self, interpreter, deadline, merger):
+        """
+        Ask the service the questions this statement generates.
+        Each response is decorated and added to the merger as it arrives, so merging overlaps waiting on the service.
+        Returns the question graph of the first question.
+        """
+        """ We want to find what schema name corresponds to the url we are querying.
+        Then we can format the constraints accordingly (e.g. the ICEES schema name is 'icces'). """
 
-            service = interpreter.context.resolve_arg (self.service)
+        self.format_constraints(interpreter)
 
+        self.service = self.resolve_backplane_url (self.service, interpreter)
+        questions = self.generate_questions (interpreter)
 
-            """ Invoke the service and store the response. """
-
-            # For each question, make a request to the service with the question
-            # Only have a maximum of maximumParallelRequests requests executing at any given time
-            logger.setLevel (logging.DEBUG)
-            logger.debug (f"Starting queries on service: {service} (asynchronous={interpreter.asynchronous})")
-            logger.setLevel (logging.INFO)
-            prev = time.time ()
-            # We don't want to flood the service so we cap the maximum number of requests we can make to it.
-            maximumQueryRequests = 50
-            interpreter.context.set('requestErrors',[])
-            if interpreter.asynchronous:
-                maximumParallelRequests = 4
-                responses = async_make_requests ([
-                    {
-                        "method" : "post",
-                        "url" : service,
-                        "json" : q,
-                        "headers" : {
-                            "accept": "application/json"
-                        }
-                    }
-                    for q in questions[:maximumQueryRequests]
-                ],maximumParallelRequests)
-                errors = responses["errors"]
-                responses = responses["responses"]
-                interpreter.context.mem.get('requestErrors', []).extend(errors)
+        [self.ast.schema.validate_question(question) for question in questions]
+
+        root_question_graph = questions[0]['question_graph']
+
+        service = interpreter.context.resolve_arg (self.service)
+
+
+        """ Invoke the service and store the response. """
+
+        # For each question, make a request to the service with the question
+        # Only have a maximum of maximumParallelRequests requests executing at any given time
+        logger.setLevel (logging.DEBUG)
+        logger.debug (f"Starting queries on service: {service} (asynchronous={interpreter.asynchronous})")
+        logger.setLevel (logging.INFO)
+        prev = time.time ()
+        # We don't want to flood the service so we cap the maximum number of requests we can make to it.
+        maximumQueryRequests = 50
+        projection = self.get_projection (interpreter)
+        cached, questions = self.reuse_responses (interpreter, service, questions, projection)
+        decoration = { "schema" : self.get_schema_name (interpreter) }
+        received = 0
+        def merge (response):
+            nonlocal received
+            response['question_order'] = self.query.order
+            self.decorate_result (response, decoration)
+            merger.add (response)
+            received += 1
+        """ With a LIMIT, stop asking once enough distinct answers are in. """
+        limit = self.get_early_limit (interpreter)
+        answers = set ()
+        def enough ():
+            return limit is not None and len(answers) >= limit
+        for response in cached:
+            self.collect_answers (answers, response)
+            merge (response)
+        if enough ():
+            questions = []
+        shared = self.may_be_asked_again (interpreter, service)
+        policy = self.get_request_policy (interpreter)
+        breaker = self.get_breaker (interpreter, service)
+        if breaker.is_open () and len(questions) > 0:
+            """ Don't send a fan-out of questions to a service we know is down. """
+            raise ServiceUnavailableError (
+                f"Service {service} is unavailable. Unable to continue query. Exiting.",
+                details=f"Recent requests to {breaker.name} failed. It will be retried in {round(breaker.retry_after ())}s.")
+        def on_result (index, result):
+            """ Report each reasoner response as it arrives. """
+            if result.get ('skipped', False):
+                interpreter.track ('questions', done=1)
+                return
+            if len(result['errors']) == 0:
+                self.collect_answers (answers, result['response'])
+                if shared:
+                    interpreter.share_response (self.question_key (service, questions[index], projection), pickle.dumps (result['response']))
+                if interpreter.subgraph_cache and projection is None:
+                    subgraph_cache.store (service, questions[index], result['response'], interpreter.subgraph_cache_ttl)
+            interpreter.track ('questions', done=1)
+            interpreter.emit ('response',
+                              service=service,
+                              question=index,
+                              elapsed=result['elapsed'],
+                              errors=[ str(e) for e in result['errors'] ],
+                              message=result['response'])
+            if len(result['errors']) == 0:
+                merge (result['response'])
+        if interpreter.asynchronous:
+            maximumParallelRequests = 4
+            interpreter.track ('questions', started=len(questions[:maximumQueryRequests]))
+            responses = async_make_requests ([
+                {
+                    "method" : "post",
+                    "url" : service,
+                    "json" : q,
+                    "headers" : {
+                        "accept": "application/json"
+                    },
+                    "policy" : policy,
+                    "breaker" : breaker,
+                    "projection" : projection
+                }
+                for q in questions[:maximumQueryRequests]
+            ],maximumParallelRequests, deadline=deadline, budget=interpreter.retry_budget,
+               on_result=on_result, until=enough)
+            errors = responses["errors"]
+            for q, question_result in zip(questions, responses["results"]):
+                if len(question_result["errors"]) > 0:
+                    self.record_missing_question (interpreter, service, q)
+            interpreter.record_errors (errors)
 
+        else:
+            interpreter.track ('questions', started=len(questions[:maximumQueryRequests+1]))
+            for index, q in enumerate(questions):
+                logger.debug (f"executing question {json.dumps(q, indent=2)}")
+                try:
+                    deadline.check (f"Query deadline passed before all questions to {service} were asked.")
+                    start = time.time ()
+                    response = self.request (service, q, deadline, policy, interpreter.retry_budget, breaker, projection)
+                except (RequestTimeoutError, ServiceUnavailableError) as e:
+                    interpreter.record_errors ([ e ])
+                    for missing in questions[index:maximumQueryRequests+1]:
+                        self.record_missing_question (interpreter, service, missing)
+                        interpreter.track ('questions', done=1)
+                    break
+                on_result (index, {
+                    "response" : response,
+                    "elapsed" : round(time.time () - start, 3),
+                    "errors" : []
+                })
+                # TODO - add a parameter to limit service invocations.
+                # Until we parallelize requests, cap the max number we attempt for performance reasons.
+                #logger.debug (f"response: {json.dumps(response, indent=2)}")
+
+                if index >= maximumQueryRequests:
+                    break
+                if enough ():
+                    interpreter.track ('questions', done=len(questions[index+1:maximumQueryRequests+1]))
+                    break
+
+        logger.setLevel (logging.DEBUG)
+        logger.debug (f"Making requests took {time.time()-prev} s (asynchronous = {interpreter.asynchronous})")
+        logger.setLevel (logging.INFO)
+
+        if received == 0:
+            # interpreter.context.mem.get('requestErrors',[]).append(ServiceInvocationError(
+            #     f"No valid results from {self.service} with query {self.query}"
+            # ))
+            if interpreter.partial_results and deadline.expired ():
+                """ Nothing came back in time. Return an empty result and say so. """
+                interpreter.record_missing ("missing_segments", self.describe ())
             else:
-                responses = []
-                for index, q in enumerate(questions):
-                    logger.debug (f"executing question {json.dumps(q, indent=2)}")
-                    response = self.request (service, q)
-                    # TODO - add a parameter to limit service invocations.
-                    # Until we parallelize requests, cap the max number we attempt for performance reasons.
-                    #logger.debug (f"response: {json.dumps(response, indent=2)}")
-                    responses.append (response)
-
-                    if index >= maximumQueryRequests:
-                        break
-
-            logger.setLevel (logging.DEBUG)
-            logger.debug (f"Making requests took {time.time()-prev} s (asynchronous = {interpreter.asynchronous})")
-            logger.setLevel (logging.INFO)
-
-            for response in responses:
-                response['question_order'] = self.query.order
-
-            if len(responses) == 0:
-                # interpreter.context.mem.get('requestErrors',[]).append(ServiceInvocationError(
-                #     f"No valid results from {self.service} with query {self.query}"
-                # ))
+                deadline.check (f"Query deadline passed before {self.service} answered query {self.query}.")
                 raise ServiceInvocationError (
                     f"No valid results from service {self.service} executing " +
                     f"query {self.query}. Unable to continue query. Exiting.")
-            self.decorate_results(responses, {
-                "schema" : self.get_schema_name(interpreter)
-            })
-            result = self.merge_results (responses, interpreter, root_question_graph)
-        interpreter.context.set('result', result)
-        """ Execute set statements associated with this statement. """
-        for set_statement in self.set_statements:
-            logger.debug (f"{set_statement}")
-            set_statement.execute (interpreter, context = { "result" : result })
-        return result
+        return root_question_graph
+
+    @staticmethod
+    def question_key (service, question, projection=None):
+        """ Responses read under a projection lack attributes, so they are only reused under the same projection. """
+        key = [ service, question ] if projection is None else [ service, question, projection.to_json () ]
+        return json.dumps (key, sort_keys=True, default=str)
+
+    def may_be_asked_again (self, interpreter, service):
+        """
+        Could a statement or plan segment still to execute ask the service the questions this one asks? Only then
+        are responses kept for reuse. A statement planned from the schema could ask any service.
+        """
+        for statement in interpreter.pending_statements:
+            if not isinstance(statement, SelectStatement):
+                continue
+            for later in (statement.services if len(statement.services) > 0 else [ statement.service ]):
+                if later == "/schema":
+                    return True
+                url = interpreter.context.resolve_arg (self.resolve_backplane_url (later, interpreter))
+                if url is None or url == service:
+                    return True
+        return False
+
+    def reuse_responses (self, interpreter, service, questions, projection=None):
+        """
+        Find responses to questions already answered. Each distinct question goes to a service once per program:
+        a question asked twice by this statement is asked once, and one asked by an earlier statement or plan
+        segment gets a copy of the response it got. With the subgraph cache on, questions sharing a hop with
+        earlier questions are answered from it. The subgraph cache holds whole responses, which are projected here.
+        Returns the responses found and the questions left to ask.
+        """
+        cached = []
+        remaining = []
+        keys = set ()
+        for q in questions:
+            key = self.question_key (service, q, projection)
+            if key in keys:
+                continue
+            keys.add (key)
+            payload = interpreter.shared_responses.get (key, None)
+            response = pickle.loads (payload) if payload is not None else None
+            if response is None and interpreter.subgraph_cache:
+                response = subgraph_cache.lookup (service, q, self.broader_types)
+                if response is not None and projection is not None:
+                    response = projection.apply (response)
+            if response is None:
+                remaining.append (q)
+            else:
+                cached.append (response)
+                interpreter.emit ('response', service=service, question=None, elapsed=0, errors=[],
+                                  cached=True, message=response)
+        logger.debug (f"answered {len(cached)} of {len(questions)} questions to {service} without asking")
+        interpreter.track ('questions', started=len(cached), done=len(cached))
+        return cached, remaining
+
+    def describe (self):
+        """ Describe this statement's unit of work for completeness reporting. """
+        return {
+            "service" : self.service,
+            "query" : self.query.order
+        }
+
+    def record_missing_question (self, interpreter, service, question):
+        interpreter.record_missing ("missing_questions", {
+            "service" : service,
+            "question_graph" : question['question_graph']
+        })
 
     def execute_plan (self, interpreter):
         """ Execute a query using a schema based query planning strategy. """
         self.service = ''
         plan = self.planner.plan (self.query)
         statements = self.plan (plan)
-        responses = []
-        duplicate_statements = []
+        interpreter.track ('segments', started=len(statements))
+        """ Segments are merged as they complete. Handoffs use the ids of the merged nodes. """
+        merger = self.merger (interpreter)
+        """ The statements after this one. Segments after each segment are added to them while it executes. """
+        pending_statements = interpreter.pending_statements
+        """ Responses since the last handoff. """
+        pending = []
         first_concept = None
+        complete = True
 
         # Generate the root statement's question graph
         root_question_graph = self.generate_questions(interpreter)[0]['question_graph']
 
         for index, statement in enumerate(statements):
             logger.debug (f" -- {statement.query}")
-            response = statement.execute (interpreter)
+            if interpreter.partial_results and self.deadline.expired ():
+                """ Out of time. Merge what we have and record the segments we did not get to. """
+                for missing in statements[index:]:
+                    interpreter.record_missing ("missing_segments", missing.describe ())
+                complete = False
+                break
+            start = time.time ()
+            interpreter.pending_statements = statements[index+1:] + pending_statements
+            try:
+                response = statement.execute (interpreter)
+            finally:
+                interpreter.pending_statements = pending_statements
+            if interpreter.partial_results and self.deadline.expired () and len(response['knowledge_map']) == 0:
+                complete = False
             response['question_order'] = statement.query.order
-            responses.append (response)
-            duplicate_statements.append (response)
+            merger.add (response)
+            pending.append (response)
+            interpreter.track ('segments', done=1)
+            interpreter.emit ('segment',
+                              index=index,
+                              service=statement.service,
+                              query=statement.query.order,
+                              elapsed=round(time.time () - start, 3))
             if index < len(statements) - 1:
                 """ Implement handoff. Finds the type name of the first element of the
                 next plan segment, looks up values for that type from the answer bindings of the
@@ -632,9 +1062,14 @@ class SelectStatement(Statement):
                 if statements[index].query.order == next_statement.query.order:
                     first_concept.set_nodes (statements[index].query.concepts[name].nodes)
                 else:
-                    values = self.jsonkit.select (f"$.knowledge_map.[*].[*].node_bindings.{name}", self.merge_results(duplicate_statements, interpreter, root_question_graph))
-                    duplicate_statements = []
+                    values = self.handoff_values (pending, name, merger.canonical)
+                    pending = []
                     first_concept.set_nodes (values)
+                    if len(values) == 0 and interpreter.partial_results and self.deadline.expired ():
+                        for missing in statements[index+1:]:
+                            interpreter.record_missing ("missing_segments", missing.describe ())
+                        complete = False
+                        break
                     if len(values) == 0:
                         print (f"---> {json.dumps(response, indent=2)}")
                         message = f"No valid results from service {statement.service} executing " + \
@@ -642,232 +1077,52 @@ class SelectStatement(Statement):
                         raise ServiceInvocationError (
                             message = message,
                             details = Text.short (obj=f"{json.dumps(response, indent=2)}", limit=1000))
-        merged = self.merge_results (responses, interpreter, root_question_graph, self.query.order)
-        questions = self.generate_questions (interpreter)
-        # merged['question_graph'] = questions[0]['question_graph']
-        return merged
+        """ Answers can only be joined along the full path if every segment ran. Otherwise, keep each segment's answers. """
+        root_order = self.query.order if complete else None
+        return merger.snapshot (root_question_graph, root_order)
 
     @staticmethod
-    def merge_results (responses, interpreter, question_graph, root_order=None):
-        """ Merge results. """
+    def handoff_values (responses, name, canonical):
+        """ The canonical ids of the nodes the responses' answers bind to a question node. """
+        values = []
+        for response in responses:
+            for answer in response.get ('knowledge_map', []):
+                bound = answer.get ('node_bindings', {}).get (name, None)
+                if bound is None:
+                    continue
+                for id in (bound if isinstance(bound, list) else [ bound ]):
+                    values.append (canonical.get (id, id))
+        return values
 
+    @staticmethod
+    def merger (interpreter, processes=None):
         """
-        If True, SelectStatement::resolve_name (and therefore the Bionames API) will be called on every node that does not already possess the `equivalent_identifiers` property.
-        As of now, this feature should be left disabled as it results in large queries failing due to the flooding of the Bionames API. Additionally, the Bionames class does not use async requests as of now, so it is also quite slow.
-        """
-        RESOLVE_EQUIVALENT_IDENTIFIERS = interpreter.resolve_names
-        """
-        If True, all nodes that have identical names will be assumed to be identical nodes and will consequently be merged together.
-        """
-        NAME_BASED_MERGING = interpreter.name_based_merging
-
-        # result = responses[0] if len(responses) > 0 else None
-        result = {
-                "knowledge_graph": {
-                    "nodes": [],
-                    "edges": []
-                },
-                "knowledge_map": [],
-                "question_graph": question_graph
-        }
-        # if not 'knowledge_graph' in result:
-        #     message = "Malformed response does not contain knowledge_graph element."
-        #     logger.error (f"{message} svce: {service}: {json.dumps(result, indent=2)}")
-        #     raise MalformedResponseError (message)
-        kg = result['knowledge_graph']
-        #answers = result['answers']
-        answers = result['knowledge_map']
-
-        node_map = {}
-
-        replace_edge_ids = []
-        if RESOLVE_EQUIVALENT_IDENTIFIERS:
-            logger.info ('Starting to fetch equivalent identifiers')
-        total_requests = 0
-        prev_time = time.time()
-        """
-        Fetch/create equivalent identifiers for all nodes in the responses.
-
-        Convert the type property on all nodes and edges to a list if it is not already one.
+        An IncrementalMerger configured by the interpreter. With several processes, by default the interpreter's
+        merge_processes, a PartitionedMerger.
         """
-        for response in responses:
-            if 'knowledge_graph' in response:
-                nodes = response['knowledge_graph'].get('nodes',[])
-                edges = response['knowledge_graph'].get('edges',[])
-                for node in nodes:
-                    """
-                    Convert the `type` property of all nodes into a list. Create it if they do not already have it.
-                    """
-                    if 'type' not in node:
-                        node['type'] = []
-                    if (not isinstance(node['type'],list)):
-                        node['type'] = [node['type']]
-
-                    """
-                    Create the `equivalent_identifiers` property on all nodes that do not already have it.
-                    """
-                    if 'equivalent_identifiers' not in node:
-                        ids = [node['id']]
-                        if RESOLVE_EQUIVALENT_IDENTIFIERS:
-                            ids = SelectStatement.resolve_name (node.get('name',None), node.get('type',''))
-                        node['equivalent_identifiers'] = ids
-                        total_requests += 1
-                    """
-                    Give the node its own identifier inside its equivalent identifiers if it doesn't already have it.
-                    """
-                    if node['id'] not in node['equivalent_identifiers']:
-                        node['equivalent_identifiers'].append(node['id'])
-
-                for edge in edges:
-                    """
-                    Convert the `type` property of all edges into a list. Create it if they do not already have it.
-                    """
-                    if 'type' not in edge:
-                        edge['type'] = []
-                    if (not isinstance(edge['type'],list)):
-                        edge['type'] = [edge['type']]
-
-        if RESOLVE_EQUIVALENT_IDENTIFIERS:
-            logger.info (f'Finished fetching equivalent identifiers for {total_requests} nodes ({time.time()-prev_time}s).')
-
+        processes = interpreter.merge_processes if processes is None else processes
+        resolve = None
+        if interpreter.resolve_names:
+            """
+            If True, the names of nodes that do not already possess the `equivalent_identifiers` property are resolved with Bionames (and MyChem for chemicals).
+            The names in each response are resolved together by the interpreter's NameResolver, which caches them, so each distinct name is looked up once.
+            """
+            def resolve (names):
+                return interpreter.name_resolver.resolve_all (names, interpreter.deadline)
         """
-        For instances where multiple nodes have the same name, infer that they are equivalent and give each equivalent identifiers to one another.
-        Note: this infers that if a node has the same `name` property as another, then it be the other. If this ever becomes untrue, it needs to be updated.
+        If name_based_merging is True, all nodes that have identical names will be assumed to be identical nodes and will consequently be merged together.
         """
-        if NAME_BASED_MERGING:
-            node_name_map = {}
-            for response in responses:
-                if 'knowledge_graph' in response:
-                    nodes = response['knowledge_graph'].get('nodes',[])
-                    for node in nodes:
-                        """
-                        Add to the node_name_map of duplicate names to nodes
-                        """
-                        name = node.get('name',None)
-                        if name != None:
-                            if name not in node_name_map:
-                                node_name_map[name] = [node]
-                            else:
-                                node_name_map[name].append(node)
-
-            for i in node_name_map:
-                """
-                Assign every node the equivalent_identifiers property of all other nodes with the same name
-                """
-                nodes = node_name_map[i]
-                all_equivalent_identifiers = []
-                [all_equivalent_identifiers.extend(node['equivalent_identifiers']) for node in nodes]
-                # Filter out all duplicates
-                all_equivalent_identifiers = list(set(all_equivalent_identifiers))
-                for node in nodes:
-                    node['equivalent_identifiers'] = all_equivalent_identifiers
+        if processes > 1:
+            return PartitionedMerger (processes, name_based_merging=interpreter.name_based_merging, resolve=resolve)
+        return IncrementalMerger (name_based_merging=interpreter.name_based_merging, resolve=resolve)
 
-
-        for response in responses:
-            #logger.error (f"   -- Response message: {json.dumps(result, indent=2)}")
-            # TODO: Preserve reasoner provenance. This treats nodes as equal if
-            # their ids are equal. Consider merging provenance/properties.
-            # Edges, we may keep distinct and whole or merge to some tbd extent.
-            if 'knowledge_graph' in response:
-                rkg = response['knowledge_graph']
-                #result['answers'] += response['answers']
-                [kg['edges'].append(e) for e in rkg.get('edges',[])]
-                # qg = response.get('question_graph',{})
-                # result['question_graph']['nodes'].extend(qg.get('nodes',[]))
-                # result['question_graph']['edges'].extend(qg.get('edges',[]))
-                other_nodes = rkg['nodes'] if 'nodes' in rkg else []
-                for n in other_nodes:
-                    """
-                    If possible, try to convert all nodes to a single identifier so that we don't end up with multiple separate nodes that are actually the same in the graph.
-                    Example: https://i.imgur.com/Z76R1wZ.png. The node on left is called "citric acid," and the node on right is called "anhydrous citric acid."
-                    The left node's id is "CHEBI:30769" and the right node's id is "CHEMBL:CHEMBL1261." These identifiers are actually equivalent to each other.
-                    """
-                    ids = n['equivalent_identifiers']
-                    exists = False
-                    for id in ids:
-                        for node_id in node_map:
-                            node = node_map[node_id]
-                            if id == node_id or id in node['equivalent_identifiers']:
-                                exists = True
-                                break
-                        if exists:
-                            replace_edge_ids.append([n["id"], node["id"]])
-                            # Ensure that both nodes' properties are represented in the new node.
-                            light_merge(node,n)
-                            light_merge(n,node)
-                            break
-                    if not exists:
-                        node_map[n['id']] = n
-                        kg['nodes'].append (n)
-        # We need to update the edges' ids if we changed any node ids.
-        for old_id, new_id in replace_edge_ids:
-            for edge in result['knowledge_graph'].get('edges',[]):
-                if old_id == edge['source_id']:
-                    edge['source_id'] = new_id
-                if old_id == edge['target_id']:
-                    edge['target_id'] = new_id
-            # We also need to replace these old identifiers within the knowledge map or bad things will happen.
-            for response in responses:
-                for answer in response['knowledge_map']:
-                    node_bindings = answer.get('node_bindings',{})
-
-                    for concept in node_bindings:
-                        identifier = node_bindings[concept]
-                        if identifier == old_id:
-                            identifier = new_id
-                        node_bindings[concept] = identifier
-
-
-        # Kill all duplicate edges. Merge them into the winning edge.
-        # This has to occur after edge ids are replaced so that we can more succesfully detect duplicate edges, since nodes will have been merged into one another.
-        merged_edges = []
-        killed_edges = []
+    @staticmethod
+    def merge_results (responses, interpreter, question_graph, root_order=None):
+        """ Merge results. The responses are modified. """
+        merger = SelectStatement.merger (interpreter)
         for response in responses:
-            if 'knowledge_graph' in response:
-                rkg = response['knowledge_graph']
-                other_edges = rkg['edges'] if 'edges' in rkg else []
-                for e in other_edges:
-                    exists = False
-                    e_type = e.get('type',None)
-                    for edge in merged_edges:
-                        edge_type = edge.get('type',None)
-                        if sorted(edge_type) == sorted(e_type) and edge['source_id'] == e['source_id'] and edge['target_id'] == e['target_id']:
-                            exists = True
-                            break
-                    if exists:
-                        light_merge(edge,e)
-                        light_merge(e,edge)
-                        killed_edges.append ([e['id'], edge['id']])
-                    else:
-                        merged_edges.append (e)
-
-        # For each killed edge, go through the knowledge_map and replace the dead edge's id with the new edge's id.
-        for old_edge_id, new_edge_id in killed_edges:
-            for response in responses:
-                for answer in response['knowledge_map']:
-                    edge_bindings = answer.get('edge_bindings',{})
-                    delete = False
-                    for concept in edge_bindings:
-                        if isinstance(edge_bindings[concept], list):
-                            identifiers = []
-                            for identifier in edge_bindings[concept]:
-                                if identifier == old_edge_id:
-                                    identifier = new_edge_id
-                                identifiers.append(identifier)
-                            edge_bindings[concept] = identifiers
-                        else:
-                            identifier = edge_bindings[concept]
-                            if identifier == old_edge_id:
-                                identifier = new_edge_id
-                            edge_bindings[concept] = identifier
-
-        kg['edges'] = merged_edges
-
-
-        result['knowledge_map'] = SelectStatement.connect_knowledge_maps(responses, root_order)
-
-
-        return result
+            merger.add (response)
+        return merger.snapshot (question_graph, root_order)
 
     @staticmethod
     def connect_knowledge_maps(responses, root_order):
@@ -879,147 +1134,16 @@ class SelectStatement(Statement):
         # must be connected to another answer with `disease : "MONDO:Y" -> gene : "HGNC:Z"` in order to form a complete answer.
         # We need the entire path of a query in each answer.
 
-        result_km = []
-
         if len(responses) == 1:
-            result_km = responses[0]['knowledge_map']
-
+            return responses[0]['knowledge_map']
         elif root_order == None:
-            for response in responses:
-                result_km.extend(response['knowledge_map'])
-        else:
-            ordered_responses = {}
-            for first_response in responses:
-                if root_order[0] == first_response['question_order'][0]:
-                    if root_order[0] in ordered_responses:
-                        ordered_responses[root_order[0]].append (first_response)
-                    else:
-                        ordered_responses[root_order[0]] = [first_response]
-
-            while sum(len(resp) for resp in ordered_responses.values()) < len(responses):
-                response = list(ordered_responses.values())[-1][0]
-                next_response_start = response['question_order'][-1]
-                # print(next_response_start)
-                for next_response in responses:
-                    if next_response['question_order'][0] == next_response_start:
-                        if next_response_start in ordered_responses:
-                            ordered_responses[next_response_start].append (next_response)
-                        else:
-                            ordered_responses[next_response_start] = [next_response]
-
-            # print (json.dumps(
-            #     ordered_responses,
-            #     indent=2
-            # ))
-            for enum, current_responses in enumerate(list(ordered_responses.values())[:-1]):
-                new_answers = []
-                next_responses = list(ordered_responses.values())[enum+1]
-                # First responses, must be head answers that will be used to build off of.
-                if enum == 0:
-                    for current_response in current_responses:
-                        for answer in current_response['knowledge_map']:
-                            result_km.append (answer)
-
-                for current_response in current_responses:
-                    for next_response in next_responses:
-
-                        current_response_end = current_response['question_order'][-1]
-                        next_response_start = next_response['question_order'][0]
-
-                        # print([
-                        #     current_response_end,
-                        #     next_response_start,
-                        #     result_km,
-                        #     next_response['knowledge_map']
-                        # ])
-
-                        for current_answer in result_km:
-                            for next_answer in next_response['knowledge_map']:
-                                current_node_bindings = current_answer['node_bindings']
-                                current_edge_bindings = current_answer['edge_bindings']
-
-                                next_node_bindings = next_answer['node_bindings']
-                                next_edge_bindings = next_answer['edge_bindings']
-
-
-                                current_last_concept_id = current_node_bindings[current_response_end]
-                                next_first_concept_id = next_node_bindings[next_response_start]
-
-                                if current_last_concept_id == next_first_concept_id:
-                                    merged_answer = copy.deepcopy(current_answer)
-                                    merged_answer['node_bindings'].update (next_node_bindings)
-                                    merged_answer['edge_bindings'].update (next_edge_bindings)
-
-                                    new_answers.append(merged_answer)
-
-                result_km = []
-                dump_map = {}
-                # Filter duplicates and set new result_km
-                for answer in new_answers:
-                    dumped = json.dumps(answer)
-                    if dumped not in dump_map:
-                        dump_map[dumped] = answer
-                        result_km.append(answer)
-
-
-            # for prev_response in responses:
-            #     detached = root_order[0] != prev_response['question_order'][0]
-            #     if not detached:
-            #         # logger.critical([prev_response['question_order'], 'detached'])
-            #         result_km.extend(prev_response['knowledge_map'])
-            #     for response in responses:
-            #         if prev_response == response: continue
-            #
-            #         prev_response_end = prev_response['question_order'][-1]
-            #         current_response_start = response['question_order'][0]
-            #
-            #         # logger.critical([prev_response_end,current_response_start])
-            #
-            #         if prev_response_end == current_response_start:
-            #             prev_knowledge_map = prev_response['knowledge_map']
-            #             current_knowledge_map = response['knowledge_map']
-            #             for prev_answer in prev_knowledge_map:
-            #                 for current_answer in current_knowledge_map:
-            #                     prev_node_bindings = prev_answer['node_bindings']
-            #                     prev_edge_bindings = prev_answer['edge_bindings']
-            #                     current_node_bindings = current_answer['node_bindings']
-            #                     current_edge_bindings = current_answer['edge_bindings']
-            #
-            #                     prev_last_concept_id = prev_node_bindings[prev_response_end]
-            #                     current_first_concept_id = current_node_bindings[current_response_start]
-            #
-            #                     if prev_last_concept_id == current_first_concept_id:
-            #                         # Merge these two answers and then add the result to the resulting knowledge map
-            #                         merged_answer = copy.deepcopy(prev_answer)
-            #                         # Merge node_bindings of current answer into the copied previous answer
-            #                         merged_answer['node_bindings'].update (current_node_bindings)
-            #                         # Same for edge_bindings
-            #                         merged_answer['edge_bindings'].update (current_edge_bindings)
-            #
-            #                         result_km.append(merged_answer)
-
-
-                # result_km.append(answer)
-
-                # logger.critical([question_graph, response['question_order']])
-
-        # Filter any answers whose node_bindings aren't the complete path
-        # if root_order != None:
-        #     filtered_result_km = []
-        #     for answer in result_km:
-        #         delete = False
-        #         node_bindings = answer["node_bindings"]
-        #         for qg_node in root_order:
-        #             if qg_node not in node_bindings:
-        #                 delete = True
-        #                 break
-        #         if not delete:
-        #             filtered_result_km.append (answer)
-        #     result_km = filtered_result_km
-
-
-        # logger.critical(result_km)
-        return result_km
+            return [ answer for response in responses for answer in response['knowledge_map'] ]
+        vocabulary = Vocabulary ()
+        tables = [
+            (response['question_order'], AnswerTable.from_answers (response['knowledge_map'], vocabulary))
+            for response in responses
+        ]
+        return AnswerTable.connect (tables, root_order).to_answers ()
 
 class TranQL_AST:
     """Represent the abstract syntax tree representing the logical structure of a parsed program."""
@@ -1033,6 +1157,7 @@ class TranQL_AST:
         self.parse_tree = parse_tree
         logger.debug (f"{json.dumps(self.parse_tree, indent=2)}")
         for index, element in enumerate(self.parse_tree):
+            count = len(self.statements)
             if isinstance (element, list):
                 statement = self.remove_whitespace (element, also=["->"])
                 if element[0] == 'set':
@@ -1047,6 +1172,8 @@ class TranQL_AST:
                         self.parse_select (element)
                     elif command == 'create':
                         self.parse_create (element)
+            for statement in self.statements[count:]:
+                statement.tokens = element
 
     def parse_create(self, element):
         """ Parse a create graph statement. """
@@ -1079,6 +1206,9 @@ class TranQL_AST:
                         select.query.add (token)
                 if command == 'from':
                     select.service = e[1][0]
+                    select.services = e[1] if len(e[1]) > 1 else []
+                elif command == 'limit':
+                    select.limit = e[1]
                 elif command == 'where':
                     for condition in e[1:]:
                         if isinstance(condition, list) and len(condition) == 3:
@@ -1233,6 +1363,7 @@ class QueryPlanStrategy:
         edge = None
         schema = None
         converted = False
+        unavailable = []
 
         source_type = source.type_name
         target_type = target.type_name
@@ -1242,6 +1373,11 @@ class QueryPlanStrategy:
         for schema_name, sub_schema_package in self.schema.schema.items ():
             """ Look for a path satisfying this edge in each schema. """
             sub_schema = sub_schema_package ['schema']
+            if breakers.is_open (schema_name):
+                """ Route around reasoners known to be down. """
+                if source_type in sub_schema and target_type in sub_schema[source_type]:
+                    unavailable.append (schema_name)
+                continue
             sub_schema_url = sub_schema_package ['url']
 
             if source_type in sub_schema:
@@ -1265,6 +1401,8 @@ class QueryPlanStrategy:
                 implicit_conversion = BiolinkModelWalker ()
                 for conv_type in implicit_conversion.get_transitions (source_type):
                     implicit_conversion_schema = "implicit_conversion"
+                    if breakers.is_open (implicit_conversion_schema):
+                        break
                     implicit_conversion_url = self.schema.schema[implicit_conversion_schema]['url']
                     if conv_type in sub_schema:
                         logger.debug (f"  --impconv: {schema_name} - {conv_type} => {target_type}")
@@ -1284,6 +1422,13 @@ class QueryPlanStrategy:
                                           exclude_patterns=source.exclude_patterns), predicate, target ]
                             ]])
                             converted = True
+        if not converted and len(unavailable) > 0:
+            raise ServiceUnavailableError (
+                f"No available reasoner supports the transition from {source_type} to {target_type}.",
+                details=''.join ([
+                    "Reasoners supporting this transition are currently unavailable: \n",
+                    json.dumps ([ breakers.get (name).to_dict () for name in unavailable ], indent=2)
+                ]))
         if not converted:
             source_target_predicates = self.explain_predicates (source_type, target_type)
             target_source_predicates = self.explain_predicates (target_type, source_type)
@@ -1,4 +1,5 @@
 import networkx as nx
+import hashlib
 import json
 import yaml
 import logging
@@ -87,9 +88,13 @@ class GraphTranslator:
 class Schema:
     """ A schema for a distributed knowledge network. """
 
-    def __init__(self, backplane):
+    """ The version of the most recently loaded schema. """
+    snapshot_version = None
+
+    def __init__(self, backplane, timeout=30):
         """
         Create a metadata map of the knowledge network.
+        Remote schemas that do not answer within timeout seconds are reported as load errors.
         """
 
         # String[] of errors encountered during loading.
@@ -110,7 +115,7 @@ class Schema:
                 # If schema_data is a URL
                 try:
                     old_s_d = schema_data
-                    response = requests.get (schema_data)
+                    response = requests.get (schema_data, timeout=timeout)
                     schema_data = response.json()
                     if 'message' in schema_data:
                         raise Exception(schema_data['message'])
@@ -131,6 +136,10 @@ class Schema:
             self.config['schema'][schema_name] = metadata
         self.schema = self.config['schema']
 
+        """ Identify this snapshot of the federated schema. Results computed against another snapshot may differ. """
+        self.version = hashlib.sha256 (json.dumps (self.schema, sort_keys=True, default=str).encode ('utf-8')).hexdigest ()
+        Schema.snapshot_version = self.version
+
         """ Build a graph of the schema. """
         #self.schema_graph = RedisGraph ()
         self.schema_graph = NetworkxGraph ()
@@ -6,6 +6,7 @@ import json
 import traceback
 import unittest
 import datetime
+import functools
 import os
 import re
 from collections import Iterable
@@ -160,17 +161,55 @@ class Resource:
 
 class JSONKit:
     """ Generic kit for sql like selects on JSON object hierarchies. """
+
+    """ Queries for the nodes bound to a question node in each answer, as used in handoff. These are answered
+    without jsonpath: $.knowledge_map.[*].node_bindings.<name>, with answers for knowledge_map and [*] repeatable. """
+    bindings_query = re.compile (r"^\$\.(knowledge_map|answers)((?:\.?\[\*\])+)\.node_bindings\.([A-Za-z_][A-Za-z0-9_]*)$")
+
     def select (self, query, graph, field="type", target=None):
         """ Query nodes by some field, matching a list of target values """
-        jsonpath_query = parse (query)
-        values = [ match.value for match in jsonpath_query.find (graph) ]
+        bindings = self.bindings_query.match (query)
+        if bindings is not None:
+            section, stars, name = bindings.groups ()
+            values = self.select_bindings (graph, section, stars.count ("[*]"), name)
+        else:
+            values = [ match.value for match in self.compile (query).find (graph) ]
         return [ val for val in values if target is None or val[field] in target ]
 
+    @staticmethod
+    @functools.lru_cache (maxsize=256)
+    def compile (query):
+        """ Parse a jsonpath query once. """
+        return parse (query)
+
+    @staticmethod
+    def select_bindings (graph, section, stars, name):
+        """ Select what each answer binds a question node to, as jsonpath would: [*] iterates a list and
+        passes anything else through, and answers without a binding for the node are skipped. """
+        if not isinstance(graph, dict) or section not in graph:
+            return []
+        answers = [ graph[section] ]
+        for i in range(stars):
+            expanded = []
+            for answer in answers:
+                if isinstance(answer, list):
+                    expanded.extend (answer)
+                else:
+                    expanded.append (answer)
+            answers = expanded
+        return [
+            answer['node_bindings'][name] for answer in answers
+            if isinstance(answer, dict) and isinstance(answer.get ('node_bindings', None), dict) and
+            name in answer['node_bindings']
+        ]
+
 class Context:
     """ A trivial context implementation. """
     def __init__(self):
         self.mem = {
         }
+        """ Names of variables set, for each tracking of writes in progress, innermost last. """
+        self.writes = []
         self.jk = JSONKit ()
         generate_gene_vocab (self)
         #generate_disease_vocab (self)
@@ -188,6 +227,17 @@ class Context:
 
     def set(self, name, val):
         self.mem[name] = val
+        for writes in self.writes:
+            writes.add (name)
+
+    def track_writes (self):
+        """ Start recording the names of variables set. Tracking may be nested. """
+        self.writes.append (set ())
+
+    def stop_tracking_writes (self):
+        """ Stop the innermost tracking of writes, returning the variables set since it started and their values. """
+        writes = self.writes.pop () if len(self.writes) > 0 else set ()
+        return { name : self.mem[name] for name in writes if name in self.mem }
 
     def select (self, key, query):
         """ context.select ('chemical_pathways', '$.knowledge_graph.nodes.[*].id,equivalent_identifiers')
@@ -248,42 +298,84 @@ class Context:
         ipd.display(ipd.HTML(result))
         #return result
 
+class PatternMatcher:
+    """
+    Matches identifiers against a list of patterns, case insensitively, as re.search would.
+    Patterns that are plain text, like CHEBI:, or plain text anchored at the start, like ^CHEBI:, are
+    checked with string operations. The rest are compiled into a single alternation.
+    Get matchers with PatternMatcher.compile so each list of patterns is compiled once.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.prefixes = []
+        self.substrings = []
+        expressions = []
+        for pattern in patterns:
+            text = pattern[1:] if pattern.startswith ("^") else pattern
+            if re.escape (text) == text:
+                (self.prefixes if pattern.startswith ("^") else self.substrings).append (text.lower ())
+            else:
+                expressions.append (pattern)
+        self.prefixes = tuple(self.prefixes)
+        self.expressions = [ re.compile ("|".join ([ f"(?:{e})" for e in expressions ]), re.IGNORECASE) ] \
+                           if len(expressions) > 0 else []
+        if len(self.expressions) > 0 and self.expressions[0].groups > 0:
+            """ Group references are numbered per pattern. Keep patterns with groups apart. """
+            self.expressions = [ re.compile (e, re.IGNORECASE) for e in expressions ]
+
+    @staticmethod
+    @functools.lru_cache (maxsize=1024)
+    def compile (patterns):
+        """ Get the matcher for a tuple of patterns. """
+        return PatternMatcher (patterns)
+
+    @staticmethod
+    def for_prefixes (prefixes):
+        """ Get a matcher for curies with any of the given prefixes. """
+        return PatternMatcher.compile (tuple([ f"^{re.escape (prefix)}:" for prefix in prefixes ]))
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def matches (self, identifier):
+        """ Does any pattern match the identifier? """
+        lower = identifier.lower ()
+        return lower.startswith (self.prefixes) or \
+            any ([ s in lower for s in self.substrings ]) or \
+            any ([ e.search (identifier) is not None for e in self.expressions ])
+
 class Concept:
-    def __init__(self, name, type_name, include_patterns = [], exclude_patterns = []):
+    def __init__(self, name, type_name, include_patterns = None, exclude_patterns = None):
         self.name = name
         self.type_name = type_name
         self.nodes = []
-        self.include_patterns = include_patterns
-        self.exclude_patterns = exclude_patterns
+        """ Each concept gets its own lists. Where clauses append to them. """
+        self.include_patterns = include_patterns if include_patterns is not None else []
+        self.exclude_patterns = exclude_patterns if exclude_patterns is not None else []
     def __repr__(self):
         return f"{self.name}:{self.nodes}"
     def set_exclude_patterns (self, patterns):
         self.exclude_patterns = patterns
+    @staticmethod
+    def identifier (n):
+        return n if isinstance(n, str) else (n['curie'] if 'curie' in n else n['id'])
     def filter_nodes (self, nodes):
+        """ Keep nodes matching an include pattern, if there are any, and no exclude pattern. """
+        if len(self.include_patterns) == 0 and len(self.exclude_patterns) == 0:
+            return list(nodes)
+        include = PatternMatcher.compile (tuple(self.include_patterns))
+        exclude = PatternMatcher.compile (tuple(self.exclude_patterns))
         final_list = []
         for n in nodes:
-            exclude = False
-            for pat in self.exclude_patterns:
-                identifier = n if isinstance(n, str) else (n['curie'] if 'curie' in n else n['id'])
-                matches = re.search (pat, identifier, re.IGNORECASE)
-                if matches is not None:
-                    exclude = True
-                    break
-            include = not len(self.include_patterns) > 0
-            for pat in self.include_patterns:
-                identifier = n if isinstance(n, str) else (n['curie'] if 'curie' in n else n['id'])
-                matches = re.search (pat, identifier, re.IGNORECASE)
-                if matches is not None:
-                    include = True
-                    break
-            if include and not exclude:
+            identifier = self.identifier (n)
+            if (len(include) == 0 or include.matches (identifier)) and not exclude.matches (identifier):
                 final_list.append (n)
         return final_list
     def set_nodes (self, nodes):
         keep_nodes = {}
         for n in nodes:
-            identifier = n if isinstance(n, str) else (n['curie'] if 'curie' in n else n['id'])
-            keep_nodes[identifier] = n
+            keep_nodes[self.identifier (n)] = n
         self.nodes = self.filter_nodes (list(keep_nodes.values()))
     def apply_filters (self):
         nodes = self.filter_nodes (self.nodes)
@@ -235,6 +235,8 @@ class App extends Component {
   from \"/graph/gamma/quick\"
  where disease=\"asthma\"`,
       dynamicIdResolution: true,
+      // Reuse the server's results for statements unchanged since they last ran. They may be minutes old.
+      statementMemo: false,
 
       // Concept model concepts and relations.
       modelConcepts : [],
@@ -1677,7 +1679,8 @@ SELECT population_of_individual_organisms->chemical_substance->gene->biological_
           this._queryController = new window.AbortController();
           const args = {
             'dynamic_id_resolution' : this.state.dynamicIdResolution,
-            'asynchronous' : true
+            'asynchronous' : true,
+            'statement_memo' : this.state.statementMemo
           };
           fetch(this.tranqlURL + '/tranql/query?'+qs.stringify(args), {
             signal: this._queryController.signal,
@@ -2664,6 +2667,9 @@ SELECT population_of_individual_organisms->chemical_substance->gene->biological_
     if (targetName === 'dynamicIdResolution') {
       this.setState({ dynamicIdResolution : e.currentTarget.checked });
       localStorage.setItem (targetName, JSON.stringify (e.currentTarget.checked));
+    } else if (targetName === 'statementMemo') {
+      this.setState({ statementMemo : e.currentTarget.checked });
+      localStorage.setItem (targetName, JSON.stringify (e.currentTarget.checked));
     } else if (targetName === 'enableNodeDrag') {
       const forceGraphOpts = this.state.forceGraphOpts;
       forceGraphOpts.enableNodeDrag = e.currentTarget.checked;
@@ -3458,6 +3464,17 @@ SELECT population_of_individual_organisms->chemical_substance->gene->biological_
                        onChange={this._handleUpdateSettings} /> Enables dynamic id lookup of curies.
               </div>
             </div>
+
+            <hr/>
+
+            <div style={{display:"flex",flexDirection:"column"}}>
+              <b>Statement Memo</b>
+              <div>
+                <input type="checkbox" name="statementMemo"
+                       checked={this.state.statementMemo}
+                       onChange={this._handleUpdateSettings} /> Reuse the server's recent results for unchanged statements. Results may be up to ten minutes old.
+              </div>
+            </div>
               </Tab>
               <Tab eventKey="graphStructure" title="Graph Structure">
             <hr style={{visibility:"hidden",marginTop:0}}/>